@@ -0,0 +1,193 @@
+""" Adaptive concurrency of PACS sends, per destination.
+
+A fast local Orthanc takes many parallel associations, while a fragile remote
+PACS starts refusing them. Each destination gets an AIMD limiter, in the
+manner of TCP congestion control:
+
+- every send that succeeds within the latency target, while the limit is in
+  use, raises the limit by 1/limit, so about one per round of sends;
+- a send that fails or is slower than the target halves the limit, at most
+  once per round: only sends started after the last decrease can decrease it
+  again.
+
+The limit always stays between a floor and a ceiling.
+
+Sends that run on a shared executor wait for their slot in a queue of the
+limiter, not on a thread of the executor: a destination at its limit never
+holds up the sends to the others, and a send cancelled or past its deadline
+while it waits is dropped without being sent.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho import logger, args_cache
+
+DECREASE_FACTOR = 0.5
+
+
+class AdaptiveLimiter:
+    """ AIMD limit on the concurrent sends to one destination. """
+
+    def __init__(self, name: str, floor: int = 1, ceiling: int = 16, initial: int = 4,
+                 latency_target: float = 5.0):
+        if not 1 <= floor <= ceiling:
+            raise ValueError(f"Invalid concurrency bounds {floor}..{ceiling}")
+        self.name = name
+        self.floor = floor
+        self.ceiling = ceiling
+        self.latency_target = latency_target
+        self.limit = float(min(max(initial, floor), ceiling))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._waiting = deque()
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("send_concurrency_limit", int(self.limit), destination=self.name)
+        metrics.set_gauge("send_in_flight", self.in_flight, destination=self.name)
+        metrics.set_gauge("send_waiting", len(self._waiting), destination=self.name)
+
+    def _take_slot(self) -> tuple:
+        """ Count a send as started. Caller holds the condition, and checked the limit. """
+        self.in_flight += 1
+        saturated = self.in_flight >= int(self.limit)
+        self._publish()
+        return time.monotonic(), saturated
+
+    def acquire(self) -> tuple:
+        """ Block until a send may start. Returns a token for release(). """
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            return self._take_slot()
+
+    def release(self, token: tuple, success: bool):
+        """ End a send, and adjust the limit from its outcome and latency. """
+        started, saturated = token
+        latency = time.monotonic() - started
+        metrics.observe("send_latency_seconds", latency, destination=self.name)
+        with self._condition:
+            self.in_flight -= 1
+            if not success or latency > self.latency_target:
+                if started >= self._last_decrease:
+                    self._decrease(latency, success)
+            elif saturated and self.limit < self.ceiling:
+                self.limit = min(self.limit + 1 / int(self.limit), self.ceiling)
+                metrics.inc("send_concurrency_increases", destination=self.name)
+            self._publish()
+            self._condition.notify_all()
+        self._dispatch()
+
+    def _give_back(self):
+        """ Free the slot of a send that was cancelled before it started, leaving the limit as it is. """
+        with self._condition:
+            self.in_flight -= 1
+            self._publish()
+            self._condition.notify_all()
+        self._dispatch()
+
+    def _decrease(self, latency: float, success: bool):
+        old = int(self.limit)
+        limit = max(self.limit * DECREASE_FACTOR, self.floor)
+        if limit == self.limit:
+            # Already at the floor
+            return
+        self.limit = limit
+        self._last_decrease = time.monotonic()
+        metrics.inc("send_concurrency_decreases", destination=self.name)
+        reason = f"slow send ({latency:.1f} s)" if success else "failed send"
+        logger.info("Lowering concurrency to %s from %d to %d after a %s",
+                    self.name, old, int(self.limit), reason)
+
+    @contextmanager
+    def slot(self):
+        """ Context manager around one send. The send counts as failed if the block raises
+        or if it sets the yielded dict's "success" to False. """
+        token = self.acquire()
+        outcome = {"success": True}
+        try:
+            yield outcome
+        except BaseException:
+            outcome["success"] = False
+            raise
+        finally:
+            self.release(token, outcome["success"])
+
+
+    def submit(self, executor, func: Callable, *args,
+               succeeded: Optional[Callable] = None) -> Future:
+        """ Run func(*args) on executor once a slot is free, without holding a thread meanwhile.
+
+        Args:
+            succeeded: succeeded(result) tells whether the send succeeded.
+                A send that raises has failed.
+
+        Returns:
+            a Future of the result. Cancelling it before the send started
+            drops the send.
+        """
+        future = Future()
+        with self._condition:
+            self._waiting.append((future, executor, func, args, succeeded))
+            self._publish()
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """ Start the waiting sends that fit in the limit. """
+        started = []
+        with self._condition:
+            while self._waiting and self.in_flight < int(self.limit):
+                waiting = self._waiting.popleft()
+                if waiting[0].cancelled():
+                    continue
+                started.append((self._take_slot(), waiting))
+            self._publish()
+        for token, (future, executor, func, args, succeeded) in started:
+            executor.submit(self._run, token, future, func, args, succeeded)
+
+    def _run(self, token: tuple, future: Future, func: Callable, args: tuple, succeeded: Optional[Callable]):
+        if not future.set_running_or_notify_cancel():
+            self._give_back()
+            return
+        success = False
+        try:
+            result = func(*args)
+            success = succeeded is None or succeeded(result)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self.release(token, success)
+
+
+class LimiterRegistry:
+    """ One AdaptiveLimiter per destination, created on first use. """
+
+    def __init__(self, floor: int, ceiling: int, initial: int, latency_target: float):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.initial = initial
+        self.latency_target = latency_target
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> AdaptiveLimiter:
+        with self._lock:
+            limiter = self._limiters.get(name)
+            if limiter is None:
+                limiter = self._limiters[name] = AdaptiveLimiter(
+                    name, self.floor, self.ceiling, self.initial, self.latency_target)
+            return limiter
+
+
+send_limiters = LimiterRegistry(
+    floor=args_cache.send_concurrency_min,
+    ceiling=args_cache.send_concurrency_max,
+    initial=args_cache.send_concurrency_initial,
+    latency_target=args_cache.send_latency_target)
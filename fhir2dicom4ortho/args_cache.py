@@ -9,6 +9,7 @@ should not be necessary anyways.
 
 """
 import os
+import tempfile
 from typing import Optional
 
 
@@ -32,6 +33,37 @@ class Namespace:
     pacs_dimse_hostname: str
     pacs_dimse_port: int
     tasks_db_url: Optional[str]
+    spool_dir: str
+    spool_max_age: int
+    max_body_bytes: int
+    compress_min_size: int
+    image_passthrough: bool
+    memory_budget_bytes: int
+    priority_aging_seconds: float
+    destinations_file: Optional[str]
+    send_threads: int
+    dicom_store_dir: Optional[str]
+    upload_threads: int
+    upload_max_attempts: int
+    upload_retry_delay: float
+    mwl_cache_size: int
+    export_chunk_size: int
+    build_timeout: float
+    send_timeout: float
+    build_threads: int
+    job_threads: int
+    send_concurrency_min: int
+    send_concurrency_max: int
+    send_concurrency_initial: int
+    send_latency_target: float
+    log_format: str
+    log_debug_sample: float
+    log_queue_size: int
+    trace_file: Optional[str]
+    trace_otlp_url: Optional[str]
+    resend_cache_dir: Optional[str]
+    resend_cache_max_bytes: int
+    resend_cache_ttl: float
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
@@ -80,5 +112,78 @@ class ArgsCache:
             pacs_dimse_port=int(os.getenv('F2D4O_PACS_DIMSE_PORT', '104')),
 
             # The path of the SQLite DB file for the local mapping. e.g.: 'sqlite:////app/tasks.db'
-            tasks_db_url=tasks_db_url
+            tasks_db_url=tasks_db_url,
+
+            # Directory where raw Binary uploads are spooled until a Bundle references them.
+            spool_dir=os.getenv('F2D4O_SPOOL_DIR', os.path.join(
+                tempfile.gettempdir(), 'fhir2dicom4ortho-spool')),
+            # Spooled Binaries older than this many seconds are purged.
+            spool_max_age=int(os.getenv('F2D4O_SPOOL_MAX_AGE', str(24 * 3600))),
+
+            # Maximum size of a request body, after decompression.
+            max_body_bytes=int(os.getenv('F2D4O_MAX_BODY_BYTES', str(256 * 1024 * 1024))),
+            # Responses smaller than this are not compressed.
+            compress_min_size=int(os.getenv('F2D4O_COMPRESS_MIN_SIZE', '1024')),
+
+            # Encapsulate baseline JPEG and JPEG 2000 input as is, without decoding it.
+            image_passthrough=bool(strtobool(os.getenv('F2D4O_IMAGE_PASSTHROUGH', 'True'))),
+
+            # Estimated bytes all running jobs may hold at once. 0 disables the budget.
+            memory_budget_bytes=int(os.getenv('F2D4O_MEMORY_BUDGET_BYTES', str(1024 * 1024 * 1024))),
+
+            # Seconds in the queue after which a job is raised by one Task.priority class.
+            priority_aging_seconds=float(os.getenv('F2D4O_PRIORITY_AGING_SECONDS', '60')),
+
+            # JSON file with extra PACS destinations and the rules routing images to them.
+            destinations_file=os.getenv('F2D4O_DESTINATIONS_FILE', None),
+            # Number of sends to PACS destinations that can run at once, over all destinations.
+            send_threads=int(os.getenv('F2D4O_SEND_THREADS', '32')),
+
+            # Directory of the local DICOM store. If set, images are written there and uploaded in the background.
+            dicom_store_dir=os.getenv('F2D4O_DICOM_STORE_DIR', None),
+            # Number of stored images uploaded at once.
+            upload_threads=int(os.getenv('F2D4O_UPLOAD_THREADS', '4')),
+            # Attempts to upload a stored image before its Task fails.
+            upload_max_attempts=int(os.getenv('F2D4O_UPLOAD_MAX_ATTEMPTS', '10')),
+            # Seconds before the first retry of an upload, doubled after each attempt.
+            upload_retry_delay=float(os.getenv('F2D4O_UPLOAD_RETRY_DELAY', '30')),
+
+            # Number of parsed MWL datasets kept in memory. 0 disables the cache.
+            mwl_cache_size=int(os.getenv('F2D4O_MWL_CACHE_SIZE', '128')),
+
+            # Number of Tasks read from the database at a time by the Task $export.
+            export_chunk_size=int(os.getenv('F2D4O_EXPORT_CHUNK_SIZE', '500')),
+
+            # Seconds a job waits for its image to be built, and for the sends to PACS. 0 waits forever.
+            build_timeout=float(os.getenv('F2D4O_BUILD_TIMEOUT', '120')),
+            send_timeout=float(os.getenv('F2D4O_SEND_TIMEOUT', '300')),
+            # Number of images that can be built at once.
+            build_threads=int(os.getenv('F2D4O_BUILD_THREADS', '10')),
+            # Number of jobs that can run at once. Their memory is bounded by the memory budget.
+            job_threads=int(os.getenv('F2D4O_JOB_THREADS', '10')),
+
+            # Bounds and starting point of the adaptive number of concurrent sends to each destination.
+            send_concurrency_min=int(os.getenv('F2D4O_SEND_CONCURRENCY_MIN', '1')),
+            send_concurrency_max=int(os.getenv('F2D4O_SEND_CONCURRENCY_MAX', '16')),
+            send_concurrency_initial=int(os.getenv('F2D4O_SEND_CONCURRENCY_INITIAL', '4')),
+            # Sends slower than this many seconds lower the concurrency, like failed ones.
+            send_latency_target=float(os.getenv('F2D4O_SEND_LATENCY_TARGET', '5')),
+
+            # Log output: text, or json, one object per line.
+            log_format=os.getenv('F2D4O_LOG_FORMAT', 'text'),
+            # Fraction of the DEBUG lines of each logging call site that are kept, between 0 and 1.
+            log_debug_sample=float(os.getenv('F2D4O_LOG_DEBUG_SAMPLE', '1')),
+            # Log records waiting to be written beyond this are dropped, and counted in log_records_dropped.
+            log_queue_size=int(os.getenv('F2D4O_LOG_QUEUE_SIZE', '10000')),
+
+            # Where trace spans are exported: a file of JSON lines, and/or an OTLP/HTTP collector URL.
+            trace_file=os.getenv('F2D4O_TRACE_FILE', None),
+            trace_otlp_url=os.getenv('F2D4O_TRACE_OTLP_URL', None),
+
+            # Directory keeping built images whose send failed, to retry and resend them without rebuilding.
+            resend_cache_dir=os.getenv('F2D4O_RESEND_CACHE_DIR', None),
+            # Total size of the cached images. The least recently used are dropped first. 0 means unbounded.
+            resend_cache_max_bytes=int(os.getenv('F2D4O_RESEND_CACHE_MAX_BYTES', str(2 * 1024 ** 3))),
+            # Seconds a cached image is kept after it was built. 0 keeps it until it is evicted.
+            resend_cache_ttl=float(os.getenv('F2D4O_RESEND_CACHE_TTL', str(7 * 24 * 3600))),
         )
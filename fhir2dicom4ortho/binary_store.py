@@ -0,0 +1,176 @@
+""" Spool for raw Binary uploads.
+
+Images and MWLs can be uploaded as raw bytes with ``POST /fhir/Binary`` instead
+of being base64 encoded inside the Bundle. The bytes are streamed to a spool
+directory, and the Bundle then refers to them with ``Binary/{id}``.
+
+Each Binary is stored as two files in the spool directory: ``{id}.bin`` with
+the raw bytes and ``{id}.json`` with its content type and size.
+
+Binaries are kept for F2D4O_SPOOL_MAX_AGE seconds, so several Bundles can
+reference the same upload, and are then purged by a scheduler job. A Binary
+held by a queued or running job is not purged until that job is done.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Optional
+
+import anyio
+
+from fhir2dicom4ortho import logger, args_cache
+
+# Uploads are written in blocks of this size, each on a worker thread
+WRITE_BLOCK_BYTES = 1024 * 1024
+# Seconds between two purges of expired Binaries
+PURGE_INTERVAL = 600
+
+
+class BinaryStore:
+    """ Stores raw Binary uploads on disk, keyed by Binary id. """
+
+    def __init__(self, spool_dir: str, max_age: Optional[int] = None):
+        self.spool_dir = Path(spool_dir)
+        self.max_age = max_age
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._holds = {}
+        self._lock = threading.Lock()
+
+    def _data_path(self, binary_id: str) -> Path:
+        return self.spool_dir / f"{binary_id}.bin"
+
+    def _meta_path(self, binary_id: str) -> Path:
+        return self.spool_dir / f"{binary_id}.json"
+
+    @staticmethod
+    def _check_id(binary_id: str):
+        """ Only accept ids we could have generated, so a reference can never escape the spool directory. """
+        try:
+            uuid.UUID(binary_id)
+        except (ValueError, TypeError) as e:
+            raise KeyError(f"Binary/{binary_id} not found") from e
+
+    async def write_stream(self, chunks: AsyncIterator[bytes], content_type: str) -> str:
+        """ Stream chunks to a new spool file and return the new Binary id.
+
+        Data is written to a temporary file first and renamed into place, so
+        a half written upload can never be referenced by a Bundle. The file is
+        written in blocks on worker threads, so the event loop never waits on
+        the disk.
+        """
+        binary_id = str(uuid.uuid4())
+        tmp_path = self.spool_dir / f".{binary_id}.tmp"
+        size = 0
+        block = bytearray()
+        try:
+            f = await anyio.to_thread.run_sync(open, tmp_path, 'wb')
+            try:
+                async for chunk in chunks:
+                    block += chunk
+                    size += len(chunk)
+                    if len(block) >= WRITE_BLOCK_BYTES:
+                        await anyio.to_thread.run_sync(f.write, bytes(block))
+                        block.clear()
+                if block:
+                    await anyio.to_thread.run_sync(f.write, bytes(block))
+            finally:
+                await anyio.to_thread.run_sync(f.close)
+            await anyio.to_thread.run_sync(self._commit, tmp_path, binary_id, content_type, size)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        logger.debug("Spooled Binary/%s (%s, %d bytes)", binary_id, content_type, size)
+        return binary_id
+
+    def _commit(self, tmp_path: Path, binary_id: str, content_type: str, size: int):
+        with open(self._meta_path(binary_id), 'w', encoding='utf-8') as f:
+            json.dump({"contentType": content_type, "size": size}, f)
+        os.replace(tmp_path, self._data_path(binary_id))
+
+    def exists(self, binary_id: str) -> bool:
+        """ True if the Binary is in the spool. """
+        try:
+            self._check_id(binary_id)
+        except KeyError:
+            return False
+        return self._data_path(binary_id).exists()
+
+    def get_content_type(self, binary_id: str) -> str:
+        """ Return the content type the Binary was uploaded with. """
+        self._check_id(binary_id)
+        try:
+            with open(self._meta_path(binary_id), 'r', encoding='utf-8') as f:
+                return json.load(f)["contentType"]
+        except FileNotFoundError as e:
+            raise KeyError(f"Binary/{binary_id} not found") from e
+
+    def get_size(self, binary_id: str) -> int:
+        """ Return the size in bytes of a spooled Binary. """
+        self._check_id(binary_id)
+        try:
+            return self._data_path(binary_id).stat().st_size
+        except FileNotFoundError as e:
+            raise KeyError(f"Binary/{binary_id} not found") from e
+
+    def read_head(self, binary_id: str, size: int) -> bytes:
+        """ Return the first size bytes of a spooled Binary, e.g. to read an image header. """
+        self._check_id(binary_id)
+        try:
+            with open(self._data_path(binary_id), 'rb') as f:
+                return f.read(size)
+        except FileNotFoundError as e:
+            raise KeyError(f"Binary/{binary_id} not found") from e
+
+    def read_bytes(self, binary_id: str) -> bytes:
+        """ Return the raw bytes of a spooled Binary. """
+        self._check_id(binary_id)
+        try:
+            return self._data_path(binary_id).read_bytes()
+        except FileNotFoundError as e:
+            raise KeyError(f"Binary/{binary_id} not found") from e
+
+    def delete(self, binary_id: str):
+        """ Remove a Binary from the spool, if present. """
+        self._check_id(binary_id)
+        self._data_path(binary_id).unlink(missing_ok=True)
+        self._meta_path(binary_id).unlink(missing_ok=True)
+
+    def hold(self, binary_ids: Iterable[str]):
+        """ Keep Binaries from being purged until a queued job that references them releases them. """
+        with self._lock:
+            for binary_id in binary_ids:
+                self._holds[binary_id] = self._holds.get(binary_id, 0) + 1
+
+    def release(self, binary_ids: Iterable[str]):
+        """ A job is done with its Binaries: they can be purged once they expire and no other job holds them. """
+        with self._lock:
+            for binary_id in binary_ids:
+                holds = self._holds.get(binary_id, 0) - 1
+                if holds > 0:
+                    self._holds[binary_id] = holds
+                else:
+                    self._holds.pop(binary_id, None)
+
+    def purge(self):
+        """ Remove spooled Binaries older than max_age seconds. """
+        if not self.max_age:
+            return
+        cutoff = time.time() - self.max_age
+        for path in self.spool_dir.glob("*.bin"):
+            with self._lock:
+                if path.stem in self._holds:
+                    continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    logger.info("Purging expired Binary/%s", path.stem)
+                    path.unlink(missing_ok=True)
+                    self._meta_path(path.stem).unlink(missing_ok=True)
+            except FileNotFoundError:
+                # Purged concurrently
+                pass
+
+
+binary_store = BinaryStore(args_cache.spool_dir, max_age=args_cache.spool_max_age)
@@ -0,0 +1,255 @@
+""" Offline bulk import of ortho-imaging-bundle Bundles, without the HTTP layer.
+
+Reads Bundles from a directory of ``.json`` files or from an NDJSON file (one
+Bundle per line, ``-`` for stdin), and builds and sends them across a pool of
+processes. Tasks are recorded in the same TaskStore as the FHIR API, by the
+parent process only, so SQLite never sees concurrent writers.
+
+Every processed input is appended to a checkpoint file, with the id of its
+Task. When an interrupted import is started again with the same checkpoint,
+inputs that completed or were rejected are skipped, and failed ones are tried
+again under the Task they already have.
+
+Jobs have the same build and send deadlines as in the FHIR API, but do not go
+through the local DICOM store or the resend cache: the import is a separate
+process, and once it exits no uploader would be left to drain them. Memory is
+bounded by the number of workers, each building one image at a time, instead
+of by the memory budget. A build that misses its deadline keeps running, so the
+worker leaves its build thread behind and starts a new one for the next input.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from fhir.resources.task import Task
+
+from fhir2dicom4ortho.ortho_bundle import parse_bundle, BundleValidationError
+from fhir2dicom4ortho.routing import router
+from fhir2dicom4ortho import tasks
+from fhir2dicom4ortho.tasks import (
+    _build_dicom_image, _send_to_destinations, _destination_outputs,
+    TASK_COMPLETED, TASK_FAILED, TASK_REJECTED)
+from fhir2dicom4ortho.job_control import run_stage, StageTimeout
+from fhir2dicom4ortho.log_pipeline import restart_logging
+from fhir2dicom4ortho import logger, args_cache
+
+# Inputs with these statuses in the checkpoint are not processed again
+DONE_STATUSES = (TASK_COMPLETED, TASK_REJECTED)
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+
+
+class _StatusRecorder:
+    """ Stands in for the TaskStore in worker processes, remembering the last status set. """
+
+    def __init__(self):
+        self.status = None
+
+    def modify_task_status(self, task_id, new_status, output=None):
+        self.status = new_status
+
+
+def read_inputs(source: str) -> Iterator[Tuple[str, Optional[str], Optional[Path]]]:
+    """ Yield (key, json text, path) for each Bundle in a directory or NDJSON file.
+
+    Files in a directory are passed as paths, so the workers read them and the
+    parent never holds their content.
+    """
+    if source != "-" and Path(source).is_dir():
+        for path in sorted(Path(source).glob("*.json")):
+            yield path.name, None, path
+        return
+    stream = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    try:
+        for line_number, line in enumerate(stream, start=1):
+            if line.strip():
+                yield f"line {line_number}", line, None
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def _new_build_executor():
+    """ Give the worker a new build thread, leaving a hung build behind. """
+    old_executor = tasks.build_executor
+    tasks.build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="f2d4o-build")
+    old_executor.shutdown(wait=False)
+
+
+def init_worker():
+    """ Set up a worker process.
+
+    Thread pools and the logging listener thread are not copied by fork:
+    give the worker pools and listeners of its own. The listeners are stopped,
+    writing out what is still queued, when the worker exits.
+    """
+    for listener in restart_logging():
+        Finalize(None, listener.stop, exitpriority=10)
+    _new_build_executor()
+    tasks.send_executor = ThreadPoolExecutor(max_workers=args_cache.send_threads, thread_name_prefix="f2d4o-send")
+
+
+def process_bundle(key: str, text: Optional[str], path: Optional[Path]) -> dict:
+    """ Build and send one Bundle. Runs in a worker process.
+
+    Returns:
+        dict with the key, the Task as JSON (or None if the Bundle could not be
+        parsed), its status, the Task.output per destination, and an error message.
+    """
+    result = {"key": key, "task": None, "status": TASK_REJECTED, "output": None, "error": None}
+    try:
+        if path is not None:
+            text = path.read_text(encoding="utf-8")
+        ortho_bundle = parse_bundle(json.loads(text))
+        result["task"] = ortho_bundle.task.model_dump_json()
+        recorder = _StatusRecorder()
+        orthodontic_photograph = run_stage(
+            tasks.build_executor, "build", _build_dicom_image, ortho_bundle, None, recorder,
+            timeout=args_cache.build_timeout)
+        destinations = router.route(ortho_bundle.task, orthodontic_photograph.dicom_mwl)
+        statuses = _send_to_destinations(
+            orthodontic_photograph.to_dataset(), destinations, timeout=args_cache.send_timeout)
+        result["output"] = [o.model_dump_json() for o in _destination_outputs(statuses)]
+        result["status"] = TASK_COMPLETED if all(s == TASK_COMPLETED for s in statuses.values()) else TASK_FAILED
+    except (BundleValidationError, json.JSONDecodeError) as e:
+        result["error"] = str(e)
+    except StageTimeout as e:
+        if e.stage == "build":
+            # The single build thread is still busy: later builds would time out behind it
+            _new_build_executor()
+        result["status"] = TASK_FAILED
+        result["error"] = str(e)
+    except Exception as e:
+        logger.exception(e)
+        result["status"] = TASK_FAILED
+        result["error"] = str(e)
+    return result
+
+
+def load_checkpoint(path: Path) -> Tuple[set, dict]:
+    """ Read a checkpoint of key, Task id and status lines.
+
+    Returns:
+        the keys of the inputs that need not be processed again, and the Task
+        id of every input that got one.
+    """
+    done = set()
+    task_ids = {}
+    if not path.exists():
+        return done, task_ids
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            # Checkpoints written before the Task id was recorded have no middle field
+            key, task_id, status = (fields[0], "", fields[1]) if len(fields) == 2 else fields[-3:]
+            if task_id:
+                task_ids[key] = task_id
+            if status in DONE_STATUSES:
+                done.add(key)
+    return done, task_ids
+
+
+class Progress:
+    """ Counts results and prints the throughput at most every PROGRESS_INTERVAL seconds. """
+
+    def __init__(self, out=sys.stderr):
+        self.out = out
+        self.started = time.monotonic()
+        self.last_print = 0
+        self.counts = {}
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def add(self, status: str):
+        self.counts[status] = self.counts.get(status, 0) + 1
+        now = time.monotonic()
+        if now - self.last_print >= PROGRESS_INTERVAL:
+            self.last_print = now
+            self.print(end="\r")
+
+    def print(self, end="\n"):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        counts = ", ".join(f"{n} {status}" for status, n in sorted(self.counts.items()))
+        print(f"{self.total} Bundles ({counts}) in {elapsed:.0f} s, {self.total / elapsed:.1f} Bundles/s",
+              end=end, file=self.out, flush=True)
+
+
+def record_result(task_store, result: dict, task_id: Optional[str] = None):
+    """ Record the final status of a processed Bundle in the TaskStore.
+
+    The Task of an input retried after an earlier import is updated; other
+    inputs get a new Task.
+    """
+    if result["task"] is None:
+        return task_id
+    if task_id is None or task_store.get_fhir_task_by_id(task_id) is None:
+        task = Task.model_validate_json(result["task"])
+        task.description = task.description or f"Bulk import {result['key']}"
+        task_id = task_store.add_task(task).id
+    output = [json.loads(o) for o in result["output"]] if result["output"] else None
+    task_store.modify_task_status(task_id, result["status"], output=output)
+    return task_id
+
+
+def run_import(source: str, task_store, workers: Optional[int] = None, checkpoint: Optional[str] = None,
+               progress: Optional[Progress] = None) -> dict:
+    """ Import all Bundles from source, and return the count of each final status. """
+    if checkpoint is None:
+        checkpoint = "import.checkpoint" if source == "-" else f"{source.rstrip('/')}.checkpoint"
+    checkpoint_path = Path(checkpoint)
+    workers = workers or os.cpu_count() or 1
+    done, task_ids = load_checkpoint(checkpoint_path)
+    if done:
+        logger.info("Skipping %d Bundles already imported according to %s", len(done), checkpoint_path)
+    progress = progress or Progress()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor, \
+            open(checkpoint_path, "a", encoding="utf-8") as checkpoint_file:
+        # Keep a bounded number of Bundles in flight, so a large NDJSON file is never read at once
+        max_in_flight = 2 * workers
+        pending = set()
+
+        def collect(futures):
+            for future in futures:
+                result = future.result()
+                task_id = record_result(task_store, result, task_ids.get(result["key"]))
+                if result["error"]:
+                    logger.warning("%s %s: %s", result["key"], result["status"], result["error"])
+                logger.debug("%s: Task %s %s", result["key"], task_id, result["status"])
+                checkpoint_file.write(f"{result['key']}\t{task_id or ''}\t{result['status']}\n")
+                checkpoint_file.flush()
+                progress.add(result["status"])
+
+        for key, text, path in read_inputs(source):
+            if key in done:
+                continue
+            pending.add(executor.submit(process_bundle, key, text, path))
+            if len(pending) >= max_in_flight:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+        collect(pending)
+
+    progress.print()
+    return dict(progress.counts)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import ortho-imaging-bundle Bundles from a directory of .json files or an NDJSON file. "
+                    "PACS and TaskStore are configured with the same F2D4O_* variables as the FHIR API.")
+    parser.add_argument("source", help="directory of Bundle .json files, NDJSON file, or - for NDJSON on stdin")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-c", "--checkpoint", default=None,
+                        help="checkpoint file used to resume an interrupted import "
+                             "(default: SOURCE.checkpoint, or import.checkpoint for stdin)")
+    return parser.parse_args(argv)
@@ -0,0 +1,216 @@
+""" Compressed transport for the FHIR API.
+
+Request bodies sent with ``Content-Encoding: gzip``, ``deflate`` or ``zstd``
+are decompressed as they are streamed in, and the decompressed size is capped
+so a small compressed upload cannot expand into an unbounded amount of memory.
+
+Responses are compressed when the client's ``Accept-Encoding`` allows it and
+the body is larger than a configurable threshold.
+
+zstd support is optional and requires the ``zstandard`` package.
+"""
+import zlib
+from typing import AsyncIterator, Callable, Optional
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zstd has no output limit on decompress(). Its stream writer hands the output
+# over in blocks of this size instead, so the size check runs after each block.
+ZSTD_OUTPUT_BLOCK = 65536
+
+
+class BodyTooLargeError(ValueError):
+    """ Raised when the (decompressed) request body exceeds the configured maximum. """
+
+
+class UnsupportedEncodingError(ValueError):
+    """ Raised when the request Content-Encoding is not supported. """
+
+
+def supported_encodings() -> list:
+    """ Content-Encodings accepted on request bodies. """
+    encodings = ["identity", "gzip", "deflate"]
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def _zlib_decoder(wbits: int, max_bytes: int):
+    decompressor = zlib.decompressobj(wbits)
+
+    def decode(chunk: bytes, total: int) -> bytes:
+        # Never ask zlib for more than would take us one byte past the limit.
+        out = decompressor.decompress(chunk, max_bytes - total + 1)
+        if decompressor.unconsumed_tail:
+            raise BodyTooLargeError(f"Decompressed request body exceeds {max_bytes} bytes")
+        return out
+    return decode
+
+
+class _CappedSink:
+    """ Collects the output of a zstd stream writer, and stops it as soon as it exceeds the limit. """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.out = bytearray()
+
+    def write(self, data: bytes) -> int:
+        if self.total + len(self.out) + len(data) > self.max_bytes:
+            raise BodyTooLargeError(f"Decompressed request body exceeds {self.max_bytes} bytes")
+        self.out += data
+        return len(data)
+
+
+def _zstd_decoder(max_bytes: int):
+    sink = _CappedSink(max_bytes)
+    writer = zstandard.ZstdDecompressor().stream_writer(sink, write_size=ZSTD_OUTPUT_BLOCK)
+
+    def decode(chunk: bytes, total: int) -> bytes:
+        sink.total = total
+        writer.write(chunk)
+        out = bytes(sink.out)
+        sink.out.clear()
+        return out
+    return decode
+
+
+def _decoder(headers: Headers, max_bytes: int) -> Optional[Callable]:
+    """ decode(chunk, total) for the Content-Encoding of a request, or None for identity. """
+    encoding = headers.get("content-encoding", "identity").strip().lower()
+    if encoding == "identity":
+        return None
+    if encoding in ("gzip", "x-gzip"):
+        return _zlib_decoder(16 + zlib.MAX_WBITS, max_bytes)
+    if encoding == "deflate":
+        return _zlib_decoder(zlib.MAX_WBITS, max_bytes)
+    if encoding == "zstd" and zstandard is not None:
+        return _zstd_decoder(max_bytes)
+    raise UnsupportedEncodingError(
+        f"Unsupported Content-Encoding '{encoding}'. Supported: {', '.join(supported_encodings())}")
+
+
+def _check_size(total: int, max_bytes: int):
+    if total > max_bytes:
+        raise BodyTooLargeError(f"Request body exceeds {max_bytes} bytes")
+
+
+async def decoded_stream(headers: Headers, chunks: AsyncIterator[bytes], max_bytes: int) -> AsyncIterator[bytes]:
+    """ Decompress a request body stream according to its Content-Encoding.
+
+    Yields decompressed chunks, and raises BodyTooLargeError as soon as more
+    than max_bytes have been produced.
+    """
+    decode = _decoder(headers, max_bytes)
+    total = 0
+    async for chunk in chunks:
+        if decode is not None:
+            chunk = decode(chunk, total)
+        total += len(chunk)
+        _check_size(total, max_bytes)
+        if chunk:
+            yield chunk
+
+
+async def read_encoded_body(headers: Headers, chunks: AsyncIterator[bytes], max_bytes: int) -> Callable[[], bytes]:
+    """ Read a whole request body as sent, and return a function that decompresses it.
+
+    The Content-Encoding is checked, and the body as sent is capped at
+    max_bytes, while reading. Decompressing is CPU bound, so it is left to the
+    returned function, to be called on a worker thread. It raises
+    BodyTooLargeError once more than max_bytes have been produced.
+    """
+    decode = _decoder(headers, max_bytes)
+    encoded = []
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        _check_size(total, max_bytes)
+        encoded.append(chunk)
+
+    def decoded() -> bytes:
+        if decode is None:
+            return b"".join(encoded)
+        body = bytearray()
+        for chunk in encoded:
+            body += decode(chunk, len(body))
+            _check_size(len(body), max_bytes)
+        return bytes(body)
+    return decoded
+
+
+async def read_body(headers: Headers, chunks: AsyncIterator[bytes], max_bytes: int) -> bytes:
+    """ Read a whole request body, decompressing it if needed. """
+    return (await read_encoded_body(headers, chunks, max_bytes))()
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """ Content-codings an Accept-Encoding header allows, leaving out those with q=0. """
+    accepted = set()
+    refused = set()
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        (accepted if q > 0 else refused).add(coding.lower())
+    if "*" in accepted:
+        accepted |= {"gzip", "zstd"} - refused
+    return accepted
+
+
+class ZstdResponder(IdentityResponder):
+    """ Compress response bodies with zstd, mirroring starlette's GZipResponder. """
+    content_encoding = "zstd"
+
+    def __init__(self, app: ASGIApp, minimum_size: int) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = zstandard.ZstdCompressor().compressobj()
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        out = self.compressor.compress(body)
+        if more_body:
+            return out + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out + self.compressor.flush()
+
+
+class CompressionMiddleware:
+    """ Compress responses with zstd or gzip, depending on Accept-Encoding.
+
+    Responses smaller than minimum_size are sent uncompressed, since the
+    framing overhead outweighs the savings on small Task resources.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, compresslevel: int = 6) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = Headers(scope=scope).get("Accept-Encoding", "")
+        accepted = accepted_encodings(accept_encoding)
+        if zstandard is not None and "zstd" in accepted:
+            responder = ZstdResponder(self.app, self.minimum_size)
+        elif "gzip" in accepted:
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
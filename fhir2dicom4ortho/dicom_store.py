@@ -0,0 +1,353 @@
+""" Local store of DICOM Part 10 files, drained to the PACS in the background.
+
+When ``F2D4O_DICOM_STORE_DIR`` is set, jobs only build the image and write it
+here; a background uploader then sends it to its destinations, retrying with
+exponential backoff while a PACS is down. Conversion throughput no longer
+depends on PACS availability, and a failed image can be sent again without
+rebuilding it.
+
+Files are sharded by Study and Series::
+
+    {root}/{hash of StudyInstanceUID[:2]}/{StudyInstanceUID}/{SeriesInstanceUID}/{SOPInstanceUID}_{task_id}.dcm
+
+The Task id is part of the name, so the same Bundle submitted twice gives two
+entries, one per Task. Next to each ``.dcm`` a ``.json`` sidecar records the
+Task id, the status of each destination and the upload attempts. Both are
+written to a temporary file and renamed into place, so a crash never leaves a
+partial file behind.
+
+The sidecars are read once, on first use, into an in-memory index that every
+later lookup uses; the disk is only written to.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict, replace
+from pathlib import Path
+from typing import Callable, Optional
+
+from pydicom import Dataset, dcmread
+
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho.log_pipeline import run_in_task_context
+from fhir2dicom4ortho import logger, args_cache
+
+DESTINATION_PENDING = "pending"
+DESTINATION_COMPLETED = "completed"
+DESTINATION_FAILED = "failed"
+
+# How often the uploader looks for entries due for a retry
+POLL_SECONDS = 5
+MAX_RETRY_DELAY = 3600
+
+
+@dataclass
+class StoreEntry:
+    """ Sidecar of a stored DICOM file. """
+    task_id: str
+    destinations: dict
+    attempts: int = 0
+    next_attempt: float = 0
+    failed: bool = False
+    # Size of the .dcm file, when it was written and when the entry was last saved
+    size: int = 0
+    created: float = 0
+    used: float = 0
+    path: Optional[Path] = field(default=None, compare=False)
+
+    def pending(self) -> list:
+        """ Names of the destinations that do not have the image yet """
+        return [name for name, status in self.destinations.items() if status != DESTINATION_COMPLETED]
+
+    def copy(self) -> "StoreEntry":
+        return replace(self, destinations=dict(self.destinations))
+
+
+def _write_atomic(path: Path, write: Callable):
+    """ Write through a temporary file in the same directory, then rename it into place. """
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+class DicomStore:
+    """ DICOM Part 10 files on disk, with a sidecar per file, indexed in memory.
+
+    Entries handed out are copies: change them, then save_entry() them.
+    """
+    # Sidecars below root_dir, and the directory levels between them
+    SIDECAR_GLOB = "*/*/*/*.json"
+    SHARD_DEPTH = 3
+
+    def __init__(self, root_dir: str):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._index = None
+        self._by_task = {}
+
+    def path_for(self, dataset: Dataset, task_id: str) -> Path:
+        """ Path of the Part 10 file of a dataset, stored for a Task """
+        study = str(dataset.StudyInstanceUID)
+        shard = hashlib.sha1(study.encode()).hexdigest()[:2]
+        return (self.root_dir / shard / study / str(dataset.SeriesInstanceUID)
+                / f"{dataset.SOPInstanceUID}_{task_id}.dcm")
+
+    @staticmethod
+    def _sidecar_path(path: Path) -> Path:
+        return path.with_suffix(".json")
+
+    def _entry_index(self) -> dict:
+        """ Path to entry, read from the sidecars on first use. Caller holds the lock. """
+        if self._index is None:
+            self._index = {}
+            for sidecar_path in self.root_dir.glob(self.SIDECAR_GLOB):
+                entry = self.load_entry(sidecar_path)
+                if entry is not None:
+                    self._add(entry)
+            logger.info("Loaded %d entries from %s", len(self._index), self.root_dir)
+        return self._index
+
+    def _add(self, entry: StoreEntry):
+        self._index[entry.path] = entry.copy()
+        self._by_task.setdefault(entry.task_id, set()).add(entry.path)
+
+    def _remove(self, entry: StoreEntry) -> bool:
+        """ Drop an entry from the index. Returns whether it was there. """
+        indexed = self._entry_index().pop(entry.path, None)
+        if indexed is None:
+            return False
+        paths = self._by_task.get(indexed.task_id, set())
+        paths.discard(entry.path)
+        if not paths:
+            self._by_task.pop(indexed.task_id, None)
+        return True
+
+    @staticmethod
+    def _write_dataset(path: Path, dataset: Dataset) -> int:
+        """ Write the Part 10 file of a dataset. Returns its size in bytes. """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(path, lambda f: dataset.save_as(f, write_like_original=False))
+        return path.stat().st_size
+
+    def _store(self, path: Path, dataset: Dataset, task_id: str, destinations: dict) -> StoreEntry:
+        """ Write a dataset and its new entry, replacing any earlier entry at that path. """
+        size = self._write_dataset(path, dataset)
+        return self._put(StoreEntry(task_id=task_id, destinations=destinations, path=path,
+                                    size=size, created=time.time()))
+
+    def _put(self, entry: StoreEntry) -> StoreEntry:
+        """ Index and save a new entry, replacing any earlier entry at its path. """
+        with self._lock:
+            self._entry_index()
+            self._remove(entry)
+            self._add(entry)
+            self.save_entry(entry)
+        return entry
+
+    def write(self, dataset: Dataset, task_id: str, destinations: list) -> StoreEntry:
+        """ Store a dataset to be sent to the named destinations.
+
+        The sidecar is written last: after a restart, only files whose sidecar
+        exists are picked up.
+        """
+        path = self.path_for(dataset, task_id)
+        entry = self._store(path, dataset, task_id, {name: DESTINATION_PENDING for name in destinations})
+        logger.debug("Stored %s for Task %s", path, task_id)
+        return entry
+
+    def save_entry(self, entry: StoreEntry) -> bool:
+        """ Record the changes to an entry, unless it was deleted in the meantime.
+
+        Returns:
+            whether the entry was still stored.
+        """
+        with self._lock:
+            if entry.path not in self._entry_index():
+                return False
+            entry.used = time.time()
+            self._index[entry.path] = entry.copy()
+            data = asdict(entry)
+            data.pop("path")
+            _write_atomic(self._sidecar_path(entry.path), lambda f: f.write(json.dumps(data).encode()))
+            return True
+
+    def load_entry(self, sidecar_path: Path) -> Optional[StoreEntry]:
+        """ Read a sidecar, or None if it or its file is gone. A sidecar without its file is removed. """
+        path = sidecar_path.with_suffix(".dcm")
+        try:
+            with open(sidecar_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            stat = path.stat()
+            used = sidecar_path.stat().st_mtime
+        except FileNotFoundError:
+            if sidecar_path.exists():
+                sidecar_path.unlink(missing_ok=True)
+            return None
+        entry = StoreEntry(path=path, **data)
+        # Sidecars written before these were recorded
+        entry.size = entry.size or stat.st_size
+        entry.created = entry.created or stat.st_mtime
+        entry.used = entry.used or used
+        return entry
+
+    def read_dataset(self, entry: StoreEntry) -> Dataset:
+        return dcmread(entry.path)
+
+    def entries(self) -> list:
+        """ All stored entries """
+        with self._lock:
+            return [entry.copy() for entry in self._entry_index().values()]
+
+    def due(self, now: Optional[float] = None) -> list:
+        """ Entries with destinations still to be sent to, whose retry time has come. """
+        now = time.time() if now is None else now
+        with self._lock:
+            return [e.copy() for e in self._entry_index().values()
+                    if not e.failed and e.pending() and e.next_attempt <= now]
+
+    def find(self, task_id: str) -> list:
+        """ Entries stored for a Task """
+        with self._lock:
+            index = self._entry_index()
+            return [index[path].copy() for path in self._by_task.get(task_id, ())]
+
+    def delete(self, entry: StoreEntry):
+        """ Remove the file and sidecar of an entry, and any directories left empty. """
+        with self._lock:
+            self._remove(entry)
+            self._sidecar_path(entry.path).unlink(missing_ok=True)
+            entry.path.unlink(missing_ok=True)
+            directory = entry.path.parent
+            for _ in range(self.SHARD_DEPTH):
+                try:
+                    directory.rmdir()
+                except OSError:
+                    # Not empty
+                    break
+                directory = directory.parent
+
+    def requeue(self, task_id: str) -> int:
+        """ Send the stored images of a failed Task again. Returns the number of entries requeued. """
+        count = 0
+        for entry in self.find(task_id):
+            entry.failed = False
+            entry.attempts = 0
+            entry.next_attempt = 0
+            self.save_entry(entry)
+            count += 1
+        return count
+
+
+class DicomUploader:
+    """ Background thread draining a DicomStore to the PACS destinations.
+
+    Args:
+        store: the DicomStore to drain.
+        send: send(dataset, destination names) -> dict of name to status.
+        report: report(task_store, entry, final) called after every attempt,
+            to record the status of the Task.
+        max_attempts: attempts before an entry is marked failed.
+        retry_delay: seconds before the first retry, doubled after each attempt.
+        threads: number of entries uploaded at once.
+        name: prefix of its metrics and threads.
+    """
+
+    def __init__(self, store: DicomStore, send: Callable, report: Callable,
+                 max_attempts: int = 10, retry_delay: float = 30, threads: int = 4, name: str = "dicom_store"):
+        self.store = store
+        self.name = name
+        self.send = send
+        self.report = report
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.threads = threads
+        self.task_store = None
+        self._wake = threading.Event()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+
+    def start(self, task_store):
+        """ Start the uploader thread, if not running yet. """
+        with self._lock:
+            self.task_store = task_store
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix=f"f2d4o-{self.name}")
+            self._thread = threading.Thread(target=self._run, name=f"f2d4o-{self.name}-uploader", daemon=True)
+            self._thread.start()
+        logger.info("Started uploader for %s", self.store.root_dir)
+
+    def wake(self):
+        """ Look for new entries now instead of at the next poll. """
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(POLL_SECONDS)
+            self._wake.clear()
+            try:
+                self.drain()
+            except Exception as e:
+                logger.exception(e)
+
+    def drain(self, wait: bool = False):
+        """ Start uploading every due entry not already being uploaded. """
+        futures = []
+        for entry in self.store.due():
+            with self._lock:
+                if entry.path in self._in_flight:
+                    continue
+                self._in_flight.add(entry.path)
+            futures.append(self._executor.submit(run_in_task_context, entry.task_id, self._upload, entry))
+        metrics.set_gauge(f"{self.name}_due", len(futures))
+        if wait:
+            for future in futures:
+                future.result()
+
+    def _retry_delay(self, attempts: int) -> float:
+        return min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+    def _upload(self, entry: StoreEntry):
+        try:
+            dataset = self.store.read_dataset(entry)
+            statuses = self.send(dataset, entry.pending())
+            entry.destinations.update(statuses)
+            entry.attempts += 1
+            if not entry.pending():
+                self.report(self.task_store, entry, True)
+                self.store.delete(entry)
+                metrics.inc(f"{self.name}_uploaded")
+                return
+            if entry.attempts >= self.max_attempts:
+                logger.error("Giving up on %s after %d attempts", entry.path, entry.attempts)
+                entry.failed = True
+                metrics.inc(f"{self.name}_failed")
+            else:
+                entry.next_attempt = time.time() + self._retry_delay(entry.attempts)
+                logger.warning("Retrying %s to %s in %.0f s", entry.path.name, ", ".join(entry.pending()),
+                               entry.next_attempt - time.time())
+                metrics.inc(f"{self.name}_retries")
+            self.store.save_entry(entry)
+            self.report(self.task_store, entry, entry.failed)
+        except Exception as e:
+            logger.exception(e)
+            logger.error("Error uploading %s: %s", entry.path, e)
+        finally:
+            with self._lock:
+                self._in_flight.discard(entry.path)
+
+
+dicom_store = DicomStore(args_cache.dicom_store_dir) if args_cache.dicom_store_dir else None
@@ -1,31 +1,50 @@
-import logging
+import atexit
+import sys
 from fhir2dicom4ortho import logger
 from fhir2dicom4ortho.args_cache import ArgsCache
 from fhir2dicom4ortho import verbosity_mapping
+from fhir2dicom4ortho.log_pipeline import start_logging
 
 def setup_logging(level):
-    """Configure root logger for the application"""
-    root_logger = logging.getLogger()
-    root_logger.setLevel(level)
-    
-    # Configure format for all handlers
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s.%(funcName)s: %(message)s')
-    
-    # Console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    root_logger.addHandler(console_handler)
+    """Configure root logger for the application
+
+    Records are queued and written by a listener thread, as text unless
+    F2D4O_LOG_FORMAT is json, so logging never blocks the threads doing work.
+    """
+    args = ArgsCache.get_arguments()
+    listener = start_logging(level, log_format=args.log_format, debug_sample=args.log_debug_sample,
+                             queue_size=args.log_queue_size)
+    # Write out what is still queued on exit
+    atexit.register(listener.stop)
 
 def fhir_api():
     args = ArgsCache.get_arguments()
     setup_logging(verbosity_mapping[args.verbosity])
-    logger.debug(("Logging Level is {}".format(
-        logger.getEffectiveLevel())))
+    logger.debug("Logging Level is %s", logger.getEffectiveLevel())
 
     import uvicorn
-    logger.info(f"Lighting a FHIR API on {args.fhir_listen}:{args.fhir_port}")
+    logger.info("Lighting a FHIR API on %s:%s", args.fhir_listen, args.fhir_port)
     uvicorn.run("fhir2dicom4ortho.fhir_api:fhir_api_app", host=args.fhir_listen, port=args.fhir_port)
 
 
+def bulk_import():
+    """ Import Bundles from a directory or NDJSON file, without the FHIR API. """
+    args = ArgsCache.get_arguments()
+    setup_logging(verbosity_mapping[args.verbosity])
+
+    from fhir2dicom4ortho.bulk_import import parse_arguments, run_import
+    from fhir2dicom4ortho.task_store import TaskStore
+    from fhir2dicom4ortho.tasks import TASK_COMPLETED
+    import_args = parse_arguments()
+    if args.tasks_db_url is None:
+        # An in-memory database would lose every Task when the import exits
+        logger.error("F2D4O_TASKS_DB_FILENAME must be set to import Bundles")
+        sys.exit(2)
+    logger.info("Importing Bundles from %s", import_args.source)
+    counts = run_import(import_args.source, TaskStore(db_url=args.tasks_db_url),
+                        workers=import_args.workers, checkpoint=import_args.checkpoint)
+    sys.exit(0 if set(counts) <= {TASK_COMPLETED} else 1)
+
+
 if __name__ == "__main__":
     fhir_api()
\ No newline at end of file
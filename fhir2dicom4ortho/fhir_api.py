@@ -1,14 +1,30 @@
 """ FHIR API for handling DICOM image generation tasks """
+import json
+from itertools import chain
 from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, Optional
 
 from fastapi import FastAPI, Request, Response, Depends
-from fhir.resources.bundle import Bundle, BundleEntry
+from fastapi.responses import StreamingResponse
+from fhir.resources.binary import Binary
 from fhir.resources.task import Task
 from fhir.resources.operationoutcome import OperationOutcome
 
-from fhir2dicom4ortho.scheduler import scheduler
-from fhir2dicom4ortho.tasks import build_and_send_dicom_image, TASK_RECEIVED
-from fhir2dicom4ortho.task_store import TaskStore
+from fhir2dicom4ortho.scheduler import scheduler, job_queue
+from fhir2dicom4ortho.tasks import (
+    build_and_send_dicom_image, estimate_bundle_bytes, cancel_task, resend_task, dicom_uploader, resend_uploader,
+    TASK_DRAFT, TASK_RECEIVED, TASK_CANCELLED, TASK_FAILED, TASK_INPROGRESS, TASK_FINAL_STATUSES)
+from fhir2dicom4ortho.dicom_store import dicom_store
+from fhir2dicom4ortho.resend_cache import resend_cache
+from fhir2dicom4ortho.task_store import TaskStore, AsyncTaskStore
+from fhir2dicom4ortho.binary_store import binary_store, PURGE_INTERVAL
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho.log_pipeline import task_context
+from fhir2dicom4ortho.tracing import tracer, trace_id_extension, TRACE_ID_EXTENSION_URL
+from fhir2dicom4ortho.ortho_bundle import parse_bundle, split_batch, BundleValidationError
+from fhir2dicom4ortho.compression import (
+    CompressionMiddleware, BodyTooLargeError, UnsupportedEncodingError, decoded_stream, read_encoded_body)
 from fhir2dicom4ortho import logger
 from fhir2dicom4ortho.args_cache import ArgsCache
 
@@ -22,12 +38,22 @@ async def lifespan(app: FastAPI):
     args = ArgsCache.get_arguments()
     global _TASK_STORE
     _TASK_STORE = TaskStore(db_url=args.tasks_db_url)
+    if dicom_store is not None:
+        # Upload images stored before a restart
+        dicom_uploader.start(_TASK_STORE)
+    if resend_cache is not None:
+        # Retry the sends cached before a restart
+        resend_uploader.start(_TASK_STORE)
+    # Uploaded Binaries that no Bundle referenced expire
+    scheduler.add_job(binary_store.purge, "interval", seconds=PURGE_INTERVAL, id="purge_binaries",
+                      replace_existing=True, next_run_time=datetime.now())
     yield
     # Shutdown
     if _TASK_STORE is not None:
         _TASK_STORE.cleanup()
 
 fhir_api_app = FastAPI(lifespan=lifespan)
+fhir_api_app.add_middleware(CompressionMiddleware, minimum_size=ArgsCache.get_arguments().compress_min_size)
 
 
 def get_task_store() -> TaskStore:
@@ -38,6 +64,11 @@ def get_task_store() -> TaskStore:
     return _TASK_STORE
 
 
+def get_async_task_store(task_store: TaskStore = Depends(get_task_store)) -> AsyncTaskStore:
+    """FastAPI dependency that provides async access to the TaskStore, for async handlers"""
+    return AsyncTaskStore(task_store)
+
+
 def create_operation_outcome(severity: str, code: str, diagnostics: str) -> str:
     """ Create an OperationOutcome resource """
     outcome = OperationOutcome(
@@ -50,61 +81,377 @@ def create_operation_outcome(severity: str, code: str, diagnostics: str) -> str:
     return outcome.model_dump_json()
 
 
+def transport_error_response(e: Exception) -> Response:
+    """ OperationOutcome response for request bodies that could not be decoded """
+    if isinstance(e, BodyTooLargeError):
+        return Response(content=create_operation_outcome("error", "too-long", str(e)), media_type="application/json", status_code=413)
+    return Response(content=create_operation_outcome("error", "not-supported", str(e)), media_type="application/json", status_code=415)
+
+
+def _set_trace_id(task: Task):
+    """ Record the trace id of the request in Task.extension, replacing any earlier one. """
+    trace_id = tracer.trace_id()
+    if trace_id is None:
+        return
+    extensions = [e for e in task.extension or [] if e.url != TRACE_ID_EXTENSION_URL]
+    task.extension = extensions + [trace_id_extension(trace_id)]
+
+
+def _accept_bundle(decoded: Callable[[], bytes], task_store: TaskStore) -> Task:
+    """ Decompress and parse a Bundle, record its Task and queue its job.
+
+    Decompressing and parsing are CPU bound, and the commit may wait on the
+    disk, so this runs on a worker thread, in one hop per request.
+
+    Args:
+        decoded: returns the request body, from read_encoded_body().
+    """
+    body = decoded()
+    with tracer.span("bundle.parse"):
+        # Structural check first, then validate only the small resources
+        ortho_bundle = parse_bundle(json.loads(body))
+    task: Task = ortho_bundle.task
+
+    # Update Task status resource to represent the job
+    task.status = TASK_RECEIVED
+    task.description = "Processing Bundle"
+    _set_trace_id(task)
+    # Stored as received in one commit: a job that starts right away is not overwritten
+    task = task_store.add_tasks([task])[0]
+    with task_context(task.id):
+        # Keep uploaded Binaries until the job is done with them
+        binary_store.hold(ortho_bundle.spooled_ids())
+        # Schedule the job with APScheduler
+        # Dispatched once its estimated memory fits in the budget
+        job_bytes = estimate_bundle_bytes(ortho_bundle)
+        with tracer.span("scheduler.add_job"):
+            job = job_queue.submit(build_and_send_dicom_image, args=[ortho_bundle, task.id, task_store],
+                                   kwargs={"reserved_bytes": job_bytes}, priority=task.priority,
+                                   memory_bytes=job_bytes)
+        logger.debug("Job scheduled: %s", job.id)
+    # The response reports the Task as accepted, in draft, as it always has
+    return task.model_copy(update={"status": TASK_DRAFT})
+
+
+def _batch_entry(status: str, resource_json: Optional[str] = None, location: Optional[str] = None,
+                 outcome_json: Optional[str] = None) -> str:
+    """ JSON of one entry of a batch-response Bundle """
+    response = f'"status":{json.dumps(status)}'
+    if location is not None:
+        response += f',"location":{json.dumps(location)}'
+    if outcome_json is not None:
+        response += f',"outcome":{outcome_json}'
+    resource = f'"resource":{resource_json},' if resource_json is not None else ""
+    return f'{{{resource}"response":{{{response}}}}}'
+
+
+def _parse_batch(bundle_data: dict) -> list:
+    """ Parse each Task set of a batch or transaction Bundle.
+
+    In a batch, a set that does not conform is returned as its
+    BundleValidationError, and the others are accepted; in a transaction,
+    one such set rejects the whole Bundle.
+    """
+    with tracer.span("bundle.parse"):
+        groups = split_batch(bundle_data)
+        parsed = []
+        for index, group in enumerate(groups):
+            try:
+                parsed.append(parse_bundle(group))
+            except BundleValidationError as e:
+                if bundle_data["type"] == "transaction":
+                    raise BundleValidationError(f"Task set {index + 1}: {e}") from e
+                parsed.append(e)
+    metrics.inc("batch_task_sets", len(groups))
+    return parsed
+
+
+def _accept_batch(decoded: Callable[[], bytes], task_store: TaskStore) -> bytes:
+    """ Decompress and parse a batch, record the Tasks of its sets and queue their jobs.
+
+    The Tasks of all valid sets are stored in one transaction. Runs on a
+    worker thread, like _accept_bundle.
+
+    Returns:
+        the batch-response or transaction-response Bundle, one entry per Task.
+    """
+    bundle_data = json.loads(decoded())
+    parsed = _parse_batch(bundle_data)
+    bundle_type = bundle_data["type"]
+    ortho_bundles = [p for p in parsed if not isinstance(p, BundleValidationError)]
+
+    for ortho_bundle in ortho_bundles:
+        ortho_bundle.task.status = TASK_RECEIVED
+        ortho_bundle.task.description = "Processing Bundle"
+        _set_trace_id(ortho_bundle.task)
+    # Stored as received at once: a job that starts right away is not overwritten
+    task_store.add_tasks([ortho_bundle.task for ortho_bundle in ortho_bundles])
+
+    entries = []
+    for item in parsed:
+        if isinstance(item, BundleValidationError):
+            entries.append(_batch_entry(
+                "400 Bad Request", outcome_json=create_operation_outcome("error", "structure", str(item))))
+            continue
+        task = item.task
+        with task_context(task.id):
+            binary_store.hold(item.spooled_ids())
+            try:
+                job_bytes = estimate_bundle_bytes(item)
+                with tracer.span("scheduler.add_job"):
+                    job = job_queue.submit(build_and_send_dicom_image, args=[item, task.id, task_store],
+                                           kwargs={"reserved_bytes": job_bytes}, priority=task.priority,
+                                           memory_bytes=job_bytes)
+                logger.debug("Job scheduled: %s", job.id)
+            except Exception as e:
+                logger.exception(e)
+                binary_store.release(item.spooled_ids())
+                task = task_store.modify_task_status(task.id, TASK_FAILED)
+                entries.append(_batch_entry(
+                    "500 Internal Server Error", resource_json=task.model_dump_json(),
+                    outcome_json=create_operation_outcome("error", "exception", str(e))))
+                continue
+        entries.append(_batch_entry("201 Created", resource_json=task.model_dump_json(), location=f"Task/{task.id}"))
+
+    response_type = f"{bundle_type}-response"
+    return f'{{"resourceType":"Bundle","type":"{response_type}","entry":[{",".join(entries)}]}}'.encode()
+
+
+@fhir_api_app.post("/fhir")
+async def handle_batch(request: Request, task_store: AsyncTaskStore = Depends(get_async_task_store)):
+    """ Handle a batch or transaction Bundle holding many Task sets
+
+    Each Task, with the ImagingStudy and Binaries its Task.input references,
+    is one ortho-imaging-bundle and becomes one job. All Tasks are stored in
+    one database transaction, and a batch-response Bundle is returned with
+    one entry per Task, in the order of the Tasks.
+    """
+    with tracer.span("handle_batch"):
+        try:
+            args = ArgsCache.get_arguments()
+            decoded = await read_encoded_body(request.headers, request.stream(), args.max_body_bytes)
+            response_json = await task_store.run(_accept_batch, decoded, task_store.task_store)
+            return Response(content=response_json, media_type="application/json", status_code=200)
+
+        except (BodyTooLargeError, UnsupportedEncodingError) as e:
+            logger.warning("Rejected Bundle: %s", e)
+            return transport_error_response(e)
+        except BundleValidationError as e:
+            logger.warning("Rejected Bundle: %s", e)
+            return Response(content=create_operation_outcome("error", "structure", str(e)), media_type="application/json", status_code=400)
+        except json.JSONDecodeError as e:
+            logger.warning("Rejected Bundle: %s", e)
+            return Response(content=create_operation_outcome("error", "invalid", f"Invalid JSON: {e}"), media_type="application/json", status_code=400)
+        except Exception as e:
+            logger.exception(e)
+            return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
+
+
 @fhir_api_app.post("/fhir/Bundle")
-async def handle_bundle(request: Request, task_store: TaskStore = Depends(get_task_store)):
-    """ Handle a FHIR Bundle containing a Task resource """
+async def handle_bundle(request: Request, task_store: AsyncTaskStore = Depends(get_async_task_store)):
+    """ Handle a FHIR Bundle containing a Task resource
+
+    Only reading the body runs on the event loop. Decompressing, parsing,
+    recording the Task and scheduling its job run on a worker thread, so
+    neither a large Bundle nor a slow commit holds up other requests. The
+    request starts the trace of the Task, and its trace id is returned in
+    Task.extension.
+    """
+    with tracer.span("handle_bundle") as span:
+        try:
+            args = ArgsCache.get_arguments()
+            decoded = await read_encoded_body(request.headers, request.stream(), args.max_body_bytes)
+            task = await task_store.run(_accept_bundle, decoded, task_store.task_store)
+            if span is not None:
+                span.set_attribute("task.id", task.id)
+            return Response(content=task.model_dump_json(), media_type="application/json", status_code=200)
+
+        except (BodyTooLargeError, UnsupportedEncodingError) as e:
+            logger.warning("Rejected Bundle: %s", e)
+            return transport_error_response(e)
+        except BundleValidationError as e:
+            logger.warning("Rejected Bundle: %s", e)
+            return Response(content=create_operation_outcome("error", "structure", str(e)), media_type="application/json", status_code=400)
+        except json.JSONDecodeError as e:
+            logger.warning("Rejected Bundle: %s", e)
+            return Response(content=create_operation_outcome("error", "invalid", f"Invalid JSON: {e}"), media_type="application/json", status_code=400)
+        except Exception as e:
+            logger.exception(e)
+            return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
+
+
+@fhir_api_app.post("/fhir/Binary")
+async def upload_binary(request: Request):
+    """ Upload raw image or MWL bytes, to be referenced as Binary/{id} from a Bundle
+
+    The request body is the raw content, and the Content-Type header is the
+    Binary contentType. The bytes are streamed to the spool without base64
+    encoding. The body may be sent compressed with Content-Encoding.
+    """
     try:
-        bundle_data = await request.json()
-        bundle = Bundle(**bundle_data)
-        for entry in bundle.entry:
-            if not entry.resource:
-                return Response(content=create_operation_outcome("error", "invalid", "Entry must contain a resource"), media_type="application/json", status_code=400)
-            resource = entry.resource
-            if isinstance(resource, Task):
-                task: Task = resource
-                break
-
-        # Update Task status resource to represent the job
-        task.status = TASK_RECEIVED
-        task.description = "Processing Bundle"
-        task = task_store.add_task(task)
-        # Schedule the job with APScheduler
-        job = scheduler.add_job(build_and_send_dicom_image, args=[
-                                bundle, task.id, task_store])
-        logger.info(f"Job scheduled: {job.id}")
+        args = ArgsCache.get_arguments()
+        content_type = request.headers.get("content-type")
+        if not content_type:
+            return Response(content=create_operation_outcome("error", "required", "Content-Type header is required"), media_type="application/json", status_code=400)
+        content_type = content_type.split(";")[0].strip()
+        binary_id = await binary_store.write_stream(
+            decoded_stream(request.headers, request.stream(), args.max_body_bytes), content_type)
+        binary = Binary(id=binary_id, contentType=content_type)
+        return Response(content=binary.model_dump_json(), media_type="application/json", status_code=201, headers={"Location": f"Binary/{binary_id}"})
+    except (BodyTooLargeError, UnsupportedEncodingError) as e:
+        logger.warning("Rejected Binary: %s", e)
+        return transport_error_response(e)
+    except Exception as e:
+        logger.exception(e)
+        return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
 
-        task_store.modify_task_status(task.id, TASK_RECEIVED)
-        return Response(content=task.model_dump_json(), media_type="application/json", status_code=200)
 
+@fhir_api_app.get("/fhir/Task/$export")
+def export_tasks(_since: Optional[str] = None, task_store: TaskStore = Depends(get_task_store)):
+    """ Stream all Tasks as NDJSON, one Task per line, in the style of FHIR $export
+
+    Tasks are read from the database in chunks of F2D4O_EXPORT_CHUNK_SIZE and
+    written as they are stored, so memory stays flat whatever the number of
+    Tasks. With _since, only Tasks changed after that instant are exported.
+    Declared before /fhir/Task/{task_id} so $export is not taken for an id.
+    """
+    since = None
+    if _since is not None:
+        try:
+            # fromisoformat only accepts Z from Python 3.11
+            since = datetime.fromisoformat(_since.replace("Z", "+00:00"))
+        except ValueError:
+            return Response(content=create_operation_outcome("error", "invalid", f"Invalid _since: {_since}"), media_type="application/json", status_code=400)
+
+    try:
+        chunks = prefetched(task_store.iter_tasks_json(since=since, chunk_size=ArgsCache.get_arguments().export_chunk_size))
     except Exception as e:
         logger.exception(e)
         return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
 
+    def ndjson():
+        for chunk in chunks:
+            metrics.inc("task_export_rows", len(chunk))
+            yield "".join(f"{task_json}\n" for task_json in chunk).encode()
+
+    return StreamingResponse(ndjson(), media_type="application/fhir+ndjson")
+
 
 @fhir_api_app.get("/fhir/Task/{task_id}")
-async def get_task_status(task_id: str, task_store: TaskStore = Depends(get_task_store)):
-    """ Get the status of a Task by ID """
+async def get_task_status(task_id: str, task_store: AsyncTaskStore = Depends(get_async_task_store)):
+    """ Get the status of a Task by ID
+
+    The stored Task JSON is returned as it is, without validating it again.
+    """
     try:
-        task = task_store.get_fhir_task_by_id(task_id)
+        task_json = await task_store.get_task_json(task_id)
+        if task_json is None:
+            return Response(content=create_operation_outcome("error", "not-found", f"Task with ID {task_id} not found"), media_type="application/json", status_code=404)
+        return Response(content=task_json, media_type="application/json", status_code=200)
+    except Exception as e:
+        logger.exception(e)
+        return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
+
+
+@fhir_api_app.put("/fhir/Task/{task_id}")
+async def update_task(task_id: str, request: Request, task_store: AsyncTaskStore = Depends(get_async_task_store)):
+    """ Update a Task. Only cancellation is supported: set status to cancelled to stop its job.
+
+    A running job stops waiting at once, and a queued job never starts.
+    """
+    try:
+        try:
+            update = Task.model_validate_json(await request.body())
+        except ValueError as e:
+            return Response(content=create_operation_outcome("error", "invalid", str(e)), media_type="application/json", status_code=400)
+        if update.id is not None and update.id != task_id:
+            return Response(content=create_operation_outcome("error", "invalid", f"Task.id {update.id} does not match {task_id}"), media_type="application/json", status_code=400)
+        if update.status != TASK_CANCELLED:
+            return Response(content=create_operation_outcome("error", "not-supported", "Only setting Task.status to cancelled is supported"), media_type="application/json", status_code=400)
+
+        task = await task_store.get_fhir_task_by_id(task_id)
         if not task:
             return Response(content=create_operation_outcome("error", "not-found", f"Task with ID {task_id} not found"), media_type="application/json", status_code=404)
+        if task.status == TASK_CANCELLED:
+            return Response(content=task.model_dump_json(), media_type="application/json", status_code=200)
+        if task.status in TASK_FINAL_STATUSES:
+            return Response(content=create_operation_outcome("error", "conflict", f"Task {task_id} is already {task.status}"), media_type="application/json", status_code=409)
+
+        task = await task_store.run(cancel_task, task_id, task_store.task_store)
         return Response(content=task.model_dump_json(), media_type="application/json", status_code=200)
     except Exception as e:
         logger.exception(e)
         return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
 
 
+@fhir_api_app.post("/fhir/Task/{task_id}/$resend")
+async def resend(task_id: str, task_store: AsyncTaskStore = Depends(get_async_task_store)):
+    """ Send the image of a failed Task again, without rebuilding it.
+
+    The image must still be in the local DICOM store or the resend cache;
+    otherwise the Bundle has to be submitted again.
+    """
+    try:
+        task = await task_store.get_fhir_task_by_id(task_id)
+        if not task:
+            return Response(content=create_operation_outcome("error", "not-found", f"Task with ID {task_id} not found"), media_type="application/json", status_code=404)
+        if task.status not in (TASK_FAILED, TASK_INPROGRESS):
+            return Response(content=create_operation_outcome("error", "conflict", f"Task {task_id} is {task.status}, only failed or in-progress Tasks can be resent"), media_type="application/json", status_code=409)
+
+        task = await task_store.run(resend_task, task_id, task_store.task_store)
+        if task is None:
+            return Response(content=create_operation_outcome("error", "not-found", f"No built image of Task {task_id} is kept, submit its Bundle again"), media_type="application/json", status_code=404)
+        return Response(content=task.model_dump_json(), media_type="application/json", status_code=200)
+    except Exception as e:
+        logger.exception(e)
+        return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
+
+
+def prefetched(chunks: Iterator[list]) -> Iterator[list]:
+    """ Read the first chunk at once, so a failing query raises before the response starts.
+
+    Once a StreamingResponse has sent its status, an error can only cut the
+    body short.
+    """
+    first = next(chunks, None)
+    return chain([first] if first is not None else [], chunks)
+
+
+def searchset_json(chunks: Iterable[list]) -> Iterator[bytes]:
+    """ Write a searchset Bundle around the stored JSON of Tasks, chunk by chunk.
+
+    The Task JSON is spliced into the Bundle as it is: no Task is validated or
+    serialized again. total is only known at the end, so it follows entry;
+    the order of JSON members carries no meaning.
+    """
+    yield b'{"resourceType":"Bundle","type":"searchset","entry":['
+    total = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        separator = "," if total else ""
+        yield (separator + ",".join(f'{{"resource":{task_json}}}' for task_json in chunk)).encode()
+        total += len(chunk)
+    yield f'],"total":{total}}}'.encode()
+
+
 @fhir_api_app.get("/fhir/Task")
-async def list_all_tasks(task_store: TaskStore = Depends(get_task_store)):
-    """ List all Tasks """
+def list_all_tasks(task_store: TaskStore = Depends(get_task_store)):
+    """ List all Tasks
+
+    The searchset Bundle is streamed, F2D4O_EXPORT_CHUNK_SIZE Tasks at a time,
+    from the stored Task JSON. The first chunk is read before the response
+    starts, so a database error still returns a 500 OperationOutcome.
+    """
     try:
-        tasks = task_store.get_all_tasks()
-        bundle = Bundle(
-            type="searchset",
-            total=len(tasks),
-            entry=[BundleEntry(resource=task) for task in tasks]
-        )
-        return Response(content=bundle.model_dump_json(), media_type="application/json", status_code=200)
+        chunks = prefetched(task_store.iter_all_tasks_json(chunk_size=ArgsCache.get_arguments().export_chunk_size))
     except Exception as e:
         logger.exception(e)
         return Response(content=create_operation_outcome("error", "exception", str(e)), media_type="application/json", status_code=500)
+    return StreamingResponse(searchset_json(chunks), media_type="application/json")
+
+
+@fhir_api_app.get("/metrics")
+async def get_metrics():
+    """ Internal metrics of the service, as JSON """
+    return Response(content=json.dumps(metrics.snapshot()), media_type="application/json", status_code=200)
@@ -0,0 +1,236 @@
+""" Header-only parsing of JPEG, JPEG 2000 and PNG images.
+
+Reads dimensions and color layout from the image headers without decoding any
+pixels, so they can be used to encapsulate compressed images as they are, or to
+estimate the decoded size of an image.
+"""
+import struct
+from dataclasses import dataclass
+from typing import Optional
+
+JPEG_SOI = b"\xff\xd8"
+J2K_SOC_SIZ = b"\xff\x4f\xff\x51"
+J2K_COD = 0x52
+J2K_SOT = 0x90
+JP2_SIGNATURE = b"\x00\x00\x00\x0cjP  \r\n\x87\n"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG Start Of Frame markers. C4 (DHT), C8 (JPG) and CC (DAC) are not frames.
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_SOF_BASELINE = 0xC0
+JPEG_SOS = 0xDA
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9}
+
+# Samples per pixel after decoding, by PNG color type
+PNG_COLOR_TYPE_SAMPLES = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+@dataclass
+class ImageHeader:
+    """ What the image header says about the pixels. """
+    format: str
+    rows: int
+    columns: int
+    samples_per_pixel: int
+    bits_stored: int
+    # DICOM Photometric Interpretation of the compressed bitstream, if known.
+    photometric_interpretation: Optional[str] = None
+    # JPEG: SOF0 baseline. JPEG 2000: True. PNG: False.
+    baseline: bool = False
+    # JPEG 2000: True if the 5-3 reversible wavelet is used.
+    reversible: bool = False
+    # JPEG: the file is a Multi-Picture Object with more than one image.
+    multi_picture: bool = False
+
+    @property
+    def decoded_size(self) -> int:
+        """ Size in bytes of the decoded pixels. """
+        bytes_per_sample = (self.bits_stored + 7) // 8
+        return self.rows * self.columns * self.samples_per_pixel * bytes_per_sample
+
+
+def _jpeg_photometric(components: list, jfif: bool, adobe_transform: Optional[int]) -> Optional[str]:
+    """ Photometric Interpretation of a JPEG bitstream, as defined in DICOM PS3.5 8.2.1 """
+    if len(components) == 1:
+        return "MONOCHROME2"
+    if len(components) != 3:
+        return None
+    if adobe_transform == 0 or (not jfif and adobe_transform is None
+                                and bytes(c[0] for c in components) == b"RGB"):
+        return "RGB"
+    sampling = {c[1] for c in components}
+    return "YBR_FULL" if len(sampling) == 1 else "YBR_FULL_422"
+
+
+def read_jpeg_header(data: bytes) -> Optional[ImageHeader]:
+    """ Parse the JPEG markers up to the first Start Of Scan. """
+    if not data.startswith(JPEG_SOI):
+        return None
+    jfif = False
+    adobe_transform = None
+    multi_picture = False
+    sof = None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        (length,) = struct.unpack(">H", data[pos + 2:pos + 4])
+        payload = data[pos + 4:pos + 2 + length]
+        if marker == 0xE0 and payload.startswith(b"JFIF\x00"):
+            jfif = True
+        elif marker == 0xE2 and payload.startswith(b"MPF\x00"):
+            multi_picture = True
+        elif marker == 0xEE and payload.startswith(b"Adobe") and len(payload) >= 12:
+            adobe_transform = payload[11]
+        elif marker in JPEG_SOF_MARKERS:
+            if len(payload) < 6:
+                return None
+            precision, rows, columns, count = struct.unpack(">BHHB", payload[:6])
+            components = [(payload[6 + 3 * i], payload[7 + 3 * i]) for i in range(count)
+                          if 8 + 3 * i < len(payload)]
+            sof = (marker, precision, rows, columns, components)
+        elif marker == JPEG_SOS:
+            break
+        pos += 2 + length
+
+    if sof is None:
+        return None
+    marker, precision, rows, columns, components = sof
+    return ImageHeader(
+        format="JPEG",
+        rows=rows,
+        columns=columns,
+        samples_per_pixel=len(components),
+        bits_stored=precision,
+        photometric_interpretation=_jpeg_photometric(components, jfif, adobe_transform),
+        baseline=marker == JPEG_SOF_BASELINE and precision == 8,
+        multi_picture=multi_picture,
+    )
+
+
+def _iter_jp2_boxes(data: bytes, start: int = 0, end: Optional[int] = None):
+    """ Yield (type, payload start, payload end) of the JP2 boxes in data[start:end] """
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        length, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if length == 1:
+            (length,) = struct.unpack(">Q", data[pos + 8:pos + 16])
+            header = 16
+        elif length == 0:
+            length = end - pos
+        if length < header:
+            return
+        yield box_type, pos + header, min(pos + length, end)
+        pos += length
+
+
+def jpeg2000_codestream(data: bytes) -> Optional[bytes]:
+    """ Return the raw JPEG 2000 codestream, stripping the JP2 file format boxes if present.
+
+    DICOM encapsulates the codestream only; the JP2 header must not be included.
+    """
+    if data.startswith(J2K_SOC_SIZ):
+        return data
+    if not data.startswith(JP2_SIGNATURE):
+        return None
+    for box_type, start, end in _iter_jp2_boxes(data):
+        if box_type == b"jp2c":
+            return data[start:end]
+    return None
+
+
+def read_jpeg2000_header(data: bytes) -> Optional[ImageHeader]:
+    """ Parse the SIZ and COD marker segments of a JPEG 2000 codestream or JP2 file. """
+    codestream = jpeg2000_codestream(data)
+    if codestream is None or not codestream.startswith(J2K_SOC_SIZ):
+        return None
+    # SIZ: Lsiz Rsiz Xsiz Ysiz XOsiz YOsiz XTsiz YTsiz XTOsiz YTOsiz Csiz
+    siz = codestream[4:]
+    if len(siz) < 38:
+        return None
+    length, _, xsiz, ysiz, xosiz, yosiz = struct.unpack(">HHIIII", siz[:20])
+    (csiz,) = struct.unpack(">H", siz[36:38])
+    if len(siz) < 38 + 3 * csiz:
+        return None
+    ssiz = [siz[38 + 3 * i] for i in range(csiz)]
+    signed = any(s & 0x80 for s in ssiz)
+    bits = {(s & 0x7F) + 1 for s in ssiz}
+
+    # Find COD in the main header: Lcod Scod progression layers MCT levels cbw cbh style transform
+    mct = 0
+    reversible = False
+    pos = 4 + length
+    while pos + 4 <= len(codestream) and codestream[pos] == 0xFF:
+        marker = codestream[pos + 1]
+        if marker == J2K_SOT:
+            break
+        if marker == J2K_COD and len(codestream) >= pos + 14:
+            mct = codestream[pos + 8]
+            reversible = codestream[pos + 13] == 1
+            break
+        (segment_length,) = struct.unpack(">H", codestream[pos + 2:pos + 4])
+        pos += 2 + segment_length
+
+    photometric = None
+    if not signed and len(bits) == 1:
+        if csiz == 1:
+            photometric = "MONOCHROME2"
+        elif csiz == 3:
+            if mct:
+                photometric = "YBR_RCT" if reversible else "YBR_ICT"
+            else:
+                photometric = "RGB"
+
+    return ImageHeader(
+        format="JPEG2000",
+        rows=ysiz - yosiz,
+        columns=xsiz - xosiz,
+        samples_per_pixel=csiz,
+        bits_stored=max(bits),
+        photometric_interpretation=photometric,
+        baseline=True,
+        reversible=reversible,
+    )
+
+
+def read_png_header(data: bytes) -> Optional[ImageHeader]:
+    """ Parse the IHDR chunk of a PNG image. """
+    if not data.startswith(PNG_SIGNATURE) or data[12:16] != b"IHDR" or len(data) < 26:
+        return None
+    columns, rows, bit_depth, color_type = struct.unpack(">IIBB", data[16:26])
+    return ImageHeader(
+        format="PNG",
+        rows=rows,
+        columns=columns,
+        samples_per_pixel=PNG_COLOR_TYPE_SAMPLES.get(color_type, 4),
+        # Low bit depths and palettes are decoded to 8 bits per sample
+        bits_stored=16 if bit_depth == 16 else 8,
+    )
+
+
+def read_image_header(data: bytes) -> Optional[ImageHeader]:
+    """ Read the header of a JPEG, JPEG 2000 or PNG image.
+
+    Returns None if the format is not recognized or the header is malformed.
+    """
+    if not data:
+        return None
+    try:
+        for reader in (read_jpeg_header, read_jpeg2000_header, read_png_header):
+            header = reader(data)
+            if header is not None:
+                return header
+    except (struct.error, IndexError):
+        return None
+    return None
@@ -0,0 +1,116 @@
+""" Deadlines and cancellation of jobs.
+
+Python threads cannot be killed, so a stage that may hang, like a PACS send,
+runs on its own executor while the job thread waits for it with a deadline.
+When the deadline passes or the Task is cancelled, the job thread gives up
+and frees its worker slot immediately; the abandoned stage finishes, or hangs,
+on its own executor without holding up other jobs.
+"""
+import threading
+import time
+from concurrent.futures import Future, wait
+from contextvars import copy_context
+from typing import Optional
+
+from fhir2dicom4ortho.metrics import metrics
+
+# How often a waiting job checks whether its Task was cancelled
+CANCEL_POLL_SECONDS = 0.2
+
+
+class JobStopped(Exception):
+    """ Base of the reasons a job gave up waiting on a stage.
+
+    Attributes:
+        stage: name of the stage, e.g. build or send.
+        futures: the abandoned futures, possibly still running.
+    """
+
+    def __init__(self, message: str, stage: str, futures: list):
+        super().__init__(message)
+        self.stage = stage
+        self.futures = futures
+
+
+class JobCancelled(JobStopped):
+    """ Raised in a job when its Task was cancelled. """
+
+    def __init__(self, stage: str, futures: list):
+        super().__init__(f"cancelled during {stage}", stage, futures)
+
+
+class StageTimeout(JobStopped):
+    """ Raised in a job when a stage did not finish before its deadline. """
+
+    def __init__(self, stage: str, futures: list):
+        super().__init__(f"{stage} did not finish in time", stage, futures)
+
+
+_cancel_events = {}
+_lock = threading.Lock()
+
+
+def cancel_event(task_id) -> threading.Event:
+    """ The event set when the Task is cancelled. Created on first use. """
+    with _lock:
+        return _cancel_events.setdefault(task_id, threading.Event())
+
+
+def request_cancel(task_id):
+    """ Ask the job of a Task to stop, whether it is running or still queued. """
+    cancel_event(task_id).set()
+
+
+def forget(task_id):
+    """ Drop the cancel event of a finished job. """
+    with _lock:
+        _cancel_events.pop(task_id, None)
+
+
+def wait_for(futures: list, stage: str, timeout: Optional[float] = None,
+             cancelled: Optional[threading.Event] = None) -> list:
+    """ Wait until all futures are done, the deadline passes, or the job is cancelled.
+
+    Args:
+        timeout: seconds to wait. None or 0 waits for as long as it takes.
+        cancelled: event set when the job is cancelled.
+
+    Returns:
+        the futures that are done. When the deadline passes, the others are
+        left running and the caller decides what to do with them.
+
+    Raises:
+        JobCancelled: if cancelled was set while waiting.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    pending = set(futures)
+    while pending:
+        if cancelled is not None and cancelled.is_set():
+            for future in pending:
+                future.cancel()
+            raise JobCancelled(stage, list(pending))
+        step = CANCEL_POLL_SECONDS if cancelled is not None else None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.inc("stage_timeouts", stage=stage)
+                break
+            step = remaining if step is None else min(step, remaining)
+        _, pending = wait(pending, timeout=step)
+    return [future for future in futures if future.done()]
+
+
+def run_stage(executor, stage: str, func, *args, timeout: Optional[float] = None,
+              cancelled: Optional[threading.Event] = None):
+    """ Run func(*args) on executor, and return its result within the deadline.
+
+    Raises:
+        StageTimeout: if func did not return in time. func keeps running.
+        JobCancelled: if cancelled was set while waiting.
+    """
+    # func runs in a copy of the caller's context, so it logs with the same Task id
+    future: Future = executor.submit(copy_context().run, func, *args)
+    if not wait_for([future], stage, timeout, cancelled):
+        future.cancel()
+        raise StageTimeout(stage, [future])
+    return future.result()
@@ -0,0 +1,215 @@
+""" Non-blocking, structured logging.
+
+Worker threads only put log records on a queue; a single listener thread
+formats them and writes them out. Messages use %-style arguments, which are
+only merged into the message by the listener, so a record that is filtered
+out or sampled away costs next to nothing.
+
+Every record carries the id of the Task being processed, taken from a
+context variable set with task_context(), so all lines of a job can be
+found together. High-volume DEBUG lines can be sampled with
+F2D4O_LOG_DEBUG_SAMPLE.
+
+The queue is bounded: when the listener cannot keep up, new records are
+dropped and counted in the log_records_dropped metric, instead of piling up
+in memory or blocking the threads that log.
+"""
+import json
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Optional
+
+from fhir2dicom4ortho.metrics import metrics
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(name)s.%(funcName)s: %(task_prefix)s%(message)s'
+
+task_id_var: ContextVar[Optional[str]] = ContextVar("task_id", default=None)
+
+
+@contextmanager
+def task_context(task_id: Optional[str]):
+    """ Tag the records logged in this block, in this thread or context, with a Task id. """
+    token = task_id_var.set(task_id)
+    try:
+        yield
+    finally:
+        task_id_var.reset(token)
+
+
+def run_in_task_context(task_id: Optional[str], func, *args, **kwargs):
+    """ Call func in task_context(task_id), e.g. as the target of an executor. """
+    with task_context(task_id):
+        return func(*args, **kwargs)
+
+
+class TaskContextFilter(logging.Filter):
+    """ Stamp records with the Task id of the context they are logged from.
+
+    Must run in the logging thread, so it sits on the QueueHandler and not on
+    the handlers of the listener.
+    """
+
+    def filter(self, record):
+        task_id = task_id_var.get()
+        record.task_id = task_id
+        record.task_prefix = f"[{task_id}] " if task_id else ""
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """ Keep only a fraction of the DEBUG records, per logging call site.
+
+    Counting per call site, instead of drawing at random, keeps an evenly
+    spread share of every debug line, including rare ones: the first record of
+    each call site is always kept. Records of INFO and above are never dropped.
+    """
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = min(max(rate, 0.0), 1.0)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        site = (record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(site, 0)
+            self._counts[site] = count + 1
+        # Keep the records where the running share of kept records goes up by one
+        return count == 0 or int((count + 1) * self.rate) > int(count * self.rate)
+
+
+class LazyQueueHandler(QueueHandler):
+    """ QueueHandler that leaves the formatting to the listener thread.
+
+    The standard QueueHandler formats the message before queueing, so records
+    can be pickled to another process. The queue is in process here, so the
+    record is queued as it is. A record that does not fit in the queue is
+    dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.listener = None
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("log_records_dropped")
+
+
+class DrainingQueueListener(QueueListener):
+    """ QueueListener whose stop() waits for room in a full queue. """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line. """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        task_id = getattr(record, "task_id", None)
+        if task_id:
+            entry["task_id"] = task_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ The classic text format, with the Task id in front of the message. """
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        if not hasattr(record, "task_prefix"):
+            record.task_prefix = ""
+        return super().format(record)
+
+
+def start_logging(level: int, log_format: str = "text", debug_sample: float = 1.0,
+                  handler: Optional[logging.Handler] = None, queue_size: int = 10000) -> QueueListener:
+    """ Route the records of the root logger through a queue to a listener thread.
+
+    Args:
+        level: level of the root logger.
+        log_format: text for the classic format, or json.
+        debug_sample: fraction of the DEBUG records of each call site that is kept.
+        handler: where the listener writes. Defaults to a StreamHandler on stderr.
+        queue_size: records waiting for the listener beyond this are dropped.
+
+    Returns:
+        the running listener. stop() it to flush the queue.
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(debug_sample))
+    queue_handler.addFilter(TaskContextFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_handler)
+
+    listener = DrainingQueueListener(log_queue, handler, respect_handler_level=True)
+    queue_handler.listener = listener
+    listener.start()
+    return listener
+
+
+def restart_logging() -> List[QueueListener]:
+    """ Start the logging of a process forked after start_logging() again.
+
+    A forked process gets a copy of the queue, but not the listener thread,
+    so its records would never be written. Each queue handler gets a new queue
+    and a listener of its own in this process, writing to the same handlers.
+
+    Returns:
+        the running listeners. stop() them before the process exits.
+    """
+    listeners = []
+    for queue_handler in logging.getLogger().handlers:
+        if not isinstance(queue_handler, LazyQueueHandler) or queue_handler.listener is None:
+            continue
+        # The copied queue may hold records the parent writes itself
+        queue_handler.queue = queue.Queue(maxsize=queue_handler.queue.maxsize)
+        for log_filter in queue_handler.filters:
+            if isinstance(log_filter, DebugSampler):
+                # Another thread may have held the lock at the fork
+                log_filter._lock = threading.Lock()
+        listener = DrainingQueueListener(queue_handler.queue, *queue_handler.listener.handlers,
+                                         respect_handler_level=True)
+        queue_handler.listener = listener
+        listener.start()
+        listeners.append(listener)
+    return listeners
@@ -0,0 +1,125 @@
+""" Per-job memory accounting and a global in-flight byte budget.
+
+Each job holds several copies of its image at once: the raw bytes, the decoded
+pixels when the image cannot be passed through, the Pixel Data in the DICOM
+dataset, and the encoded dataset while it is being sent. The peak is estimated
+from the image header before the job starts, and a job only starts once its
+estimate fits in the global budget, so concurrency can be raised without
+risking running out of memory on large images.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from fhir2dicom4ortho.image_header import read_image_header
+from fhir2dicom4ortho.passthrough import can_pass_through
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho import logger, args_cache
+
+# Enough to reach the SOF of JPEGs with large EXIF/thumbnail segments
+IMAGE_HEADER_BYTES = 128 * 1024
+
+# Decoding with PIL and converting through numpy in dicom4ortho holds about
+# three copies of the decoded pixels at once.
+DECODED_COPIES = 3
+
+
+def estimate_job_bytes(image_size: int, image_head: bytes, mwl_size: int, passthrough: bool = True) -> int:
+    """ Estimate the peak memory of building and sending one image.
+
+    Args:
+        image_size: size of the raw image bytes.
+        image_head: the first bytes of the image, enough to contain its header.
+        mwl_size: size of the raw DICOM MWL bytes.
+        passthrough: whether the image would be encapsulated without decoding.
+    """
+    header = read_image_header(image_head)
+    if header is not None and passthrough and can_pass_through(header):
+        # Raw bytes, encapsulated Pixel Data, encoded dataset
+        pixel_data = image_size
+        decoded = 0
+    elif header is not None:
+        pixel_data = header.decoded_size
+        decoded = DECODED_COPIES * header.decoded_size
+    else:
+        # Unknown format: assume a 10:1 compression ratio
+        pixel_data = 10 * image_size
+        decoded = DECODED_COPIES * pixel_data
+    # The MWL is parsed into a Dataset, and its tags copied into the image.
+    return image_size + decoded + 2 * pixel_data + 2 * mwl_size
+
+
+class MemoryBudget:
+    """ Gate jobs on a global budget of in-flight bytes.
+
+    A job larger than the whole budget is still admitted, but only when
+    nothing else is in flight, so it can never be starved.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """ Call callback() after every release, e.g. to dispatch jobs that did not fit. """
+        self._listeners.append(callback)
+
+    def _fits(self, size: int) -> bool:
+        return self.in_flight + size <= self.max_bytes or self.in_flight == 0
+
+    def acquire(self, size: int):
+        """ Block until size bytes fit in the budget, then reserve them. """
+        if not self.max_bytes:
+            return
+        started = time.monotonic()
+        with self._condition:
+            if not self._fits(size):
+                logger.debug("Waiting for %d bytes of memory budget (%d/%d in flight)",
+                             size, self.in_flight, self.max_bytes)
+                self.waiting += 1
+                metrics.set_gauge("memory_budget_waiting_jobs", self.waiting)
+                try:
+                    self._condition.wait_for(lambda: self._fits(size))
+                finally:
+                    self.waiting -= 1
+                    metrics.set_gauge("memory_budget_waiting_jobs", self.waiting)
+            self.in_flight += size
+            metrics.set_gauge("memory_in_flight_bytes", self.in_flight)
+        metrics.observe("memory_budget_wait_seconds", time.monotonic() - started)
+
+    def try_acquire(self, size: int) -> bool:
+        """ Reserve size bytes if they fit in the budget now, without waiting. """
+        if not self.max_bytes:
+            return True
+        with self._condition:
+            if not self._fits(size):
+                return False
+            self.in_flight += size
+            metrics.set_gauge("memory_in_flight_bytes", self.in_flight)
+        return True
+
+    def release(self, size: int):
+        """ Return size bytes to the budget. """
+        if not self.max_bytes:
+            return
+        with self._condition:
+            self.in_flight -= size
+            metrics.set_gauge("memory_in_flight_bytes", self.in_flight)
+            self._condition.notify_all()
+        for callback in self._listeners:
+            callback()
+
+    @contextmanager
+    def reserve(self, size: int):
+        """ Context manager holding size bytes of the budget. """
+        self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+
+memory_budget = MemoryBudget(args_cache.memory_budget_bytes)
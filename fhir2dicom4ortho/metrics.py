@@ -0,0 +1,83 @@
+""" In-process metrics.
+
+A minimal thread-safe registry of counters, gauges and summaries, exposed as
+JSON on ``GET /metrics``. Metric names can carry labels, which are folded into
+the key, e.g. ``queue_wait_seconds{priority=stat}``.
+"""
+import threading
+
+
+def _key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """ Registry of counters, gauges and summaries. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """ Increment a counter. """
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """ Set a gauge to its current value. """
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """ Record one observation in a summary, tracking count, sum and max. """
+        key = _key(name, labels)
+        with self._lock:
+            summary = self._summaries.setdefault(key, {"count": 0, "sum": 0.0, "max": None})
+            summary["count"] += 1
+            summary["sum"] += value
+            if summary["max"] is None or value > summary["max"]:
+                summary["max"] = value
+
+    def get_counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def get_gauge(self, name: str, **labels):
+        with self._lock:
+            return self._gauges.get(_key(name, labels))
+
+    def get_summary(self, name: str, **labels) -> dict:
+        """ Return count, sum, max and avg of a summary, or None if nothing was observed. """
+        with self._lock:
+            summary = self._summaries.get(_key(name, labels))
+            if summary is None:
+                return None
+            return dict(summary, avg=summary["sum"] / summary["count"])
+
+    def snapshot(self) -> dict:
+        """ Return all metrics as a JSON serializable dict. """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": {
+                    key: dict(summary, avg=summary["sum"] / summary["count"])
+                    for key, summary in self._summaries.items()
+                },
+            }
+
+    def reset(self):
+        """ Forget all metrics. """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,74 @@
+""" Cache of parsed DICOM Modality Worklists.
+
+All photographs of one appointment carry the same MWL Binary. Instead of
+parsing and translating it again for every job, the parsed and translated
+Dataset is kept in a bounded LRU cache keyed by the SHA-256 of the MWL bytes.
+Every job gets its own deep copy, so changes made while building one image
+never leak into another.
+"""
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+from pydicom import Dataset
+
+from fhir2dicom4ortho.utils import convert_bytes_to_dataset, translate_all_scheduled_protocol_codes_to_opor
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho.tracing import tracer
+from fhir2dicom4ortho import args_cache
+
+
+def parse_mwl(dicom_bytes: bytes) -> Dataset:
+    """ Parse MWL bytes, and translate its scheduled protocol codes to 99OPOR. """
+    with tracer.span("mwl.parse"):
+        dataset = convert_bytes_to_dataset(dicom_bytes)
+    with tracer.span("mwl.translate_codes"):
+        return translate_all_scheduled_protocol_codes_to_opor(dataset)
+
+
+class MwlCache:
+    """ Bounded LRU cache of parsed MWL datasets. max_entries of 0 disables it. """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._datasets)
+
+    def get(self, dicom_bytes: bytes) -> Dataset:
+        """ Return a private copy of the parsed and translated MWL. """
+        if not self.max_entries:
+            return parse_mwl(dicom_bytes)
+        key = hashlib.sha256(dicom_bytes).digest()
+        with self._lock:
+            dataset = self._datasets.get(key)
+            if dataset is not None:
+                self._datasets.move_to_end(key)
+                self.hits += 1
+        if dataset is not None:
+            metrics.inc("mwl_cache_hits")
+            return copy.deepcopy(dataset)
+
+        # Parse outside the lock. Two jobs missing at once both parse, which is harmless.
+        dataset = parse_mwl(dicom_bytes)
+        with self._lock:
+            self.misses += 1
+            self._datasets[key] = dataset
+            self._datasets.move_to_end(key)
+            while len(self._datasets) > self.max_entries:
+                self._datasets.popitem(last=False)
+        metrics.inc("mwl_cache_misses")
+        return copy.deepcopy(dataset)
+
+    def clear(self):
+        with self._lock:
+            self._datasets.clear()
+
+
+mwl_cache = MwlCache(args_cache.mwl_cache_size)
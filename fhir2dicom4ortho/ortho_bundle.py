@@ -0,0 +1,349 @@
+""" Fast validation and parsing of ortho-imaging-bundle Bundles.
+
+Building the full fhir.resources Bundle model validates every entry, including
+the multi-megabyte base64 Binary payloads, before the Task is even found. This
+module checks the raw JSON against the structure required by the
+ortho-imaging-bundle profile (ig/input/resources) first, so malformed Bundles
+are rejected before any model is built. Only the small Task and ImagingStudy
+resources then go through full model validation, while Binary data is
+base64-decoded directly to opaque bytes.
+
+Binaries uploaded with POST /fhir/Binary and referenced from Task.input as
+Binary/{id} count towards the Binary slice of the profile.
+
+A batch or transaction Bundle sent to POST /fhir may hold many such sets.
+split_batch() cuts it into one ortho-imaging-bundle per Task, following the
+ImagingStudy and Binary references of each Task.input.
+"""
+import base64
+import binascii
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from pydantic import ValidationError
+from fhir.resources.binary import Binary
+from fhir.resources.bundle import Bundle
+from fhir.resources.imagingstudy import ImagingStudy
+from fhir.resources.task import Task
+
+from fhir2dicom4ortho.binary_store import binary_store
+
+PROFILE_URL = "http://fhir2dicom4ortho/StructureDefinition/ortho-imaging-bundle"
+
+# Constraints from the profile differential. Keep in sync with
+# ig/input/resources/StructureDefinition-ortho-imaging-bundle.json
+BUNDLE_TYPE = "batch"
+MIN_ENTRIES = 3
+# resourceType: (min, max). None means unbounded.
+ENTRY_SLICES = {
+    "Task": (1, 1),
+    "ImagingStudy": (1, 1),
+    "Binary": (1, None),
+}
+
+# Bundle.type accepted by POST /fhir
+BATCH_TYPES = ("batch", "transaction")
+
+MWL_CONTENT_TYPE = "application/dicom"
+IMAGE_CONTENT_TYPE_PREFIX = "image/"
+
+
+class BundleValidationError(ValueError):
+    """ Raised when a Bundle does not conform to the ortho-imaging-bundle profile. """
+
+
+@dataclass
+class BinaryContent:
+    """ Content of a Binary, either inlined in the Bundle or spooled from a raw upload. """
+    content_type: str
+    id: Optional[str] = None
+    data: Optional[bytes] = None
+
+    def get_bytes(self) -> bytes:
+        """ Return the raw bytes, reading them from the spool if they were uploaded separately. """
+        if self.data is not None:
+            return self.data
+        try:
+            return binary_store.read_bytes(self.id)
+        except KeyError as e:
+            raise BundleValidationError(f"Binary/{self.id} has no data and was not uploaded") from e
+
+    @property
+    def size(self) -> int:
+        """ Size of the raw bytes, without reading spooled content. 0 if unknown. """
+        if self.data is not None:
+            return len(self.data)
+        try:
+            return binary_store.get_size(self.id)
+        except KeyError:
+            return 0
+
+    def head(self, size: int) -> bytes:
+        """ First size bytes of the content, without reading all of a spooled Binary. """
+        if self.data is not None:
+            return self.data[:size]
+        try:
+            return binary_store.read_head(self.id, size)
+        except KeyError:
+            return b""
+
+
+@dataclass
+class OrthoImagingBundle:
+    """ The parts of an ortho-imaging-bundle needed to build one DICOM image. """
+    task: Task
+    imaging_study: ImagingStudy
+    image: BinaryContent
+    mwl: BinaryContent
+
+    def spooled_ids(self) -> list:
+        """ Ids of the Binaries uploaded with POST /fhir/Binary instead of inlined """
+        return [binary.id for binary in (self.image, self.mwl) if binary.data is None and binary.id]
+
+
+def _binary_references(task: dict) -> list:
+    """ Return the ids of all Binary resources referenced from Task.input """
+    ids = []
+    for task_input in task.get("input") or []:
+        reference = (task_input.get("valueReference") or {}).get("reference") or ""
+        if reference.startswith("Binary/"):
+            ids.append(reference[len("Binary/"):])
+    return ids
+
+
+def _task_references(task: dict) -> list:
+    """ Return all references of Task.input, e.g. ImagingStudy/{id} or urn:uuid:{id} """
+    return [
+        (task_input.get("valueReference") or {}).get("reference")
+        for task_input in task.get("input") or []
+        if (task_input.get("valueReference") or {}).get("reference")]
+
+
+def _check_imaging_study(imaging_study: dict):
+    """ Check the ImagingStudy fields needed to build the DICOM image """
+    if not imaging_study.get("status"):
+        raise BundleValidationError("ImagingStudy.status is required")
+    series = imaging_study.get("series")
+    if not isinstance(series, list) or not series or not isinstance(series[0], dict):
+        raise BundleValidationError("ImagingStudy must contain at least one Series")
+    series0 = series[0]
+    for field in ("uid", "modality"):
+        if not series0.get(field):
+            raise BundleValidationError(f"ImagingStudy.series.{field} is required")
+    instances = series0.get("instance")
+    if not isinstance(instances, list) or not instances or not isinstance(instances[0], dict):
+        raise BundleValidationError("ImagingStudy must contain at least one Series and one Instance")
+    for field in ("uid", "sopClass"):
+        if not instances[0].get(field):
+            raise BundleValidationError(f"ImagingStudy.series.instance.{field} is required")
+
+
+def _check_binaries(binaries: list):
+    """ Check there is exactly one image Binary and one DICOM MWL Binary. """
+    images = 0
+    mwls = 0
+    for binary in binaries:
+        content_type = binary.get("contentType")
+        if not content_type:
+            raise BundleValidationError("Binary.contentType is required")
+        if content_type.startswith(IMAGE_CONTENT_TYPE_PREFIX):
+            images += 1
+        elif content_type == MWL_CONTENT_TYPE:
+            mwls += 1
+        else:
+            raise BundleValidationError(
+                f"Binary.contentType must be image/* or {MWL_CONTENT_TYPE}, not {content_type}")
+        if binary.get("data") is None and not binary_store.exists(binary.get("id")):
+            raise BundleValidationError(f"Binary/{binary.get('id')} has no data and was not uploaded")
+    if images != 1 or mwls != 1:
+        raise BundleValidationError(
+            "Invalid Bundle: Must contain one image Binary, one DICOM Binary and one ImagingStudy.")
+
+
+def validate_bundle_structure(bundle_data: dict) -> dict:
+    """ Check a raw Bundle against the structure of the ortho-imaging-bundle profile.
+
+    Only looks at the JSON structure, never at Binary data, so it is cheap
+    regardless of the size of the images.
+
+    Returns:
+        dict mapping resourceType to the list of raw resources of that type.
+        Spooled Binaries referenced from the Task are included as Binary
+        resources without data.
+
+    Raises:
+        BundleValidationError: if the Bundle does not conform.
+    """
+    if not isinstance(bundle_data, dict) or bundle_data.get("resourceType") != "Bundle":
+        raise BundleValidationError("Resource must be a Bundle")
+    if bundle_data.get("type") != BUNDLE_TYPE:
+        raise BundleValidationError(f"Bundle.type must be '{BUNDLE_TYPE}'")
+    entries = bundle_data.get("entry")
+    if not isinstance(entries, list):
+        raise BundleValidationError("Bundle.entry is required")
+
+    resources = {resource_type: [] for resource_type in ENTRY_SLICES}
+    for entry in entries:
+        resource = entry.get("resource") if isinstance(entry, dict) else None
+        if not isinstance(resource, dict):
+            raise BundleValidationError("Entry must contain a resource")
+        resource_type = resource.get("resourceType")
+        # The slicing of Bundle.entry is open: other resources, e.g. a Basic, are ignored
+        if resource_type in resources:
+            resources[resource_type].append(resource)
+
+    # Binaries uploaded with POST /fhir/Binary stand in for Binary entries.
+    if len(resources["Task"]) == 1:
+        in_bundle = {binary.get("id") for binary in resources["Binary"]}
+        for binary_id in _binary_references(resources["Task"][0]):
+            if binary_id not in in_bundle and binary_store.exists(binary_id):
+                resources["Binary"].append({
+                    "resourceType": "Binary",
+                    "id": binary_id,
+                    "contentType": binary_store.get_content_type(binary_id)})
+
+    if sum(len(r) for r in resources.values()) < MIN_ENTRIES:
+        raise BundleValidationError(f"Bundle must contain at least {MIN_ENTRIES} entries")
+    for resource_type, (minimum, maximum) in ENTRY_SLICES.items():
+        count = len(resources[resource_type])
+        if count < minimum or (maximum is not None and count > maximum):
+            expected = f"{minimum}..{'*' if maximum is None else maximum}"
+            raise BundleValidationError(
+                f"Bundle must contain {expected} {resource_type} entries, found {count}")
+
+    if not resources["Task"][0].get("intent"):
+        raise BundleValidationError("Task.intent is required")
+    _check_imaging_study(resources["ImagingStudy"][0])
+    _check_binaries(resources["Binary"])
+    return resources
+
+
+def split_batch(bundle_data: dict) -> list:
+    """ Cut a batch or transaction Bundle into one ortho-imaging-bundle per Task.
+
+    The ImagingStudy and Binary entries of a Task are those its Task.input
+    references, as Type/{id} or as the fullUrl of the entry. A Bundle with a
+    single Task keeps all its entries, as POST /fhir/Bundle does. Only the
+    JSON structure is looked at; each group is validated by parse_bundle().
+
+    Returns:
+        list of raw Bundles, one per Task, in the order of the Tasks.
+
+    Raises:
+        BundleValidationError: if the Bundle is not a batch or transaction,
+            or has ImagingStudy or Binary entries that no Task references.
+    """
+    if not isinstance(bundle_data, dict) or bundle_data.get("resourceType") != "Bundle":
+        raise BundleValidationError("Resource must be a Bundle")
+    if bundle_data.get("type") not in BATCH_TYPES:
+        raise BundleValidationError(f"Bundle.type must be one of {', '.join(BATCH_TYPES)}")
+    entries = bundle_data.get("entry")
+    if not isinstance(entries, list):
+        raise BundleValidationError("Bundle.entry is required")
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("resource"), dict):
+            raise BundleValidationError("Entry must contain a resource")
+
+    tasks = [entry for entry in entries if entry["resource"].get("resourceType") == "Task"]
+    if not tasks:
+        raise BundleValidationError("Bundle must contain at least one Task")
+    if len(tasks) == 1:
+        return [{"resourceType": "Bundle", "type": BUNDLE_TYPE, "entry": entries}]
+
+    by_reference = {}
+    for index, entry in enumerate(entries):
+        resource = entry["resource"]
+        if resource.get("id"):
+            by_reference[f"{resource.get('resourceType')}/{resource['id']}"] = index
+        if entry.get("fullUrl"):
+            by_reference[entry["fullUrl"]] = index
+
+    groups = []
+    referenced = set()
+    for task_entry in tasks:
+        indices = []
+        for reference in _task_references(task_entry["resource"]):
+            index = by_reference.get(reference)
+            # Binaries uploaded with POST /fhir/Binary are not in the Bundle
+            if index is not None and index not in indices:
+                indices.append(index)
+        referenced.update(indices)
+        groups.append({"resourceType": "Bundle", "type": BUNDLE_TYPE,
+                       "entry": [task_entry] + [entries[index] for index in indices]})
+
+    for index, entry in enumerate(entries):
+        resource = entry["resource"]
+        resource_type = resource.get("resourceType")
+        # Other resources are ignored, as by validate_bundle_structure()
+        if resource_type in ENTRY_SLICES and resource_type != "Task" and index not in referenced:
+            raise BundleValidationError(
+                f"{resource_type}/{resource.get('id')} is not referenced from any Task.input")
+    return groups
+
+
+def _decode_binary(binary: dict) -> BinaryContent:
+    data = binary.get("data")
+    if data is not None:
+        try:
+            data = base64.b64decode(data, validate=True)
+        except (binascii.Error, TypeError) as e:
+            raise BundleValidationError(f"Binary/{binary.get('id')} data is not valid base64") from e
+    return BinaryContent(content_type=binary["contentType"], id=binary.get("id"), data=data)
+
+
+def _split_binaries(binaries: list) -> tuple:
+    image = next(b for b in binaries if b.content_type.startswith(IMAGE_CONTENT_TYPE_PREFIX))
+    mwl = next(b for b in binaries if b.content_type == MWL_CONTENT_TYPE)
+    return image, mwl
+
+
+def parse_bundle(bundle_data: dict) -> OrthoImagingBundle:
+    """ Validate and parse a raw ortho-imaging-bundle.
+
+    Runs the structural pre-check, then full model validation of the Task and
+    ImagingStudy only. Binary data is base64-decoded without building Binary
+    models.
+    """
+    resources = validate_bundle_structure(bundle_data)
+    try:
+        task = Task.model_validate(resources["Task"][0])
+        imaging_study = ImagingStudy.model_validate(resources["ImagingStudy"][0])
+    except ValidationError as e:
+        raise BundleValidationError(str(e)) from e
+    image, mwl = _split_binaries([_decode_binary(b) for b in resources["Binary"]])
+    return OrthoImagingBundle(task=task, imaging_study=imaging_study, image=image, mwl=mwl)
+
+
+def from_bundle(bundle: Bundle) -> OrthoImagingBundle:
+    """ Extract an OrthoImagingBundle from an already validated Bundle model. """
+    task = None
+    imaging_study = None
+    binaries = []
+    for entry in bundle.entry or []:
+        resource = entry.resource
+        if isinstance(resource, Task):
+            task = resource
+        elif isinstance(resource, ImagingStudy):
+            imaging_study = resource
+        elif isinstance(resource, Binary):
+            binaries.append(BinaryContent(content_type=resource.contentType, id=resource.id, data=resource.data))
+
+    if task is not None:
+        in_bundle = {binary.id for binary in binaries}
+        for binary_id in _binary_references(task.model_dump()):
+            if binary_id not in in_bundle and binary_store.exists(binary_id):
+                binaries.append(BinaryContent(content_type=binary_store.get_content_type(binary_id), id=binary_id))
+
+    images = [b for b in binaries if b.content_type.startswith(IMAGE_CONTENT_TYPE_PREFIX)]
+    mwls = [b for b in binaries if b.content_type == MWL_CONTENT_TYPE]
+    if not images or not mwls or imaging_study is None:
+        raise BundleValidationError(
+            "Invalid Bundle: Must contain one image Binary, one DICOM Binary and one ImagingStudy.")
+    return OrthoImagingBundle(task=task, imaging_study=imaging_study, image=images[-1], mwl=mwls[-1])
+
+
+def as_ortho_imaging_bundle(bundle: Union[Bundle, OrthoImagingBundle]) -> OrthoImagingBundle:
+    """ Accept either a parsed OrthoImagingBundle or a Bundle model. """
+    if isinstance(bundle, OrthoImagingBundle):
+        return bundle
+    return from_bundle(bundle)
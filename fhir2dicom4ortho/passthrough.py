@@ -0,0 +1,88 @@
+""" Pass-through encapsulation of JPEG and JPEG 2000 photographs.
+
+dicom4ortho opens every input image with PIL, and re-encodes JPEG 2000 images
+before encapsulating them. For baseline JPEG and JPEG 2000 input we can instead
+read the dimensions and color layout from the header and encapsulate the
+original compressed bitstream as it is, with the matching Transfer Syntax.
+Pixels are never decoded, and the PACS receives exactly what the camera wrote.
+
+Anything else (PNG, progressive or 12 bit JPEG, MPO, CMYK, ...) falls back to
+the dicom4ortho conversion.
+"""
+from pydicom.encaps import encapsulate
+from pydicom.uid import JPEGBaseline8Bit, JPEG2000, JPEG2000Lossless
+
+from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
+
+from fhir2dicom4ortho.image_header import read_image_header, jpeg2000_codestream, ImageHeader
+from fhir2dicom4ortho import logger
+
+
+def can_pass_through(header: ImageHeader) -> bool:
+    """ True if the image can be encapsulated without decoding it. """
+    if header is None or not header.baseline or header.photometric_interpretation is None:
+        return False
+    if header.bits_stored != 8 or header.samples_per_pixel not in (1, 3):
+        return False
+    if header.format == "JPEG":
+        return not header.multi_picture
+    if header.format == "JPEG2000":
+        # YBR_RCT is only defined for the lossless Transfer Syntax
+        return header.photometric_interpretation != "YBR_RCT" or header.reversible
+    return False
+
+
+class PassThroughOrthodonticPhotograph(OrthodonticPhotograph):
+    """ OrthodonticPhotograph that encapsulates JPEG and JPEG 2000 input without decoding it. """
+
+    def set_image(self):
+        if self.input_image_bytes:
+            header = read_image_header(self.input_image_bytes)
+            if can_pass_through(header):
+                self._image_format = header.format
+                return self._set_image_passthrough(header)
+            logger.debug("Image cannot be passed through, converting with dicom4ortho")
+        return super().set_image()
+
+    def _set_image_passthrough(self, header: ImageHeader):
+        """ Encapsulate the original bitstream as Pixel Data, using only values read from the header. """
+        if header.format == "JPEG2000":
+            bitstream = jpeg2000_codestream(self.input_image_bytes)
+            # The reversible wavelet is only lossless if no quality layers were dropped, which the
+            # header cannot tell. Use the lossless Transfer Syntax only where DICOM requires it.
+            transfer_syntax = JPEG2000Lossless if header.photometric_interpretation == "YBR_RCT" else JPEG2000
+            compression_method = 'ISO_15444_1'
+            lossy = not header.reversible
+        else:
+            bitstream = self.input_image_bytes
+            transfer_syntax = JPEGBaseline8Bit
+            compression_method = 'ISO_10918_1'
+            lossy = True
+
+        logger.debug("Encapsulating %s bitstream as is (%dx%d, %s)", header.format,
+                     header.columns, header.rows, header.photometric_interpretation)
+        self._ds.Rows = header.rows
+        self._ds.Columns = header.columns
+        self._ds.PixelData = encapsulate([bitstream])
+        # Compressed Pixel Data must be encoded with undefined length
+        self._ds['PixelData'].is_undefined_length = True
+
+        self._ds.PhotometricInterpretation = header.photometric_interpretation
+        self._ds.SamplesPerPixel = header.samples_per_pixel
+        if header.samples_per_pixel > 1:
+            self._ds.PlanarConfiguration = 0
+        elif 'PlanarConfiguration' in self._ds:
+            del self._ds.PlanarConfiguration
+        self._ds.PixelRepresentation = 0
+        self._ds.BitsAllocated = 8
+        self._ds.BitsStored = 8
+        self._ds.HighBit = 7
+
+        self.lossy_compression(lossy)
+        if lossy:
+            self._ds.LossyImageCompressionRatio = round(header.decoded_size / len(bitstream), 2)
+            self._ds.LossyImageCompressionMethod = compression_method
+
+        self._ds.file_meta.TransferSyntaxUID = transfer_syntax
+        self._ds.is_little_endian = True
+        self._ds.is_implicit_VR = False
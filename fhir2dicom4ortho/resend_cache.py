@@ -0,0 +1,123 @@
+""" On-disk cache of built DICOM images whose send failed, keyed by Task id.
+
+Without the local DICOM store, a job that fails to send used to throw its
+image away, and a retry meant submitting the Bundle again and building it
+again. With ``F2D4O_RESEND_CACHE_DIR`` set, the image is kept here instead,
+and a DicomUploader retries the failed destinations with exponential
+backoff. ``POST /fhir/Task/{task_id}/$resend`` sends it again on demand, once
+the automatic retries gave up.
+
+The cache is bounded: images older than ``F2D4O_RESEND_CACHE_TTL`` seconds
+are dropped, and when the images exceed ``F2D4O_RESEND_CACHE_MAX_BYTES``,
+the least recently used are dropped first. An image larger than the whole
+cache is never cached. Files are::
+
+    {root}/{task_id[:2]}/{task_id}.dcm
+    {root}/{task_id[:2]}/{task_id}.json
+
+The sidecar records when the image was built, and when the entry was last
+used: written, attempted or requeued. Like the local DICOM store, the cache
+is indexed in memory, so evicting never reads the disk.
+"""
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from pydicom import Dataset
+
+from fhir2dicom4ortho.dicom_store import DicomStore, StoreEntry
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho import logger, args_cache
+
+
+class ResendCache(DicomStore):
+    """ DICOM images of Tasks with failed sends, with a size cap, TTL and LRU eviction.
+
+    Has the interface of DicomStore, so a DicomUploader can drain it.
+
+    Args:
+        max_bytes: total size of the cached images. 0 means unbounded.
+        ttl: seconds an image is kept after it was built. 0 keeps it until evicted.
+        on_evict: on_evict(entry) called for each entry dropped with destinations still pending.
+    """
+    SIDECAR_GLOB = "*/*.json"
+    SHARD_DEPTH = 1
+
+    def __init__(self, root_dir: str, max_bytes: int = 0, ttl: float = 0,
+                 on_evict: Optional[Callable] = None):
+        super().__init__(root_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+    def path_for_task(self, task_id: str) -> Path:
+        return self.root_dir / task_id[:2] / f"{task_id}.dcm"
+
+    def write(self, dataset: Dataset, task_id: str, statuses: dict) -> Optional[StoreEntry]:
+        """ Cache the image of a Task with the status of each destination after the first send.
+
+        Destinations that are not completed are sent again. An earlier image of
+        the same Task is replaced. Other images are evicted to make room, but
+        never the one being written.
+
+        Returns:
+            the new entry, or None if the image is larger than max_bytes.
+        """
+        path = self.path_for_task(task_id)
+        size = self._write_dataset(path, dataset)
+        if self.max_bytes and size > self.max_bytes:
+            # Dropping every other image would not make room for it
+            self.delete(StoreEntry(task_id=task_id, destinations={}, path=path))
+            metrics.inc("resend_cache_rejections")
+            logger.warning("Image of Task %s not cached: %d bytes, over the cache size of %d bytes",
+                           task_id, size, self.max_bytes)
+            return None
+        entry = self._put(StoreEntry(task_id=task_id, destinations=dict(statuses), path=path,
+                                     size=size, created=time.time()))
+        metrics.inc("resend_cache_writes")
+        logger.debug("Cached %s for resending", path)
+        self.evict(keep=path)
+        return entry
+
+    def due(self, now: Optional[float] = None) -> list:
+        # The uploader polls due() regularly, which also expires old images
+        self.evict(now)
+        return super().due(now)
+
+    def evict(self, now: Optional[float] = None, keep: Optional[Path] = None):
+        """ Drop expired images, then the least recently used ones until the cache fits in max_bytes.
+
+        Args:
+            keep: path of an image that is not dropped, e.g. the one just written.
+        """
+        now = time.time() if now is None else now
+        evicted = []
+        with self._lock:
+            cached = []
+            for entry in self.entries():
+                if entry.path != keep and self.ttl and now - entry.created > self.ttl:
+                    evicted.append((entry, "expired"))
+                else:
+                    cached.append(entry)
+            if self.max_bytes:
+                total = sum(entry.size for entry in cached)
+                for entry in sorted(cached, key=lambda e: e.used):
+                    if total <= self.max_bytes:
+                        break
+                    if entry.path == keep:
+                        continue
+                    evicted.append((entry, "over the size cap"))
+                    total -= entry.size
+            for entry, _ in evicted:
+                self.delete(entry)
+        for entry, reason in evicted:
+            logger.info("Dropped cached image of Task %s, %s", entry.task_id, reason)
+            metrics.inc("resend_cache_evictions")
+            if entry.pending() and not entry.failed and self.on_evict is not None:
+                self.on_evict(entry)
+
+
+resend_cache = ResendCache(
+    args_cache.resend_cache_dir,
+    max_bytes=args_cache.resend_cache_max_bytes,
+    ttl=args_cache.resend_cache_ttl) if args_cache.resend_cache_dir else None
@@ -0,0 +1,193 @@
+""" Routing of DICOM images to one or more PACS destinations.
+
+Destinations and the rules choosing between them are read from a JSON file
+(``F2D4O_DESTINATIONS_FILE``)::
+
+    {
+        "destinations": {
+            "practice-a": {"send_method": "dimse", "dimse_aet": "PACS_A",
+                           "dimse_hostname": "10.0.0.1", "dimse_port": 104},
+            "archive": {"send_method": "wado", "wado_url": "https://archive/dicom-web"}
+        },
+        "rules": [
+            {"match": {"task.owner": "Organization/practice-a"}, "destinations": ["practice-a"]},
+            {"match": {"mwl.ScheduledStationAETitle": ["CAM1", "CAM2"]}, "destinations": ["practice-a"]},
+            {"match": {}, "destinations": ["archive"]}
+        ],
+        "default": ["default"]
+    }
+
+The PACS configured with ``F2D4O_PACS_*`` is always available as the
+``default`` destination. Every rule whose conditions all match adds its
+destinations, in order. When no rule matches, the ``default`` list is used.
+
+Match keys are either ``task.<element>``, compared with the reference, display
+or identifier value of a Reference, or the string value otherwise; or
+``mwl.<DICOM keyword>``, looked up in the MWL dataset and in its Scheduled
+Procedure Step Sequence. A match value can be a string or a list of strings.
+"""
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+
+from pydicom import Dataset
+from pydicom.multival import MultiValue
+from fhir.resources.task import Task
+
+from fhir2dicom4ortho import logger, args_cache
+
+DEFAULT_DESTINATION = "default"
+
+
+class RoutingConfigError(ValueError):
+    """ Raised when the destinations file is invalid. """
+
+
+@dataclass
+class Destination:
+    """ One PACS the DICOM images can be sent to. """
+    name: str
+    send_method: str = "dimse"
+    dimse_aet: str = ""
+    dimse_hostname: str = ""
+    dimse_port: int = 104
+    wado_url: str = ""
+    wado_username: str = ""
+    wado_password: str = ""
+
+    def send_kwargs(self) -> dict:
+        """ Keyword arguments for OrthodonticController.send() """
+        return {
+            "send_method": self.send_method,
+            "pacs_dimse_hostname": self.dimse_hostname,
+            "pacs_dimse_port": self.dimse_port,
+            "pacs_dimse_aet": self.dimse_aet,
+            "pacs_wado_url": self.wado_url,
+            "pacs_wado_username": self.wado_username,
+            "pacs_wado_password": self.wado_password,
+        }
+
+    @classmethod
+    def from_args(cls, args) -> "Destination":
+        """ The destination configured with the F2D4O_PACS_* variables """
+        return cls(
+            name=DEFAULT_DESTINATION,
+            send_method=args.pacs_send_method,
+            dimse_aet=args.pacs_dimse_aet,
+            dimse_hostname=args.pacs_dimse_hostname,
+            dimse_port=args.pacs_dimse_port,
+            wado_url=args.pacs_wado_url,
+            wado_username=args.pacs_wado_username,
+            wado_password=args.pacs_wado_password,
+        )
+
+
+@dataclass
+class Rule:
+    """ Send to destinations when every condition in match holds. """
+    match: dict
+    destinations: list = field(default_factory=list)
+
+
+def _task_values(task: Task, element: str) -> list:
+    value = getattr(task, element, None) if task is not None else None
+    if value is None:
+        return []
+    values = value if isinstance(value, list) else [value]
+    result = []
+    for v in values:
+        if hasattr(v, "reference"):
+            result.extend([v.reference, v.display])
+            if getattr(v, "identifier", None) is not None:
+                result.append(v.identifier.value)
+        else:
+            result.append(str(v))
+    return [v for v in result if v]
+
+
+def _mwl_values(mwl: Dataset, keyword: str) -> list:
+    if mwl is None:
+        return []
+    datasets = [mwl] + list(mwl.get("ScheduledProcedureStepSequence", []))
+    result = []
+    for ds in datasets:
+        if keyword in ds:
+            value = ds.data_element(keyword).value
+            values = value if isinstance(value, MultiValue) else [value]
+            result.extend(str(v) for v in values)
+    return result
+
+
+def _attribute_values(key: str, task: Task, mwl: Dataset) -> list:
+    scope, _, name = key.partition(".")
+    if scope == "task":
+        return _task_values(task, name)
+    if scope == "mwl":
+        return _mwl_values(mwl, name)
+    raise RoutingConfigError(f"Unknown routing attribute {key}, must start with task. or mwl.")
+
+
+class Router:
+    """ Picks the destinations of each image from its Task and MWL. """
+
+    def __init__(self, destinations: dict, rules: Optional[list] = None, default: Optional[list] = None):
+        self.destinations = destinations
+        self.rules = rules or []
+        self.default = default or [DEFAULT_DESTINATION]
+        for name in self.default + [n for rule in self.rules for n in rule.destinations]:
+            if name not in self.destinations:
+                raise RoutingConfigError(f"Unknown destination {name}")
+        for rule in self.rules:
+            for key in rule.match:
+                scope = key.partition(".")[0]
+                if scope not in ("task", "mwl"):
+                    raise RoutingConfigError(f"Unknown routing attribute {key}, must start with task. or mwl.")
+
+    @classmethod
+    def from_config(cls, config: dict, default_destination: Destination) -> "Router":
+        """ Build a Router from the parsed destinations file. """
+        destinations = {DEFAULT_DESTINATION: default_destination}
+        try:
+            for name, options in (config.get("destinations") or {}).items():
+                destinations[name] = Destination(name=name, **options)
+            rules = [Rule(match=rule.get("match") or {}, destinations=list(rule["destinations"]))
+                     for rule in config.get("rules") or []]
+        except (TypeError, KeyError, AttributeError) as e:
+            raise RoutingConfigError(f"Invalid destinations file: {e}") from e
+        return cls(destinations, rules, config.get("default"))
+
+    @classmethod
+    def from_args(cls, args) -> "Router":
+        """ Build the Router from F2D4O_DESTINATIONS_FILE, or route everything to F2D4O_PACS_* """
+        default_destination = Destination.from_args(args)
+        if not args.destinations_file:
+            return cls({DEFAULT_DESTINATION: default_destination})
+        logger.info("Loading PACS destinations from %s", args.destinations_file)
+        with open(args.destinations_file, "r", encoding="utf-8") as f:
+            return cls.from_config(json.load(f), default_destination)
+
+    @staticmethod
+    def _matches(rule: Rule, task: Task, mwl: Dataset) -> bool:
+        for key, expected in rule.match.items():
+            expected = expected if isinstance(expected, list) else [expected]
+            actual = _attribute_values(key, task, mwl)
+            if not any(str(e) in actual for e in expected):
+                return False
+        return True
+
+    def route(self, task: Task, mwl: Dataset) -> list:
+        """ Return the destinations for an image, without duplicates. """
+        names = []
+        for rule in self.rules:
+            if not self._matches(rule, task, mwl):
+                continue
+            for name in rule.destinations:
+                if name not in names:
+                    names.append(name)
+        if not names:
+            names = list(self.default)
+        logger.debug("Routing to %s", ", ".join(names))
+        return [self.destinations[name] for name in names]
+
+
+router = Router.from_args(args_cache)
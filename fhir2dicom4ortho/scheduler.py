@@ -1,10 +1,135 @@
 # filepath: /home/afm/src/open-ortho/dicom4ortho/fhir2dicom4ortho/scheduler.py
+import threading
+import time
+from collections import deque
+from contextvars import copy_context
+
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 
+from fhir2dicom4ortho.memory_budget import memory_budget
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho.tracing import tracer
+from fhir2dicom4ortho import logger, args_cache
+
+# FHIR request-priority codes, highest first
+PRIORITY_STAT = "stat"
+PRIORITY_ASAP = "asap"
+PRIORITY_URGENT = "urgent"
+PRIORITY_ROUTINE = "routine"
+PRIORITIES = (PRIORITY_STAT, PRIORITY_ASAP, PRIORITY_URGENT, PRIORITY_ROUTINE)
+
 executors = {
-    'default': ThreadPoolExecutor(10)
+    'default': ThreadPoolExecutor(args_cache.job_threads)
 }
 
 scheduler = BackgroundScheduler(executors=executors)
-scheduler.start()
\ No newline at end of file
+scheduler.start()
+
+
+class PriorityJobQueue:
+    """ Run jobs on the scheduler in order of FHIR Task.priority.
+
+    Every submitted job schedules one dispatch on the scheduler. When a worker
+    thread picks the dispatch up, it runs the best job waiting at that moment,
+    not necessarily the one that was submitted with it. So a stat Task jumps
+    ahead of a bulk import of routine Tasks that is already queued.
+
+    To keep routine work from starving, waiting jobs age: every aging_seconds
+    spent in the queue raise a job by one priority class. Among equal
+    effective priorities, the job that waited longest runs first.
+
+    With a memory budget, the best job is only dispatched once its memory
+    fits, so no worker thread sits idle waiting for memory. Until then the
+    dispatch is deferred, and made again when memory is released.
+    """
+
+    def __init__(self, job_scheduler, aging_seconds: float = 60, budget=None):
+        self._scheduler = job_scheduler
+        self.aging_seconds = aging_seconds
+        self.budget = budget
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._deferred = 0
+        self._lock = threading.Lock()
+        if budget is not None:
+            budget.add_listener(self._redispatch)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    @staticmethod
+    def normalize_priority(priority) -> str:
+        """ Return a known priority code, defaulting to routine as FHIR does. """
+        return priority if priority in PRIORITIES else PRIORITY_ROUTINE
+
+    def submit(self, func, args=None, kwargs=None, priority=None, memory_bytes: int = 0):
+        """ Queue func(*args, **kwargs) with the given Task.priority, and return the dispatch job.
+
+        The job runs in a copy of the caller's context, so it continues its trace.
+        memory_bytes are reserved from the budget when the job is dispatched;
+        the job then owns them and must release them.
+        """
+        priority = self.normalize_priority(priority)
+        job = (time.monotonic(), time.time_ns(), copy_context(), func, args or [], kwargs or {}, memory_bytes)
+        with self._lock:
+            self._queues[priority].append(job)
+            metrics.set_gauge("queue_length", len(self._queues[priority]), priority=priority)
+        return self._dispatch()
+
+    def _dispatch(self):
+        # A dispatch may wait for a free worker for as long as the queue is
+        # backed up: it must never be dropped as missed, or its job would be
+        # stranded in the queue.
+        return self._scheduler.add_job(self._run_next, misfire_grace_time=None, coalesce=False)
+
+    def _redispatch(self):
+        """ Memory was released: make the deferred dispatches again. """
+        with self._lock:
+            deferred, self._deferred = self._deferred, 0
+            metrics.set_gauge("job_queue_deferred_jobs", 0)
+        for _ in range(deferred):
+            self._dispatch()
+
+    def _pick(self, now: float) -> str:
+        """ Return the priority class whose oldest job should run next. Caller holds the lock. """
+        best = None
+        best_key = None
+        for rank, priority in enumerate(PRIORITIES):
+            if not self._queues[priority]:
+                continue
+            enqueued = self._queues[priority][0][0]
+            waited = now - enqueued
+            effective_rank = rank - (waited / self.aging_seconds if self.aging_seconds else 0)
+            key = (effective_rank, enqueued)
+            if best_key is None or key < best_key:
+                best, best_key = priority, key
+        return best
+
+    def _run_next(self):
+        """ Run the best waiting job. Called once per submitted job. """
+        now = time.monotonic()
+        with self._lock:
+            priority = self._pick(now)
+            if priority is None:
+                return
+            memory_bytes = self._queues[priority][0][6]
+            # Reserved under the queue lock, so a release in between cannot miss this deferral
+            if self.budget is not None and not self.budget.try_acquire(memory_bytes):
+                self._deferred += 1
+                metrics.set_gauge("job_queue_deferred_jobs", self._deferred)
+                return
+            enqueued, enqueued_ns, context, func, args, kwargs, _ = self._queues[priority].popleft()
+            metrics.set_gauge("queue_length", len(self._queues[priority]), priority=priority)
+        wait = now - enqueued
+        metrics.observe("queue_wait_seconds", wait, priority=priority)
+        logger.debug("Running %s job after %.3f s in queue", priority, wait)
+        context.run(self._run_job, priority, enqueued_ns, func, args, kwargs)
+
+    @staticmethod
+    def _run_job(priority, enqueued_ns, func, args, kwargs):
+        tracer.record("queue.wait", enqueued_ns, time.time_ns(), priority=priority)
+        func(*args, **kwargs)
+
+
+job_queue = PriorityJobQueue(scheduler, aging_seconds=args_cache.priority_aging_seconds, budget=memory_budget)
@@ -1,14 +1,20 @@
 import uuid
-from sqlalchemy import create_engine, Column, String, Text
+import threading
+from datetime import datetime, timezone
+from functools import wraps, partial
+from anyio import to_thread
+from sqlalchemy import event, create_engine, Column, String, Text, inspect, text, or_, and_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.pool import StaticPool
 from fhir.resources.task import Task as FHIRTask
 from pathlib import Path
+from typing import Optional
 import re
 
 from fhir2dicom4ortho import logger
 from fhir2dicom4ortho.tasks import TASK_DRAFT
+from fhir2dicom4ortho.tracing import traced
 
 Base = declarative_base()
 
@@ -18,6 +24,67 @@ class Task(Base):
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     description = Column(String)
     fhir_task = Column(Text, nullable=False)
+    # UTC ISO 8601 timestamp of the last change, sortable as a string
+    last_updated = Column(String, index=True, default="")
+
+
+def _timestamp(moment: datetime) -> str:
+    """ Format a datetime as stored in last_updated. Naive datetimes are taken as UTC. """
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _now() -> str:
+    return _timestamp(datetime.now(timezone.utc))
+
+
+def _migrate(engine):
+    """ Add columns introduced after a database was created. """
+    columns = {c["name"] for c in inspect(engine).get_columns(Task.__tablename__)}
+    if "last_updated" not in columns:
+        logger.info("Adding last_updated column to the tasks table")
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE tasks ADD COLUMN last_updated VARCHAR DEFAULT ''"))
+            connection.execute(text("CREATE INDEX IF NOT EXISTS ix_tasks_last_updated ON tasks (last_updated)"))
+
+
+def _synchronized(method):
+    """ Serialize access to the database.
+
+    Jobs run on worker threads, and with the in-memory database every thread
+    shares the same SQLite connection, which cannot interleave transactions.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with TaskStore._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _synchronized_read(method):
+    """ Serialize reads of the in-memory database only.
+
+    A database file gives each thread its own connection, and in WAL mode
+    SQLite lets reads run while another thread commits, so they need not wait
+    for the lock. Writes stay serialized, as modify_task_status reads, changes
+    and writes back the Task.
+    """
+    synchronized = _synchronized(method)
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if TaskStore._shared_connection:
+            return synchronized(self, *args, **kwargs)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _enable_wal(dbapi_connection, connection_record):
+    """ Let readers run while a transaction is being committed to the database file. """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
 
 
 class TaskStore:
@@ -34,6 +101,8 @@ class TaskStore:
     _initialized = False
     _engine = None
     _session_factory = None
+    _lock = threading.RLock()
+    _shared_connection = True
 
     def __new__(cls, db_url=None):
         if cls._instance is None:
@@ -51,9 +120,9 @@ class TaskStore:
                 if file_path != ':memory:':
                     db_path = Path(file_path)
                     db_path.parent.mkdir(parents=True, exist_ok=True)
-                    logger.info(f"All parent directories exist for {db_path.absolute()}")
+                    logger.debug("All parent directories exist for %s", db_path.absolute())
 
-            logger.info(f"Using SQLite database at {db_url}")
+            logger.info("Using SQLite database at %s", db_url)
             
             # Create engine with specific settings for SQLite
             TaskStore._engine = create_engine(
@@ -68,8 +137,13 @@ class TaskStore:
                 poolclass=StaticPool if ':memory:' in db_url else None
             )
             
+            TaskStore._shared_connection = ':memory:' in db_url
+            if not TaskStore._shared_connection:
+                event.listen(TaskStore._engine, "connect", _enable_wal)
+
             # Create all tables
             Base.metadata.create_all(TaskStore._engine)
+            _migrate(TaskStore._engine)
             
             # Create session factory
             TaskStore._session_factory = scoped_session(sessionmaker(bind=TaskStore._engine))
@@ -84,6 +158,8 @@ class TaskStore:
             raise RuntimeError("TaskStore not properly initialized")
         return self.Session()
 
+    @traced("task_store.add_task")
+    @_synchronized
     def add_task(self, fhir_task: FHIRTask):
         """ Add a new task to the store
 
@@ -94,10 +170,13 @@ class TaskStore:
             new_id = str(uuid.uuid4())
             fhir_task.id = new_id
             fhir_task.status = TASK_DRAFT
+            last_updated = _now()
+            fhir_task.lastModified = last_updated
             new_task = Task(
                 id=new_id,
                 description=fhir_task.description,
-                fhir_task=fhir_task.model_dump_json()
+                fhir_task=fhir_task.model_dump_json(),
+                last_updated=last_updated
             )
             session.add(new_task)
             session.commit()
@@ -105,6 +184,33 @@ class TaskStore:
         finally:
             session.close()
 
+    @traced("task_store.add_tasks")
+    @_synchronized
+    def add_tasks(self, fhir_tasks: list) -> list:
+        """ Add many new tasks to the store, in one transaction.
+
+        Like add_task, each task gets a new unique ID, but keeps its status, so
+        a batch is accepted in a single write: either all tasks are stored, or none.
+        """
+        session = self.get_session()
+        try:
+            last_updated = _now()
+            for fhir_task in fhir_tasks:
+                fhir_task.id = str(uuid.uuid4())
+                fhir_task.lastModified = last_updated
+                session.add(Task(
+                    id=fhir_task.id,
+                    description=fhir_task.description,
+                    fhir_task=fhir_task.model_dump_json(),
+                    last_updated=last_updated
+                ))
+            session.commit()
+            return fhir_tasks
+        finally:
+            session.close()
+
+    @traced("task_store.reserve_id")
+    @_synchronized
     def reserve_id(self, description=None, intent="unknown") -> str:
         """ Reserve a new task ID.
 
@@ -116,10 +222,15 @@ class TaskStore:
         """
         session = self.get_session()
         try:
-            fhir_task = FHIRTask.model_construct(
-                status=TASK_DRAFT, description=description, intent=intent)
-            new_task = Task(description=description,
-                            fhir_task=fhir_task.model_dump_json())
+            new_id = str(uuid.uuid4())
+            last_updated = _now()
+            # Validated, so the stored JSON is the same as model_dump_json() of the Task read back
+            fhir_task = FHIRTask(
+                id=new_id, status=TASK_DRAFT, description=description, intent=intent, lastModified=last_updated)
+            new_task = Task(id=new_id,
+                            description=description,
+                            fhir_task=fhir_task.model_dump_json(),
+                            last_updated=last_updated)
             session.add(new_task)
             session.commit()
             reserved_id = new_task.id
@@ -127,6 +238,7 @@ class TaskStore:
         finally:
             session.close()
 
+    @_synchronized_read
     def get_task_by_id(self, task_id) -> Task:
         session = self.get_session()
         try:
@@ -142,8 +254,27 @@ class TaskStore:
             return fhir_task
         return None
 
-    def modify_task_status(self, task_id, new_status) -> FHIRTask:
+    @_synchronized_read
+    def get_task_json(self, task_id) -> Optional[str]:
+        """ The stored JSON of a Task, as written by model_dump_json(), or None if not found.
+
+        For responses that only pass the Task on, without validating it again.
+        """
+        session = self.get_session()
+        try:
+            row = session.query(Task.fhir_task).filter_by(id=task_id).first()
+            return row.fhir_task if row else None
+        finally:
+            session.close()
+
+    @traced("task_store.modify_task_status")
+    @_synchronized
+    def modify_task_status(self, task_id, new_status, output=None, business_status=None) -> FHIRTask:
         """ Modify the status of a task by ID
+
+        If output is given, it replaces Task.output, e.g. with the status of
+        each PACS destination. If business_status is given, it replaces
+        Task.businessStatus, e.g. to tell a timeout from other failures.
         """
         session = self.get_session()
         try:
@@ -151,6 +282,12 @@ class TaskStore:
             if task:
                 fhir_task = FHIRTask.model_validate_json(task.fhir_task)
                 fhir_task.status = new_status
+                if output is not None:
+                    fhir_task.output = output
+                if business_status is not None:
+                    fhir_task.businessStatus = business_status
+                task.last_updated = _now()
+                fhir_task.lastModified = task.last_updated
                 task.fhir_task = fhir_task.model_dump_json()
                 session.add(task)
                 session.commit()
@@ -158,6 +295,7 @@ class TaskStore:
         finally:
             session.close()
 
+    @_synchronized_read
     def get_all_tasks(self):
         """ Retrieve all tasks from the database """
         session = self.get_session()
@@ -168,7 +306,105 @@ class TaskStore:
         finally:
             session.close()
 
+    @_synchronized_read
+    def _get_tasks_json_page(self, since, after, limit) -> list:
+        """ Next page of (last_updated, id, fhir_task) ordered by last_updated and id. """
+        session = self.get_session()
+        try:
+            query = session.query(Task.last_updated, Task.id, Task.fhir_task)
+            if since is not None:
+                query = query.filter(Task.last_updated > since)
+            if after is not None:
+                last_updated, task_id = after
+                query = query.filter(or_(
+                    Task.last_updated > last_updated,
+                    and_(Task.last_updated == last_updated, Task.id > task_id)))
+            return query.order_by(Task.last_updated, Task.id).limit(limit).all()
+        finally:
+            session.close()
+
+    def iter_tasks_json(self, since: datetime = None, chunk_size: int = 500):
+        """ Iterate over the stored JSON of all Tasks, in chunks of at most chunk_size.
+
+        Pages through the table by (last_updated, id), so memory stays flat
+        whatever the table size, and the database is never locked for longer
+        than one page. Yields lists of JSON strings, oldest change first. A
+        Task changed during the export moves to the end, and may be yielded
+        twice: the later one is current.
+
+        Args:
+            since: only Tasks changed after this moment.
+        """
+        if since is not None:
+            since = _timestamp(since)
+        after = None
+        while True:
+            rows = self._get_tasks_json_page(since, after, chunk_size)
+            if not rows:
+                return
+            yield [row.fhir_task for row in rows]
+            if len(rows) < chunk_size:
+                return
+            after = (rows[-1].last_updated, rows[-1].id)
+
+    @_synchronized_read
+    def _get_tasks_json_page_by_id(self, after, limit) -> list:
+        """ Next page of (id, fhir_task) ordered by id. """
+        session = self.get_session()
+        try:
+            query = session.query(Task.id, Task.fhir_task)
+            if after is not None:
+                query = query.filter(Task.id > after)
+            return query.order_by(Task.id).limit(limit).all()
+        finally:
+            session.close()
+
+    def iter_all_tasks_json(self, chunk_size: int = 500):
+        """ Iterate over the stored JSON of all Tasks, in chunks of at most chunk_size.
+
+        Pages through the table by id, which never changes, so every Task is
+        yielded exactly once, even if it changes meanwhile. Yields lists of JSON strings.
+        """
+        after = None
+        while True:
+            rows = self._get_tasks_json_page_by_id(after, chunk_size)
+            if not rows:
+                return
+            yield [row.fhir_task for row in rows]
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1].id
+
     def cleanup(self):
         """Cleanup resources"""
         if hasattr(self, 'Session'):
             self.Session.remove()
+
+
+class AsyncTaskStore:
+    """ Async access to the TaskStore, for the FastAPI handlers.
+
+    Reads run on a worker thread, as with the in-memory database they wait
+    for the lock held by commits. Writes go through run(), together with the
+    rest of the work of the request, so a slow SQLite commit waits there
+    instead of stalling every request on the event loop. The synchronous
+    TaskStore stays the single owner of the database: jobs keep using it
+    directly, and the in-memory database keeps working.
+    """
+
+    def __init__(self, task_store: TaskStore):
+        self.task_store = task_store
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        return await to_thread.run_sync(partial(func, *args, **kwargs))
+
+    async def get_fhir_task_by_id(self, task_id) -> FHIRTask:
+        return await self._run(self.task_store.get_fhir_task_by_id, task_id)
+
+    async def get_task_json(self, task_id) -> Optional[str]:
+        return await self._run(self.task_store.get_task_json, task_id)
+
+    async def run(self, func, *args, **kwargs):
+        """ Run any other blocking work on the TaskStore, e.g. a job submission, off the event loop. """
+        return await self._run(func, *args, **kwargs)
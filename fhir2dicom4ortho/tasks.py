@@ -1,13 +1,32 @@
 """ Module for processing tasks from FHIR resources to DICOM images and sending them to PACS. """
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Union
+
 from fhir.resources.bundle import Bundle
-from fhir.resources.binary import Binary
-from fhir.resources.imagingstudy import ImagingStudy
+from fhir.resources.task import TaskOutput
+from pydicom import Dataset
 
 from dicom4ortho.controller import OrthodonticController
 from dicom4ortho.m_orthodontic_photograph import OrthodonticPhotograph
 # from fhir2dicom4ortho.task_store import TaskStore # Cannot import TaskStore for circular import
 
-from fhir2dicom4ortho.utils import convert_binary_to_dataset, translate_all_scheduled_protocol_codes_to_opor
+from fhir2dicom4ortho.mwl_cache import mwl_cache
+from fhir2dicom4ortho.passthrough import PassThroughOrthodonticPhotograph
+from fhir2dicom4ortho.memory_budget import memory_budget, estimate_job_bytes, IMAGE_HEADER_BYTES
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho.adaptive_concurrency import send_limiters
+from fhir2dicom4ortho.ortho_bundle import OrthoImagingBundle, BundleValidationError, as_ortho_imaging_bundle
+from fhir2dicom4ortho.routing import router, Destination, DEFAULT_DESTINATION
+from fhir2dicom4ortho.dicom_store import dicom_store, DicomUploader, StoreEntry
+from fhir2dicom4ortho.resend_cache import resend_cache
+from fhir2dicom4ortho.binary_store import binary_store
+from fhir2dicom4ortho.job_control import (
+    JobCancelled, StageTimeout, cancel_event, request_cancel, forget, run_stage, wait_for)
+from fhir2dicom4ortho.log_pipeline import task_context
+from fhir2dicom4ortho.tracing import tracer, traced
 from fhir2dicom4ortho import logger, args_cache
 
 TASK_DRAFT = "draft"
@@ -16,35 +35,47 @@ TASK_COMPLETED = "completed"
 TASK_REJECTED = "rejected"
 TASK_FAILED = "failed"
 TASK_INPROGRESS = "in-progress"
+TASK_CANCELLED = "cancelled"
+
+# Statuses a Task never leaves
+TASK_FINAL_STATUSES = (TASK_COMPLETED, TASK_REJECTED, TASK_FAILED, TASK_CANCELLED)
+
+# Task.output type of the send status of each PACS destination
+TASK_OUTPUT_SYSTEM = "http://fhir2dicom4ortho/CodeSystem/task-output"
+TASK_OUTPUT_DESTINATION_STATUS = "destination-status"
+
+# Task.businessStatus of jobs that were stopped, and destination status of a send that timed out
+BUSINESS_STATUS_SYSTEM = "http://fhir2dicom4ortho/CodeSystem/task-business-status"
+BUSINESS_STATUS_TIMED_OUT = "timed-out"
+BUSINESS_STATUS_CANCELLED = "cancelled"
+DESTINATION_TIMED_OUT = "timed-out"
+
+# Builds and sends run on their own threads, so a job can stop waiting for them
+build_executor = ThreadPoolExecutor(max_workers=args_cache.build_threads, thread_name_prefix="f2d4o-build")
+send_executor = ThreadPoolExecutor(max_workers=args_cache.send_threads, thread_name_prefix="f2d4o-send")
 
-def _build_dicom_image(bundle:Bundle, task_id, task_store)-> OrthodonticPhotograph:
+@traced("build")
+def _build_dicom_image(bundle: Union[Bundle, OrthoImagingBundle], task_id, task_store)-> OrthodonticPhotograph:
     """ Build a DICOM image from a FHIR Bundle containing a Binary image, Binary DICOM MWL, a Basic with code..
+
+    Accepts either an OrthoImagingBundle from parse_bundle(), or a Bundle
+    model. Binaries can either be inlined in the Bundle, or uploaded raw with
+    POST /fhir/Binary and referenced as Binary/{id}.
     """
     logger.debug("Extracting Binary resources")
-    image_binary = None
-    dicom_binary = None
-    imagingstudy = None
-
-    for entry in bundle.entry:
-        resource = entry.resource
-        if isinstance(resource, Binary):
-            if resource.contentType.startswith("image/"):
-                image_binary = resource
-            elif resource.contentType == "application/dicom":
-                dicom_binary = resource
-        elif isinstance(resource, ImagingStudy):
-            imagingstudy = ImagingStudy.model_validate(resource)
-
-    if not image_binary or not dicom_binary or not imagingstudy:
+    try:
+        ortho_bundle = as_ortho_imaging_bundle(bundle)
+        image_bytes = ortho_bundle.image.get_bytes()
+        dicom_bytes = ortho_bundle.mwl.get_bytes()
+    except BundleValidationError:
         task_store.modify_task_status(task_id, TASK_REJECTED)
-        raise ValueError("Invalid Bundle: Must contain one image Binary, one DICOM Binary and one ImagingStudy.")
+        raise
+    imagingstudy = ortho_bundle.imaging_study
 
     logger.debug("Converting Binary resources to image and dataset")
     # image = convert_binary_to_image(image_binary)
-    mwl_dataset = convert_binary_to_dataset(dicom_binary)
-        
-    # logger.debug("Getting proper 99OPOR image type code from MWL")
-    mwl_dataset = translate_all_scheduled_protocol_codes_to_opor(mwl_dataset)
+    # Parsed once per MWL, with scheduled protocol codes translated to 99OPOR
+    mwl_dataset = mwl_cache.get(dicom_bytes)
 
     logger.debug("Building OrthodonticPhotograph")
     try:
@@ -77,9 +108,10 @@ def _build_dicom_image(bundle:Bundle, task_id, task_store)-> OrthodonticPhotogra
     if hasattr(instance0, 'number'):
         instance0_number = instance0.number
 
-    orthodontic_photograph:OrthodonticPhotograph = OrthodonticPhotograph(
+    photograph_class = PassThroughOrthodonticPhotograph if args_cache.image_passthrough else OrthodonticPhotograph
+    orthodontic_photograph:OrthodonticPhotograph = photograph_class(
         sop_instance_uid=instance0_uid,
-        input_image_bytes=image_binary.data,
+        input_image_bytes=image_bytes,
         dicom_mwl=mwl_dataset
     )
         
@@ -93,49 +125,360 @@ def _build_dicom_image(bundle:Bundle, task_id, task_store)-> OrthodonticPhotogra
     if series0_started:
         orthodontic_photograph.series_datetime = series0_started
     orthodontic_photograph.set_dicom_attributes_by_type_keyword()
-    orthodontic_photograph.prepare()
+    with tracer.span("photograph.prepare"):
+        orthodontic_photograph.prepare()
 
     return orthodontic_photograph
 
-def _send_dicom_image(orthodontic_photograph:OrthodonticPhotograph):
-    """ Send a DICOM image to PACS
-    
+def _send_dataset(dataset: Dataset, destination: Destination = None):
+    """ Send a DICOM dataset to PACS
+
+    Args:
+        destination: where to send the dataset. Defaults to the PACS configured with F2D4O_PACS_*.
+
     Returns:
         response: Response from PACS. Either a DIMSE response or a WADO response
     """
-    logger.debug("Sending OrthodonticPhotograph to PACS")
+    if destination is None:
+        destination = router.destinations[DEFAULT_DESTINATION]
+    logger.debug("Sending OrthodonticPhotograph to PACS %s", destination.name)
     controller = OrthodonticController()
-    return controller.send(
-        send_method=args_cache.pacs_send_method,
-        pacs_dimse_hostname=args_cache.pacs_dimse_hostname,
-        pacs_dimse_port=args_cache.pacs_dimse_port,
-        pacs_dimse_aet=args_cache.pacs_dimse_aet,
-        pacs_wado_url=args_cache.pacs_wado_url,
-        pacs_wado_username=args_cache.pacs_wado_username,
-        pacs_wado_password=args_cache.pacs_wado_password,
-        dicom_datasets=[orthodontic_photograph.to_dataset()]
-    )
+    with tracer.span("send", destination=destination.name, send_method=destination.send_method):
+        return controller.send(
+            dicom_datasets=[dataset],
+            **destination.send_kwargs()
+        )
+
+
+def _send_dicom_image(orthodontic_photograph:OrthodonticPhotograph, destination: Destination = None):
+    """ Send a DICOM image to PACS
+
+    Returns:
+        response: Response from PACS. Either a DIMSE response or a WADO response
+    """
+    return _send_dataset(orthodontic_photograph.to_dataset(), destination)
+
+
+def _send_once(dataset: Dataset, destination: Destination) -> str:
+    """ Send to one destination and return the resulting Task status. Never raises. """
+    try:
+        status = _get_status_from_response(_send_dataset(dataset, destination))
+    except Exception as e:
+        logger.exception(e)
+        logger.error("Error sending to PACS %s: %s", destination.name, e)
+        status = TASK_FAILED
+    metrics.inc("destination_sends", destination=destination.name, status=status)
+    return status
+
+
+def _send_to_destination(dataset: Dataset, destination: Destination) -> str:
+    """ Send to one destination in this thread, once the adaptive concurrency limit of the destination allows it. """
+    with send_limiters.get(destination.name).slot() as outcome:
+        status = _send_once(dataset, destination)
+        outcome["success"] = status == TASK_COMPLETED
+    return status
+
+
+def _is_completed(status: str) -> bool:
+    return status == TASK_COMPLETED
+
+
+def _send_to_destinations(dataset: Dataset, destinations: list, timeout: float = None,
+                          cancelled: threading.Event = None, abandoned: list = None) -> dict:
+    """ Send a DICOM dataset to all destinations concurrently.
+
+    Args:
+        timeout: seconds to wait for all sends. Sends still running then get
+            the DESTINATION_TIMED_OUT status, and their futures are appended
+            to abandoned.
+        cancelled: event set when the Task is cancelled.
+
+    Returns:
+        dict of destination name to Task status, in the order of destinations.
+
+    Raises:
+        JobCancelled: if cancelled was set while sending.
+    """
+    if len(destinations) == 1 and not timeout and cancelled is None:
+        return {destinations[0].name: _send_to_destination(dataset, destinations[0])}
+    futures = {
+        # Each send waits for a slot of its destination before it takes a thread,
+        # and logs with the Task id of the job
+        destination.name: send_limiters.get(destination.name).submit(
+            send_executor, copy_context().run, _send_once, dataset, destination, succeeded=_is_completed)
+        for destination in destinations
+    }
+    done = wait_for(list(futures.values()), "send", timeout, cancelled)
+    statuses = {}
+    for name, future in futures.items():
+        if future in done:
+            statuses[name] = future.result()
+            continue
+        logger.error("Send to PACS %s did not finish in %s s", name, timeout)
+        future.cancel()
+        if abandoned is not None:
+            abandoned.append(future)
+        statuses[name] = DESTINATION_TIMED_OUT
+    return statuses
+
+
+def _send_stored(dataset: Dataset, names: list) -> dict:
+    """ Send a dataset from the local DICOM store to the named destinations. """
+    statuses = {name: TASK_FAILED for name in names if name not in router.destinations}
+    for name in statuses:
+        logger.error("PACS destination %s is no longer configured", name)
+    statuses.update(_send_to_destinations(
+        dataset, [router.destinations[n] for n in names if n in router.destinations],
+        timeout=args_cache.send_timeout))
+    return statuses
+
 
+def _report_stored(task_store, entry: StoreEntry, final: bool):
+    """ Record the status of a Task after an upload attempt from the local DICOM store. """
+    fhir_task = task_store.get_fhir_task_by_id(entry.task_id)
+    if fhir_task is not None and fhir_task.status == TASK_CANCELLED:
+        return
+    if not entry.pending():
+        task_status = TASK_COMPLETED
+    elif final:
+        task_status = TASK_FAILED
+    else:
+        task_status = TASK_INPROGRESS
+    task_store.modify_task_status(entry.task_id, task_status, output=_destination_outputs(entry.destinations))
+    logger.info("Task %s %s", entry.task_id, task_status)
 
-def build_and_send_dicom_image(bundle:Bundle, task_id, task_store):
+
+def _business_status(code: str) -> dict:
+    """ Task.businessStatus CodeableConcept """
+    return {"coding": [{"system": BUSINESS_STATUS_SYSTEM, "code": code}], "text": code}
+
+
+def _destination_outputs(statuses: dict) -> list:
+    """ One Task.output per destination, with its send status """
+    return [
+        TaskOutput(
+            type={
+                "coding": [{"system": TASK_OUTPUT_SYSTEM, "code": TASK_OUTPUT_DESTINATION_STATUS}],
+                "text": name},
+            valueCode=status)
+        for name, status in statuses.items()
+    ]
+
+
+def estimate_bundle_bytes(bundle: Union[Bundle, OrthoImagingBundle]) -> int:
+    """ Estimate the peak memory of a job from the sizes and the image header. """
+    try:
+        ortho_bundle = as_ortho_imaging_bundle(bundle)
+    except BundleValidationError:
+        # _build_dicom_image will reject it without doing any work
+        return 0
+    return estimate_job_bytes(
+        ortho_bundle.image.size,
+        ortho_bundle.image.head(IMAGE_HEADER_BYTES),
+        ortho_bundle.mwl.size,
+        passthrough=args_cache.image_passthrough)
+
+
+def _store_for_upload(orthodontic_photograph:OrthodonticPhotograph, destinations: list, task_id, task_store):
+    """ Write the image to the local DICOM store, and let the uploader send it. """
+    entry = dicom_store.write(orthodontic_photograph.to_dataset(), task_id, [d.name for d in destinations])
+    task_store.modify_task_status(task_id, TASK_INPROGRESS, output=_destination_outputs(entry.destinations))
+    dicom_uploader.start(task_store)
+    dicom_uploader.wake()
+    logger.info("Task %s stored for upload", task_id)
+
+
+def _cache_for_resend(dataset: Dataset, statuses: dict, task_id, task_store, business_status=None):
+    """ Keep the image of a failed send in the resend cache, and let the resend uploader retry it.
+
+    The Task stays in progress only while its image is cached. An image too
+    large for the cache, or evicted before the Task is updated, fails the Task
+    as it would without the cache.
+    """
+    entry = resend_cache.write(dataset, task_id, statuses)
+    if entry is not None:
+        # The send just made counts as the first attempt
+        entry.attempts = 1
+        entry.next_attempt = time.time() + resend_uploader.retry_delay
+    if entry is not None and resend_cache.save_entry(entry):
+        task_store.modify_task_status(
+            task_id, TASK_INPROGRESS, output=_destination_outputs(entry.destinations), business_status=business_status)
+        # Evicted meanwhile, its failure may have been reported before this update
+        if resend_cache.find(task_id):
+            resend_uploader.start(task_store)
+            logger.info("Task %s cached for resending to %s", task_id, ", ".join(entry.pending()))
+            return
+    task_store.modify_task_status(
+        task_id, TASK_FAILED, output=_destination_outputs(statuses), business_status=business_status)
+    logger.info("Task %s %s", task_id, TASK_FAILED)
+
+
+def _report_evicted(entry: StoreEntry):
+    """ A Task whose image was dropped from the resend cache before all sends succeeded has failed. """
+    if resend_uploader.task_store is not None:
+        _report_stored(resend_uploader.task_store, entry, True)
+
+
+def _release_when_done(futures: list, size: int):
+    """ Give size bytes back to the memory budget once all futures are done. """
+    if not futures:
+        memory_budget.release(size)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            memory_budget.release(size)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def _release_binaries(bundle: Union[Bundle, OrthoImagingBundle]):
+    """ The job is done with the Binaries uploaded for it: let the spool purge them once they expire. """
+    try:
+        spooled_ids = as_ortho_imaging_bundle(bundle).spooled_ids()
+    except BundleValidationError:
+        return
+    binary_store.release(spooled_ids)
+
+
+def cancel_task(task_id, task_store):
+    """ Cancel a Task: stop its job, whether running or queued, and drop any image waiting for upload. """
+    request_cancel(task_id)
+    stored = False
+    for store in (dicom_store, resend_cache):
+        if store is not None:
+            for entry in store.find(task_id):
+                store.delete(entry)
+                stored = True
+    if stored:
+        # The job ended once it stored its image, so no job is left to drop the cancel event
+        forget(task_id)
+    logger.info("Task %s cancelled", task_id)
+    return task_store.modify_task_status(
+        task_id, TASK_CANCELLED, business_status=_business_status(BUSINESS_STATUS_CANCELLED))
+
+
+def resend_task(task_id, task_store):
+    """ Send the built image of a Task again, from the local DICOM store or the resend cache.
+
+    Returns the Task, in progress again, or None if no image of the Task is kept.
+    """
+    for store, uploader in ((dicom_store, dicom_uploader), (resend_cache, resend_uploader)):
+        if store is None or not store.requeue(task_id):
+            continue
+        uploader.start(task_store)
+        uploader.wake()
+        logger.info("Task %s queued for resending", task_id)
+        return task_store.modify_task_status(task_id, TASK_INPROGRESS)
+    return None
+
+
+def build_and_send_dicom_image(bundle: Union[Bundle, OrthoImagingBundle], task_id, task_store,
+                               reserved_bytes: int = None):
     """ Build a DICOM image and send it to PACS from a FHIR Bundle containing a Binary image, Binary DICOM MWL, a Basic with code..
+
+    The job needs its estimated memory to fit in the global memory budget.
+    The job queue reserves it before dispatching the job, and passes it as
+    reserved_bytes, which the job releases. Called directly, the job waits
+    for the memory itself.
+    The image is sent to every destination picked by the router, and the
+    status of each destination is recorded in Task.output. With a local DICOM
+    store, the image is written there instead and uploaded in the background.
+    With a resend cache, the image of a failed send is kept there and the
+    failed destinations are retried in the background, without rebuilding.
+
+    Building and sending each have a deadline (F2D4O_BUILD_TIMEOUT,
+    F2D4O_SEND_TIMEOUT). A job past its deadline, or whose Task is cancelled,
+    stops waiting and frees its worker thread at once.
+
+    Everything logged by the job, its build and its sends carries the Task id,
+    and is traced in the span of the job.
     """
-    logger.info(f"Processing Task: {task_id}")
+    with task_context(task_id), tracer.span("job"):
+        _build_and_send_dicom_image(bundle, task_id, task_store, reserved_bytes)
+
+
+def _build_and_send_dicom_image(bundle: Union[Bundle, OrthoImagingBundle], task_id, task_store,
+                                reserved_bytes: int = None):
+    """ The job of build_and_send_dicom_image, in the context of its Task. """
+    cancelled = cancel_event(task_id)
+    if cancelled.is_set():
+        logger.info("Task %s was cancelled before it started", task_id)
+        if reserved_bytes is not None:
+            memory_budget.release(reserved_bytes)
+        _release_binaries(bundle)
+        forget(task_id)
+        return
+
+    logger.info("Processing Task: %s", task_id)
     task_store.modify_task_status(task_id, TASK_INPROGRESS)
 
+    job_bytes = reserved_bytes or 0
+    reserved = reserved_bytes is not None
+    abandoned = []
     try:
-        orthodontic_photograph = _build_dicom_image(bundle, task_id, task_store)
-        result = _send_dicom_image(orthodontic_photograph)
+        if not reserved:
+            job_bytes = estimate_bundle_bytes(bundle)
+            memory_budget.acquire(job_bytes)
+            reserved = True
+        metrics.observe("job_estimated_bytes", job_bytes)
+        orthodontic_photograph = run_stage(
+            build_executor, "build", _build_dicom_image, bundle, task_id, task_store,
+            timeout=args_cache.build_timeout, cancelled=cancelled)
+        with tracer.span("photograph.to_dataset"):
+            dataset = orthodontic_photograph.to_dataset()
+        metrics.observe("job_dataset_bytes", len(dataset.PixelData))
+        destinations = router.route(as_ortho_imaging_bundle(bundle).task, orthodontic_photograph.dicom_mwl)
+        if dicom_store is not None:
+            _store_for_upload(orthodontic_photograph, destinations, task_id, task_store)
+            return
+        statuses = _send_to_destinations(
+            dataset, destinations,
+            timeout=args_cache.send_timeout, cancelled=cancelled, abandoned=abandoned)
 
-        task_status = _get_status_from_response(result)
+        # Completed only once every destination has the image
+        if all(status == TASK_COMPLETED for status in statuses.values()):
+            task_status = TASK_COMPLETED
+        else:
+            task_status = TASK_FAILED
+        business_status = None
+        if DESTINATION_TIMED_OUT in statuses.values():
+            business_status = _business_status(BUSINESS_STATUS_TIMED_OUT)
 
-        logger.debug(f"Setting Task status to {task_status}")
-        task_store.modify_task_status(task_id, task_status)
-        logger.info(f"Task {task_id} {task_status}")
+        if cancelled.is_set():
+            # Cancelled after the last send finished: the cancellation stands.
+            return
+        if task_status == TASK_FAILED and resend_cache is not None:
+            _cache_for_resend(dataset, statuses, task_id, task_store, business_status)
+            return
+        logger.debug("Setting Task status to %s", task_status)
+        task_store.modify_task_status(
+            task_id, task_status, output=_destination_outputs(statuses), business_status=business_status)
+        logger.info("Task %s %s", task_id, task_status)
+    except JobCancelled as e:
+        abandoned.extend(e.futures)
+        logger.info("Task %s %s", task_id, e)
+    except StageTimeout as e:
+        abandoned.extend(e.futures)
+        logger.error("Task %s timed out: %s", task_id, e)
+        task_store.modify_task_status(
+            task_id, TASK_FAILED, business_status=_business_status(BUSINESS_STATUS_TIMED_OUT))
     except Exception as e:
         task_store.modify_task_status(task_id, TASK_FAILED)
         logger.exception(e)
-        logger.error(f"Error processing Bundle: {e}")
+        logger.error("Error processing Bundle: %s", e)
+    finally:
+        # The memory of abandoned stages is only free once they really end.
+        if reserved:
+            _release_when_done(abandoned, job_bytes)
+        _release_binaries(bundle)
+        forget(task_id)
 
 def _get_status_from_response(response):
     """ Set the status of a task from a response object
@@ -153,4 +496,21 @@ def _get_status_from_response(response):
         if response.status_code == 200:
             return TASK_COMPLETED
     
-    return TASK_FAILED
\ No newline at end of file
+    return TASK_FAILED
+
+
+dicom_uploader = DicomUploader(
+    dicom_store, _send_stored, _report_stored,
+    max_attempts=args_cache.upload_max_attempts,
+    retry_delay=args_cache.upload_retry_delay,
+    threads=args_cache.upload_threads)
+
+# Retries failed sends from the resend cache, with the same policy as the local DICOM store
+resend_uploader = DicomUploader(
+    resend_cache, _send_stored, _report_stored,
+    max_attempts=args_cache.upload_max_attempts,
+    retry_delay=args_cache.upload_retry_delay,
+    threads=args_cache.upload_threads,
+    name="resend_cache")
+if resend_cache is not None:
+    resend_cache.on_evict = _report_evicted
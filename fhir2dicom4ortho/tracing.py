@@ -0,0 +1,257 @@
+""" Lightweight tracing of Tasks from ingest to PACS.
+
+Spans are timed around each step a Task goes through: the Bundle handler,
+scheduling, the wait in the queue, building the image and sending it, and the
+TaskStore writes. The current span is kept in a context variable, and jobs,
+stages and sends run in copies of the context of the code that started them,
+so all spans of a Task end up in one trace. Every span carries the Task id of
+its context, and the trace id is recorded in an extension of the Task.
+
+Finished spans are queued and exported in batches by a background thread:
+- to a file (F2D4O_TRACE_FILE), one span per line as JSON;
+- to an OTLP/HTTP collector (F2D4O_TRACE_OTLP_URL), as OTLP JSON.
+
+With neither set, tracing is off and spans cost a context variable lookup.
+"""
+import atexit
+import json
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+
+import httpx
+
+from fhir2dicom4ortho.log_pipeline import task_id_var
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho import logger, args_cache
+
+SERVICE_NAME = "fhir2dicom4ortho"
+
+# Task.extension holding the trace id of the Task
+TRACE_ID_EXTENSION_URL = "http://fhir2dicom4ortho/StructureDefinition/trace-id"
+
+# How often queued spans are exported, and how many at most are kept waiting
+EXPORT_INTERVAL = 1.0
+MAX_QUEUED_SPANS = 10000
+
+# OTLP status codes
+OTLP_STATUS_OK = 1
+OTLP_STATUS_ERROR = 2
+
+
+class Span:
+    """ A timed step of a trace. """
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, start_ns: Optional[int] = None,
+                 attributes: Optional[dict] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        """ The span as one line of the trace file. """
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> dict:
+        """ The span in OTLP JSON encoding. """
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": OTLP_STATUS_ERROR, "message": self.error} if self.error else {"code": OTLP_STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class FileExporter:
+    """ Append spans to a file, one JSON object per line. """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans))
+
+
+class OtlpHttpExporter:
+    """ POST spans to an OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces, as OTLP JSON. """
+
+    def __init__(self, url: str, client: Optional[httpx.Client] = None, timeout: float = 10):
+        self.url = url
+        self.client = client or httpx.Client(timeout=timeout)
+
+    @staticmethod
+    def payload(spans: list) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+
+    def export(self, spans: list):
+        response = self.client.post(self.url, json=self.payload(spans))
+        response.raise_for_status()
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """ Creates spans and exports them in the background.
+
+    Args:
+        exporters: where finished spans go. Without any, tracing is off.
+    """
+
+    def __init__(self, exporters: Optional[list] = None):
+        self.exporters = list(exporters or [])
+        self._queue = deque(maxlen=MAX_QUEUED_SPANS)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    @staticmethod
+    def trace_id() -> Optional[str]:
+        """ Id of the trace of the current span, if any. """
+        span = current_span.get()
+        return span.trace_id if span is not None else None
+
+    def _new_span(self, name: str, start_ns: Optional[int], attributes: dict) -> Span:
+        parent = current_span.get()
+        task_id = task_id_var.get()
+        if task_id and "task.id" not in attributes:
+            attributes["task.id"] = task_id
+        if parent is None:
+            return Span(name, secrets.token_hex(16), None, start_ns, attributes)
+        return Span(name, parent.trace_id, parent.span_id, start_ns, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """ Time the block as a span, child of the current one. Yields the Span, or None when tracing is off. """
+        if not self.enabled:
+            yield None
+            return
+        span = self._new_span(name, None, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            current_span.reset(token)
+            self._emit(span)
+
+    def record(self, name: str, start_ns: int, end_ns: int, **attributes):
+        """ Record a span that already ended, e.g. the time a job spent in the queue. """
+        if not self.enabled:
+            return
+        span = self._new_span(name, start_ns, attributes)
+        span.end_ns = end_ns
+        self._emit(span)
+
+    def _emit(self, span: Span):
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                metrics.inc("trace_spans_dropped")
+            self._queue.append(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="f2d4o-tracer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(EXPORT_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """ Export all queued spans now. """
+        with self._lock:
+            spans = list(self._queue)
+            self._queue.clear()
+        if not spans:
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception as e:
+                metrics.inc("trace_export_errors")
+                logger.warning("Could not export %d spans with %s: %s", len(spans), type(exporter).__name__, e)
+        metrics.inc("trace_spans_exported", len(spans))
+
+
+def traced(name: str):
+    """ Decorator timing every call of a function as a span. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_id_extension(trace_id: str) -> dict:
+    """ Task.extension recording the trace id of a Task. """
+    return {"url": TRACE_ID_EXTENSION_URL, "valueString": trace_id}
+
+
+def _exporters_from_args(args) -> list:
+    exporters = []
+    if args.trace_file:
+        exporters.append(FileExporter(args.trace_file))
+    if args.trace_otlp_url:
+        exporters.append(OtlpHttpExporter(args.trace_otlp_url))
+    return exporters
+
+
+tracer = Tracer(_exporters_from_args(args_cache))
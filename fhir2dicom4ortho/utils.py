@@ -14,20 +14,20 @@ def convert_binary_to_image(binary: Binary) -> Image:
     """
     image_data = binary.data
 
-    logger.debug(f"Decoded image data length: {len(image_data)}")
-    logger.debug(f"Content type: {binary.contentType}")
-    logger.debug(f"First 20 bytes of image data: {image_data[:20]}")
+    logger.debug("Decoded image data length: %s", len(image_data))
+    logger.debug("Content type: %s", binary.contentType)
+    logger.debug("First 20 bytes of image data: %s", image_data[:20])
 
     # Create a BytesIO stream from the decoded data
     image_stream = BytesIO(image_data)
 
     # Open the image using PIL
     image = Image.open(image_stream)
-    logger.debug(f"Image format: {image.format}")
+    logger.debug("Image format: %s", image.format)
     # If the content type is provided, use it to establish the kind of image
     if binary.contentType:
         image_format = binary.contentType.split('/')[-1].upper()
-        logger.debug(f"Image format: {image_format}")
+        logger.debug("Image format: %s", image_format)
         image.format = image_format
 
     return image
@@ -56,7 +56,7 @@ def get_opor_code_value_from_code(image_type_code):
         if hasattr(image_type_code, 'CodingSchemeDesignator'):
             if image_type_code.CodingSchemeDesignator == "99OPOR":
                 if hasattr(image_type_code, 'CodeValue'):
-                    logger.debug(f"Code is a valid OPOR code: {image_type_code.CodeValue}")
+                    logger.debug("Code is a valid OPOR code: %s", image_type_code.CodeValue)
                     image_type = image_type_code.CodeValue
                     return image_type
             else:
@@ -76,19 +76,22 @@ def translate_code_to_opor(code:Dataset) -> Dataset:
     Assumes code is a valid DICOM Code, with CodeValue, CodeMeaning, and CodeSchemeDesignator.
     '''
     # TODO: Implement this function
-    logger.warning(f"Translate Code: Function not implemented. Returning whatever code {code.CodeValue} was passed.")
+    logger.warning("Translate Code: Function not implemented. Returning whatever code %s was passed.", code.CodeValue)
     return code
 
     
 def convert_binary_to_dataset(binary: Binary) -> Dataset:
     """ Convert a FHIR Binary resource to a pydicom Dataset object."""
     # Decode the base64 data
-    dicom_data = binary.data
+    return convert_bytes_to_dataset(binary.data)
 
+
+def convert_bytes_to_dataset(dicom_data: bytes) -> Dataset:
+    """ Convert raw DICOM bytes to a pydicom Dataset object."""
     # Create a BytesIO stream from the decoded data
     dicom_stream = BytesIO(dicom_data)
 
     # Read the DICOM dataset from the stream
     dataset = dcmread(dicom_stream)
 
-    return dataset
\ No newline at end of file
+    return dataset
@@ -25,3 +25,23 @@ with open(json_file_path, 'r') as f:
 # Load instance values representing 3 different images
 with open(json_instances_path, 'r') as f:
     test_instances = json.load(f)
+
+
+def batch_bundle(count: int) -> dict:
+    """ A batch Bundle of count copies of the Task set of test_bundle, each with its own ids. """
+    import copy
+    entries = []
+    for n in range(count):
+        group = copy.deepcopy(test_bundle["entry"])
+        ids = {}
+        for entry in group:
+            resource = entry["resource"]
+            new_id = f"{resource['id']}-{n:04d}"
+            ids[f"{resource['resourceType']}/{resource['id']}"] = f"{resource['resourceType']}/{new_id}"
+            resource["id"] = new_id
+            entry["fullUrl"] = f"urn:uuid:{new_id}"
+        for task_input in group[0]["resource"]["input"]:
+            reference = task_input["valueReference"]
+            reference["reference"] = ids[reference["reference"]]
+        entries.extend(group)
+    return {"resourceType": "Bundle", "type": "batch", "entry": entries}
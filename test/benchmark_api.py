@@ -0,0 +1,140 @@
+""" Benchmark request latency of the FHIR API under concurrent POST + GET load.
+
+Posts Bundles and reads Tasks at the same time, and reports the latency of
+each kind of request. If the handlers block the event loop, GET latency
+climbs with every concurrent POST.
+
+Runs the app in process by default. Jobs are not run, so only the API is
+measured. In process, the lag of the event loop is reported too: how late a
+task that wakes up every millisecond runs, i.e. how long the loop was stalled. --commit-delay adds a sleep to every TaskStore commit, to see how
+the API behaves on a slow disk. Pass --url to benchmark a running server
+instead.
+
+    python -m test.benchmark_api --posts 200 --gets 1000 --concurrency 20
+    python -m test.benchmark_api --commit-delay 0.02
+    python -m test.benchmark_api --image-bytes 8000000   # an 8 MB photo inline
+    python -m test.benchmark_api --batch 8 --posts 5     # POST /fhir with 8 Task sets each
+"""
+import argparse
+import asyncio
+import base64
+import copy
+import json
+import random
+import statistics
+import time
+from unittest import mock
+
+import httpx
+from sqlalchemy.orm import Session
+
+import test
+from fhir2dicom4ortho import fhir_api
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(name, latencies):
+    if not latencies:
+        return
+    ms = [1000 * latency for latency in latencies]
+    print(f"{name:5} n={len(ms):5}  p50={percentile(ms, 0.5):7.1f} ms  p95={percentile(ms, 0.95):7.1f} ms  "
+          f"max={max(ms):7.1f} ms  mean={statistics.mean(ms):7.1f} ms")
+
+
+def bundle_body(image_bytes: int, batch: int = 0) -> bytes:
+    """ The test Bundle, or a batch of that many Task sets, with an image of image_bytes random bytes inline if not 0. """
+    bundle = test.batch_bundle(batch) if batch else copy.deepcopy(test.test_bundle)
+    if image_bytes:
+        for entry in bundle["entry"]:
+            resource = entry["resource"]
+            if resource["resourceType"] == "Binary" and resource["contentType"].startswith("image/"):
+                resource["data"] = base64.b64encode(random.Random(0).randbytes(image_bytes)).decode()
+    return json.dumps(bundle).encode()
+
+
+async def run(client: httpx.AsyncClient, posts: int, gets: int, concurrency: int, image_bytes: int = 0,
+              batch: int = 0):
+    body = bundle_body(image_bytes, batch)
+    post_url = "/fhir" if batch else "/fhir/Bundle"
+    headers = {"Content-Type": "application/json"}
+    response = await client.post("/fhir/Bundle", content=bundle_body(0), headers=headers)
+    response.raise_for_status()
+    task_id = response.json()["id"]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = {"POST": [], "GET": []}
+    lags = []
+
+    async def probe_lag():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    async def request(method, url, **kwargs):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies[method].append(time.perf_counter() - started)
+            response.raise_for_status()
+
+    # Interleave POSTs and GETs, the same way on every run
+    kinds = ["POST"] * posts + ["GET"] * gets
+    random.Random(0).shuffle(kinds)
+    requests = [
+        request("POST", post_url, content=body, headers=headers) if kind == "POST"
+        else request("GET", f"/fhir/Task/{task_id}")
+        for kind in kinds
+    ]
+    probe = asyncio.create_task(probe_lag())
+    started = time.perf_counter()
+    await asyncio.gather(*requests)
+    elapsed = time.perf_counter() - started
+    probe.cancel()
+
+    print(f"{posts} POST {post_url} ({len(body)} bytes) + {gets} GET /fhir/Task/{{id}}, "
+          f"{concurrency} concurrent, {elapsed:.2f} s")
+    report("POST", latencies["POST"])
+    report("GET", latencies["GET"])
+    report("lag", lags)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a running server, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--posts", type=int, default=100)
+    parser.add_argument("--gets", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--commit-delay", type=float, default=0,
+                        help="seconds added to every TaskStore commit, in process only")
+    parser.add_argument("--image-bytes", type=int, default=0,
+                        help="size of a random image to put inline in the posted Bundle, instead of the test image")
+    parser.add_argument("--batch", type=int, default=0,
+                        help="post batches of this many Task sets to POST /fhir instead")
+    args = parser.parse_args()
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+            await run(client, args.posts, args.gets, args.concurrency, args.image_bytes, args.batch)
+        return
+
+    commit = Session.commit
+
+    def slow_commit(session):
+        time.sleep(args.commit_delay)
+        commit(session)
+
+    transport = httpx.ASGITransport(app=fhir_api.fhir_api_app)
+    with mock.patch.object(fhir_api.job_queue, "submit", return_value=mock.Mock(id="benchmark")), \
+            mock.patch.object(Session, "commit", slow_commit):
+        async with fhir_api.lifespan(fhir_api.fhir_api_app):
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+                await run(client, args.posts, args.gets, args.concurrency, args.image_bytes, args.batch)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
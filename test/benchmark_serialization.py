@@ -0,0 +1,90 @@
+""" Benchmark Task serialization: pydantic round trip against splicing the stored JSON.
+
+For searchsets of 1k and 10k Tasks, compares building the Bundle as
+GET /fhir/Task used to, validating every stored Task and serializing a
+Bundle model, with searchset_json(), which splices the stored JSON. Also
+compares reading one Task. Tasks look like finished jobs: with a trace id
+extension and the status of two destinations.
+
+    python -m test.benchmark_serialization --sizes 1000 10000 --repeat 3
+
+The pydantic round trip of 10k Tasks takes minutes.
+"""
+import argparse
+import copy
+import json
+import time
+import uuid
+
+from fhir.resources.bundle import Bundle, BundleEntry
+from fhir.resources.task import Task
+
+import test
+from fhir2dicom4ortho.fhir_api import searchset_json
+from fhir2dicom4ortho.tasks import _destination_outputs, TASK_COMPLETED
+from fhir2dicom4ortho.tracing import trace_id_extension
+
+CHUNK_SIZE = 500
+
+
+def stored_tasks(count: int) -> list:
+    """ JSON of count finished Tasks, as stored by the TaskStore. """
+    resource = copy.deepcopy(test.test_bundle["entry"][0]["resource"])
+    task = Task.model_validate(resource)
+    task.status = TASK_COMPLETED
+    task.lastModified = "2024-11-15T12:00:00.000000+00:00"
+    task.extension = [trace_id_extension(uuid.uuid4().hex)]
+    task.output = _destination_outputs({"default": TASK_COMPLETED, "archive": TASK_COMPLETED})
+    task_jsons = []
+    for _ in range(count):
+        task.id = str(uuid.uuid4())
+        task_jsons.append(task.model_dump_json())
+    return task_jsons
+
+
+def round_trip_searchset(task_jsons: list) -> bytes:
+    tasks = [Task.model_validate_json(task_json) for task_json in task_jsons]
+    bundle = Bundle(type="searchset", total=len(tasks), entry=[BundleEntry(resource=task) for task in tasks])
+    return bundle.model_dump_json().encode()
+
+
+def spliced_searchset(task_jsons: list) -> bytes:
+    chunks = (task_jsons[i:i + CHUNK_SIZE] for i in range(0, len(task_jsons), CHUNK_SIZE))
+    return b"".join(searchset_json(chunks))
+
+
+def best_of(repeat: int, func, *args) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each case; the best is reported")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        task_jsons = stored_tasks(size)
+        # Both produce the same Bundle
+        sample = task_jsons[:100]
+        assert json.loads(round_trip_searchset(sample)) == json.loads(spliced_searchset(sample))
+        round_trip = best_of(args.repeat, round_trip_searchset, task_jsons)
+        spliced = best_of(args.repeat, spliced_searchset, task_jsons)
+        print(f"searchset of {size:6} Tasks: round trip {1000 * round_trip:8.1f} ms, "
+              f"spliced {1000 * spliced:7.1f} ms, {round_trip / spliced:6.1f}x faster")
+
+    task_json = stored_tasks(1)[0]
+    reads = 1000
+    round_trip = best_of(args.repeat, lambda: [Task.model_validate_json(task_json).model_dump_json() for _ in range(reads)])
+    spliced = best_of(args.repeat, lambda: [task_json.encode() for _ in range(reads)])
+    print(f"one Task, per read:          round trip {1e6 * round_trip / reads:8.1f} us, "
+          f"spliced {1e6 * spliced / reads:7.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,11 +10,15 @@ from fhir.resources.bundle import Bundle
 from fastapi.testclient import TestClient
 import os
 import copy
+import base64
+import gzip
+import json
+from unittest import mock
 
 from fhir2dicom4ortho.fhir_api import fhir_api_app, get_task_store
-from fhir2dicom4ortho.tasks import TASK_COMPLETED, TASK_FAILED, build_and_send_dicom_image
+from fhir2dicom4ortho.tasks import TASK_COMPLETED, TASK_FAILED, TASK_INPROGRESS, build_and_send_dicom_image, _build_dicom_image
 from fhir2dicom4ortho.task_store import TaskStore
-from fhir2dicom4ortho import logger
+from fhir2dicom4ortho import logger, tracing
 from fhir2dicom4ortho.entry_points import setup_logging
 
 
@@ -117,6 +121,80 @@ class TestFHIRAPI(unittest.TestCase):
                 logger.exception("Failed to process bundle task")
                 raise
 
+    def test_upload_binary(self):
+        """ Upload image and MWL as raw Binaries, and reference them from a Bundle without inlined data. """
+        bundle = copy.deepcopy(test.test_bundle)
+        binary_entries = [e for e in bundle["entry"] if e["resource"]["resourceType"] == "Binary"]
+        task_resource = bundle["entry"][0]["resource"]
+        task_resource["input"] = []
+        for entry in binary_entries:
+            binary = entry["resource"]
+            response = self.client.post(
+                "/fhir/Binary",
+                content=base64.b64decode(binary["data"]),
+                headers={"Content-Type": binary["contentType"]})
+            self.assertEqual(response.status_code, 201)
+            response_data = response.json()
+            self.assertEqual(response_data["contentType"], binary["contentType"])
+            self.assertNotIn("data", response_data)
+            self.assertEqual(response.headers["Location"], f"Binary/{response_data['id']}")
+            task_resource["input"].append({
+                "type": {"text": binary["contentType"]},
+                "valueReference": {"reference": f"Binary/{response_data['id']}"}})
+        bundle["entry"] = [e for e in bundle["entry"] if e not in binary_entries]
+
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        orthodontic_photograph = _build_dicom_image(Bundle.model_validate(bundle), task_id, self.task_store)
+        ds = orthodontic_photograph.to_dataset()
+        self.assertEqual(ds.SOPInstanceUID, "1.3.6.1.4.1.61741.11.2.4.146.2.192.6.158.81")
+        self.assertIn("PixelData", ds)
+
+    def test_compressed_bundle(self):
+        """ A gzip encoded Bundle is accepted, and unknown encodings are refused. """
+        body = gzip.compress(json.dumps(test.test_bundle).encode())
+        response = self.client.post(
+            "/fhir/Bundle", content=body,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["resourceType"], "Task")
+
+        response = self.client.post(
+            "/fhir/Bundle", content=body,
+            headers={"Content-Type": "application/json", "Content-Encoding": "br"})
+        self.assertEqual(response.status_code, 415)
+
+    def test_invalid_bundle(self):
+        """ A Bundle that does not match the profile is rejected before any Task is created. """
+        bundle = copy.deepcopy(test.test_bundle)
+        del bundle["entry"][1]
+        response = self.client.post("/fhir/Bundle", json=bundle)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+
+    def test_compressed_response(self):
+        """ Large responses are gzipped when the client accepts it, small ones are not. """
+        for _ in range(10):
+            self.task_store.reserve_id(description="Test task for compression")
+        response = self.client.get("/fhir/Task", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(response.json()["resourceType"], "Bundle")
+
+        response = self.client.get("/fhir/Task/does-not-exist", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+        response = self.client.get("/fhir/Task", headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_metrics(self):
+        """ Job memory is reported once a job has run. """
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        build_and_send_dicom_image(Bundle.model_validate(test.test_bundle), task_id, self.task_store)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        summaries = response.json()["summaries"]
+        self.assertGreater(summaries["job_estimated_bytes"]["max"], 0)
+        self.assertGreater(summaries["job_estimated_bytes"]["avg"], 0)
+
     def test_list_all_tasks(self):
         # Create a task to ensure there's at least one
         self.task_store.reserve_id(description="Test task for listing")
@@ -129,6 +207,129 @@ class TestFHIRAPI(unittest.TestCase):
                            "The bundle should contain at least one entry")
         self.assertGreater(bundle.total, 0)
 
+        # A database error is reported before the response starts
+        with mock.patch.object(TaskStore, "_get_tasks_json_page_by_id", side_effect=RuntimeError("database is locked")):
+            response = self.client.get("/fhir/Task")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+
+    def test_export_tasks(self):
+        """ Tasks are streamed as NDJSON, in pages, and _since only returns later changes. """
+        before = self.client.get("/fhir/Task/$export")
+        self.assertEqual(before.status_code, 200)
+        self.assertEqual(before.headers["content-type"], "application/fhir+ndjson")
+        # A Task changed by a job during the export may appear twice
+        count = len({json.loads(line)["id"] for line in before.text.splitlines()})
+
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        since = self.task_store.get_fhir_task_by_id(task_id).lastModified
+        sleep(0.01)
+        self.task_store.reserve_id(description=self._testMethodName)
+
+        lines = self.client.get("/fhir/Task/$export").text.splitlines()
+        self.assertEqual(len({json.loads(line)["id"] for line in lines}), count + 2)
+        self.assertTrue(all(json.loads(line)["resourceType"] == "Task" for line in lines))
+
+        since_param = since.isoformat().replace("+00:00", "Z")
+        lines = self.client.get("/fhir/Task/$export", params={"_since": since_param}).text.splitlines()
+        # Jobs of other tests may update their Tasks in the meantime
+        descriptions = [json.loads(line)["description"] for line in lines]
+        self.assertEqual(descriptions.count(self._testMethodName), 1)
+        exported = [json.loads(t)["id"] for chunk in self.task_store.iter_tasks_json(chunk_size=1) for t in chunk]
+        self.assertEqual(len(set(exported)), count + 2)
+
+        response = self.client.get("/fhir/Task/$export", params={"_since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+        with mock.patch.object(TaskStore, "_get_tasks_json_page", side_effect=RuntimeError("database is locked")):
+            response = self.client.get("/fhir/Task/$export")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+
+    def test_trace_id(self):
+        """ With tracing on, the Task records the trace id of the request that created it. """
+        exported = []
+        collector = mock.Mock(export=exported.extend)
+        with mock.patch.object(tracing.tracer, "exporters", [collector]):
+            response = self.client.post("/fhir/Bundle", json=test.test_bundle)
+            tracing.tracer.flush()
+        self.assertEqual(response.status_code, 200)
+        task = response.json()
+        trace_ids = [e["valueString"] for e in task["extension"] if e["url"] == tracing.TRACE_ID_EXTENSION_URL]
+        self.assertEqual(len(trace_ids), 1)
+        stored = self.client.get(f"/fhir/Task/{task['id']}").json()
+        self.assertIn({"url": tracing.TRACE_ID_EXTENSION_URL, "valueString": trace_ids[0]}, stored["extension"])
+        spans = {span.name: span for span in exported if span.trace_id == trace_ids[0]}
+        self.assertEqual(spans["handle_bundle"].attributes["task.id"], task["id"])
+        for name in ("bundle.parse", "task_store.add_tasks", "scheduler.add_job"):
+            self.assertEqual(spans[name].trace_id, trace_ids[0])
+
+    def test_cancel_task(self):
+        """ PUT with status cancelled cancels a Task; other updates are refused. """
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        cancel = {"resourceType": "Task", "id": task_id, "status": "cancelled", "intent": "order"}
+        response = self.client.put(f"/fhir/Task/{task_id}", json=dict(cancel, status="completed"))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(f"/fhir/Task/{task_id}", json=cancel)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "cancelled")
+        self.assertEqual(response.json()["businessStatus"]["text"], "cancelled")
+        self.assertEqual(self.client.put(f"/fhir/Task/{task_id}", json=cancel).status_code, 200)
+        self.assertEqual(self.client.put("/fhir/Task/does-not-exist", json=dict(cancel, id=None)).status_code, 404)
+
+        done_id = self.task_store.reserve_id(description=self._testMethodName)
+        self.task_store.modify_task_status(done_id, TASK_COMPLETED)
+        self.assertEqual(self.client.put(f"/fhir/Task/{done_id}", json=dict(cancel, id=done_id)).status_code, 409)
+
+
+    def test_resend_task(self):
+        """ $resend queues a failed Task again if its image is kept, and refuses Tasks that did not fail. """
+        self.assertEqual(self.client.post("/fhir/Task/does-not-exist/$resend").status_code, 404)
+
+        done_id = self.task_store.reserve_id(description=self._testMethodName)
+        self.task_store.modify_task_status(done_id, TASK_COMPLETED)
+        self.assertEqual(self.client.post(f"/fhir/Task/{done_id}/$resend").status_code, 409)
+
+        failed_id = self.task_store.reserve_id(description=self._testMethodName)
+        self.task_store.modify_task_status(failed_id, TASK_FAILED)
+        with mock.patch("fhir2dicom4ortho.fhir_api.resend_task", return_value=None):
+            response = self.client.post(f"/fhir/Task/{failed_id}/$resend")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+
+        def resend(task_id, task_store):
+            return task_store.modify_task_status(task_id, TASK_INPROGRESS)
+
+        with mock.patch("fhir2dicom4ortho.fhir_api.resend_task", side_effect=resend):
+            response = self.client.post(f"/fhir/Task/{failed_id}/$resend")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], TASK_INPROGRESS)
+
+
+    def test_batch(self):
+        """ POST /fhir accepts many Task sets in one Bundle, and answers with one entry per Task. """
+        batch = test.batch_bundle(3)
+        # The second set has no image
+        batch["entry"] = [e for e in batch["entry"] if e["resource"]["id"] != batch["entry"][7]["resource"]["id"]]
+        with mock.patch("fhir2dicom4ortho.fhir_api.job_queue.submit", return_value=mock.Mock(id="batch")) as submit:
+            response = self.client.post("/fhir", json=batch)
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json()
+        self.assertEqual(response_data["type"], "batch-response")
+        statuses = [entry["response"]["status"] for entry in response_data["entry"]]
+        self.assertEqual(statuses, ["201 Created", "400 Bad Request", "201 Created"])
+        self.assertEqual(submit.call_count, 2)
+        for entry in (response_data["entry"][0], response_data["entry"][2]):
+            self.assertEqual(entry["response"]["location"], f"Task/{entry['resource']['id']}")
+            task = self.client.get(f"/fhir/Task/{entry['resource']['id']}").json()
+            self.assertEqual(task["status"], "received")
+
+        # In a transaction, one bad set rejects them all
+        with mock.patch("fhir2dicom4ortho.fhir_api.job_queue.submit") as submit:
+            response = self.client.post("/fhir", json=dict(batch, type="transaction"))
+        self.assertEqual(response.status_code, 400)
+        submit.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
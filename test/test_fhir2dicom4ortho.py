@@ -1,12 +1,55 @@
 """ Test the fhir2dicom4ortho module. """
 import os
+import copy
+import json
+import io
+import gzip
+import base64
+import asyncio
+import logging
+import contextvars
+import time
+import threading
+import queue
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import unittest
+import httpx
+from pathlib import Path
+from unittest import mock
 from pydantic import ValidationError
+from PIL import Image
+from pydicom.encaps import generate_pixel_data_frame
+from pydicom.uid import JPEGBaseline8Bit, JPEG2000
 from fhir.resources.bundle import Bundle
+from fhir.resources.task import Task
+from pydicom import Dataset, dcmread
 
 import test
-from fhir2dicom4ortho.task_store import TaskStore
-from fhir2dicom4ortho.tasks import _build_dicom_image
+from fhir2dicom4ortho.task_store import TaskStore, AsyncTaskStore
+from fhir2dicom4ortho import tasks
+from fhir2dicom4ortho.tasks import _build_dicom_image, TASK_COMPLETED, TASK_FAILED
+from fhir2dicom4ortho.mwl_cache import MwlCache
+from fhir2dicom4ortho import bulk_import
+from fhir2dicom4ortho.adaptive_concurrency import AdaptiveLimiter
+from fhir2dicom4ortho.log_pipeline import start_logging, task_context, DebugSampler, LazyQueueHandler
+from fhir2dicom4ortho import tracing
+from fhir2dicom4ortho.tracing import Tracer, FileExporter, OtlpHttpExporter
+from fhir2dicom4ortho import job_control
+from fhir2dicom4ortho.job_control import wait_for, run_stage, StageTimeout, JobCancelled
+from fhir2dicom4ortho.dicom_store import DicomStore, DicomUploader, DESTINATION_PENDING
+from fhir2dicom4ortho.resend_cache import ResendCache
+from fhir2dicom4ortho.binary_store import BinaryStore
+from fhir2dicom4ortho.routing import Router, Destination, RoutingConfigError, DEFAULT_DESTINATION
+from fhir2dicom4ortho.ortho_bundle import (
+    parse_bundle, split_batch, BundleValidationError, BUNDLE_TYPE, MIN_ENTRIES, ENTRY_SLICES)
+from fhir2dicom4ortho.image_header import read_image_header, jpeg2000_codestream
+from fhir2dicom4ortho.memory_budget import MemoryBudget, estimate_job_bytes
+from fhir2dicom4ortho.scheduler import PriorityJobQueue
+from fhir2dicom4ortho.metrics import metrics
+from fhir2dicom4ortho import compression
+from fhir2dicom4ortho.compression import read_body, BodyTooLargeError, UnsupportedEncodingError
 from dicom4ortho.utils import get_scheduled_protocol_code
 
 class TestTasks(unittest.TestCase):
@@ -102,6 +145,1149 @@ class TestTasks(unittest.TestCase):
                         self.fail(f"Validation failed unexpectedly for started={started}")
 
 
+class TestOrthoBundle(unittest.TestCase):
+    """ Test the structural pre-check of ortho-imaging-bundle Bundles. """
+
+    def setUp(self):
+        self.bundle_data = copy.deepcopy(test.test_bundle)
+
+    def test_constants_match_profile(self):
+        """ The hardcoded constraints must follow the profile in ig/. """
+        profile_path = os.path.join(test.current_dir, "..", "ig", "input", "resources",
+                                    "StructureDefinition-ortho-imaging-bundle.json")
+        with open(profile_path, "r", encoding="utf-8") as f:
+            elements = {e["id"]: e for e in json.load(f)["differential"]["element"]}
+        self.assertEqual(elements["Bundle.type"]["fixedCode"], BUNDLE_TYPE)
+        self.assertEqual(elements["Bundle.entry"]["min"], MIN_ENTRIES)
+        for slice_name, resource_type in (("task", "Task"), ("imagingStudy", "ImagingStudy"), ("binary", "Binary")):
+            element = elements[f"Bundle.entry:{slice_name}"]
+            maximum = None if element["max"] == "*" else int(element["max"])
+            self.assertEqual(ENTRY_SLICES[resource_type], (element["min"], maximum))
+
+    def test_parse_bundle(self):
+        ortho_bundle = parse_bundle(self.bundle_data)
+        self.assertEqual(ortho_bundle.task.intent, "order")
+        self.assertEqual(ortho_bundle.image.content_type, "image/png")
+        self.assertTrue(ortho_bundle.image.get_bytes().startswith(b"\x89PNG"))
+        self.assertEqual(ortho_bundle.mwl.content_type, "application/dicom")
+        self.assertEqual(ortho_bundle.imaging_study.series[0].instance[0].number, 100)
+
+    def test_other_entries_ignored(self):
+        """ The slicing of Bundle.entry is open: entries of other resource types are ignored. """
+        basic = {"resource": {"resourceType": "Basic", "id": "extra", "code": {"text": "photograph"}}}
+        self.bundle_data["entry"].append(basic)
+        self.assertEqual(parse_bundle(self.bundle_data).task.intent, "order")
+        batch = test.batch_bundle(2)
+        batch["entry"].append(copy.deepcopy(basic))
+        self.assertEqual(len(split_batch(batch)), 2)
+
+    def test_invalid_bundles(self):
+        def drop_imaging_study(b):
+            del b["entry"][1]
+        def bad_content_type(b):
+            b["entry"][3]["resource"]["contentType"] = "text/plain"
+        def bad_type(b):
+            b["type"] = "collection"
+        def no_instance(b):
+            b["entry"][1]["resource"]["series"][0]["instance"] = []
+        def two_tasks(b):
+            b["entry"].append(copy.deepcopy(b["entry"][0]))
+        def bad_base64(b):
+            b["entry"][3]["resource"]["data"] = "not base64!"
+        def unknown_binary(b):
+            b["entry"][3]["resource"].pop("data")
+        for mutate in (drop_imaging_study, bad_content_type, bad_type, no_instance, two_tasks, bad_base64, unknown_binary):
+            with self.subTest(mutate=mutate.__name__):
+                bundle_data = copy.deepcopy(self.bundle_data)
+                mutate(bundle_data)
+                with self.assertRaises(BundleValidationError):
+                    parse_bundle(bundle_data)
+
+    def test_split_batch(self):
+        """ A batch is cut into one ortho-imaging-bundle per Task, following Task.input. """
+        batch = test.batch_bundle(3)
+        # Entries of the sets may come in any order
+        batch["entry"].reverse()
+        groups = split_batch(batch)
+        self.assertEqual(len(groups), 3)
+        for group in groups:
+            ortho_bundle = parse_bundle(group)
+            suffix = ortho_bundle.task.id[-4:]
+            self.assertEqual(ortho_bundle.imaging_study.id[-4:], suffix)
+            self.assertEqual(ortho_bundle.image.id[-4:], suffix)
+        self.assertEqual(len(split_batch(self.bundle_data)[0]["entry"]), 4)
+
+        batch["entry"].append(copy.deepcopy(batch["entry"][0]))
+        batch["entry"][-1]["resource"]["id"] = "orphan"
+        batch["entry"][-1].pop("fullUrl")
+        with self.assertRaises(BundleValidationError):
+            split_batch(batch)
+        with self.assertRaises(BundleValidationError):
+            split_batch(dict(batch, type="collection"))
+
+    def test_build_from_parsed_bundle(self):
+        """ A parsed bundle builds the same image as the Bundle model. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        ds = _build_dicom_image(parse_bundle(self.bundle_data), task_id, task_store).to_dataset()
+        self.assertEqual(ds.SOPInstanceUID, "1.3.6.1.4.1.61741.11.2.4.146.2.192.6.158.81")
+        self.assertEqual(ds.InstanceNumber, "00100")
+
+
+class TestBinaryStore(unittest.TestCase):
+    """ Test the spool of raw Binary uploads. """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.store = BinaryStore(self.tmp_dir.name, max_age=60)
+
+    def write(self, data: bytes) -> str:
+        async def chunks():
+            for i in range(0, len(data), 65536):
+                yield data[i:i + 65536]
+        return asyncio.run(self.store.write_stream(chunks(), "image/png"))
+
+    def test_write_stream(self):
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        binary_id = self.write(data)
+        self.assertEqual(self.store.read_bytes(binary_id), data)
+        self.assertEqual(self.store.get_content_type(binary_id), "image/png")
+        self.assertEqual([p.name for p in Path(self.tmp_dir.name).glob(".*")], [])
+
+    def test_hold_release(self):
+        """ A Binary outlives the jobs that use it, is never purged while held, and expires once released. """
+        binary_id = self.write(b"image")
+        self.store.hold([binary_id])
+        self.store.hold([binary_id])
+        self.store.release([binary_id])
+        self.store.release([binary_id])
+        self.assertTrue(self.store.exists(binary_id))
+        self.store.hold([binary_id])
+        os.utime(self.store._data_path(binary_id), (0, 0))
+        self.store.purge()
+        self.assertTrue(self.store.exists(binary_id))
+        self.store.release([binary_id])
+        self.store.purge()
+        self.assertFalse(self.store.exists(binary_id))
+
+    def test_purge(self):
+        binary_id = self.write(b"image")
+        self.store.purge()
+        self.assertTrue(self.store.exists(binary_id))
+        os.utime(self.store._data_path(binary_id), (0, 0))
+        self.store.purge()
+        self.assertFalse(self.store.exists(binary_id))
+
+
+class TestPassThrough(unittest.TestCase):
+    """ Test encapsulation of JPEG and JPEG 2000 photographs without decoding. """
+
+    def setUp(self):
+        self.task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+
+    def _build(self, image_bytes, content_type):
+        bundle_data = copy.deepcopy(test.test_bundle)
+        bundle_data["entry"][3]["resource"]["contentType"] = content_type
+        bundle_data["entry"][3]["resource"]["data"] = base64.b64encode(image_bytes).decode()
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        return _build_dicom_image(parse_bundle(bundle_data), task_id, self.task_store).to_dataset()
+
+    def test_image_headers(self):
+        image = Image.new("RGB", (100, 80), (200, 10, 10))
+        cases = {
+            "jpeg_420": ({"format": "JPEG"}, ("JPEG", "YBR_FULL_422", True)),
+            "jpeg_444": ({"format": "JPEG", "subsampling": 0}, ("JPEG", "YBR_FULL", True)),
+            "jpeg_progressive": ({"format": "JPEG", "progressive": True}, ("JPEG", "YBR_FULL_422", False)),
+            "j2k_rgb": ({"format": "JPEG2000"}, ("JPEG2000", "RGB", True)),
+            "j2k_ict": ({"format": "JPEG2000", "irreversible": True, "mct": 1}, ("JPEG2000", "YBR_ICT", True)),
+        }
+        for name, (save_args, expected) in cases.items():
+            with self.subTest(name=name):
+                buffer = io.BytesIO()
+                image.save(buffer, **save_args)
+                header = read_image_header(buffer.getvalue())
+                self.assertEqual((header.format, header.photometric_interpretation, header.baseline), expected)
+                self.assertEqual((header.rows, header.columns, header.samples_per_pixel), (80, 100, 3))
+
+    def test_jpeg_passthrough(self):
+        with open(os.path.join(test.current_dir, "resources", "sample_NikonD90.JPG"), "rb") as f:
+            jpeg = f.read()
+        ds = self._build(jpeg, "image/jpeg")
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, JPEGBaseline8Bit)
+        self.assertEqual((ds.Rows, ds.Columns), (1424, 2144))
+        self.assertEqual(ds.PhotometricInterpretation, "YBR_FULL_422")
+        self.assertEqual(ds.LossyImageCompression, "01")
+        frame = next(generate_pixel_data_frame(ds.PixelData))
+        self.assertEqual(frame.rstrip(b"\x00"), jpeg.rstrip(b"\x00"))
+
+    def test_jpeg2000_passthrough(self):
+        with open(os.path.join(test.current_dir, "resources", "sample_topsOrtho.jp2"), "rb") as f:
+            j2k = f.read()
+        ds = self._build(j2k, "image/jp2")
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, JPEG2000)
+        self.assertEqual((ds.Rows, ds.Columns), (1411, 2048))
+        self.assertEqual(ds.PhotometricInterpretation, "YBR_ICT")
+        frame = next(generate_pixel_data_frame(ds.PixelData))
+        self.assertEqual(frame.rstrip(b"\x00"), jpeg2000_codestream(j2k).rstrip(b"\x00"))
+
+
+class TestMemoryBudget(unittest.TestCase):
+    """ Test job memory estimation and the in-flight byte budget. """
+
+    def test_estimate_job_bytes(self):
+        with open(os.path.join(test.current_dir, "resources", "sample_NikonD90.JPG"), "rb") as f:
+            jpeg = f.read()
+        decoded = 1424 * 2144 * 3
+        passthrough = estimate_job_bytes(len(jpeg), jpeg[:128 * 1024], 1000, passthrough=True)
+        decoding = estimate_job_bytes(len(jpeg), jpeg[:128 * 1024], 1000, passthrough=False)
+        self.assertLess(passthrough, decoded)
+        self.assertGreater(decoding, 3 * decoded)
+
+    def test_budget_blocks_until_released(self):
+        budget = MemoryBudget(100)
+        budget.acquire(60)
+        admitted = threading.Event()
+
+        def job():
+            with budget.reserve(60):
+                admitted.set()
+
+        worker = threading.Thread(target=job)
+        worker.start()
+        self.assertFalse(admitted.wait(0.2))
+        budget.release(60)
+        self.assertTrue(admitted.wait(2))
+        worker.join()
+        self.assertEqual(budget.in_flight, 0)
+
+    def test_oversized_job_runs_alone(self):
+        budget = MemoryBudget(100)
+        with budget.reserve(500):
+            self.assertEqual(budget.in_flight, 500)
+        self.assertEqual(budget.in_flight, 0)
+
+
+class TestPriorityJobQueue(unittest.TestCase):
+    """ Test ordering of jobs by Task.priority. """
+
+    class ManualScheduler:
+        """ Collects dispatches instead of running them on worker threads. """
+        def __init__(self):
+            self.dispatches = []
+
+        def add_job(self, func, **kwargs):
+            self.dispatches.append(func)
+            return func
+
+    def setUp(self):
+        self.scheduler = self.ManualScheduler()
+        self.ran = []
+
+    def _run_all(self):
+        for dispatch in self.scheduler.dispatches:
+            dispatch()
+
+    def test_priority_order(self):
+        queue = PriorityJobQueue(self.scheduler, aging_seconds=3600)
+        for name, priority in (("r1", "routine"), ("u", "urgent"), ("r2", None), ("s", "stat"), ("a", "asap")):
+            queue.submit(self.ran.append, args=[name], priority=priority)
+        self._run_all()
+        self.assertEqual(self.ran, ["s", "a", "u", "r1", "r2"])
+        self.assertEqual(len(queue), 0)
+        self.assertIsNotNone(metrics.get_summary("queue_wait_seconds", priority="stat"))
+
+    def test_routine_is_not_starved(self):
+        """ A routine job that waited long enough runs before a newer stat job. """
+        queue = PriorityJobQueue(self.scheduler, aging_seconds=0.02)
+        queue.submit(self.ran.append, args=["routine"], priority="routine")
+        time.sleep(0.1)
+        queue.submit(self.ran.append, args=["stat"], priority="stat")
+        self._run_all()
+        self.assertEqual(self.ran, ["routine", "stat"])
+
+    def test_memory_budget(self):
+        """ A job is only dispatched once its memory fits, and is dispatched again when memory is released. """
+        budget = MemoryBudget(100)
+        queue = PriorityJobQueue(self.scheduler, aging_seconds=3600, budget=budget)
+        queue.submit(self.ran.append, args=["first"], memory_bytes=60)
+        queue.submit(self.ran.append, args=["second"], memory_bytes=60)
+        self._run_all()
+        self.assertEqual(self.ran, ["first"])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(len(self.scheduler.dispatches), 2)
+        self.assertEqual(metrics.get_gauge("job_queue_deferred_jobs"), 1)
+        budget.release(60)
+        self.assertEqual(metrics.get_gauge("job_queue_deferred_jobs"), 0)
+        self.assertEqual(len(self.scheduler.dispatches), 3)
+        self.scheduler.dispatches[-1]()
+        self.assertEqual(self.ran, ["first", "second"])
+        self.assertEqual(budget.in_flight, 60)
+
+    def test_saturated_scheduler(self):
+        """ Every job runs on a real scheduler, even when dispatches wait longer than the misfire grace time. """
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerPool
+        scheduler = BackgroundScheduler(executors={"default": SchedulerPool(2)})
+        scheduler.start()
+        self.addCleanup(scheduler.shutdown, wait=False)
+        queue = PriorityJobQueue(scheduler)
+        done = threading.Semaphore(0)
+
+        def job(n):
+            time.sleep(0.6)
+            self.ran.append(n)
+            done.release()
+
+        for n in range(10):
+            queue.submit(job, args=[n])
+        for _ in range(10):
+            self.assertTrue(done.acquire(timeout=10))
+        self.assertEqual(sorted(self.ran), list(range(10)))
+        self.assertEqual(len(queue), 0)
+
+
+class TestCompression(unittest.TestCase):
+    """ Test decoding of compressed request bodies. """
+
+    @staticmethod
+    def _read(body, encoding, max_bytes):
+        async def chunks():
+            for i in range(0, len(body), 1000):
+                yield body[i:i + 1000]
+        return asyncio.run(read_body({"content-encoding": encoding}, chunks(), max_bytes))
+
+    def test_gzip_roundtrip(self):
+        payload = os.urandom(5000) * 4
+        self.assertEqual(self._read(gzip.compress(payload), "gzip", len(payload)), payload)
+        self.assertEqual(self._read(payload, "identity", len(payload)), payload)
+
+    def test_decompressed_size_cap(self):
+        """ A small compressed body that expands past the cap is refused. """
+        bomb = gzip.compress(bytes(10 * 1024 * 1024))
+        self.assertLess(len(bomb), 100 * 1024)
+        with self.assertRaises(BodyTooLargeError):
+            self._read(bomb, "gzip", 1024 * 1024)
+        with self.assertRaises(BodyTooLargeError):
+            self._read(bytes(2048), "identity", 1024)
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(UnsupportedEncodingError):
+            self._read(b"abc", "br", 1024)
+
+    @unittest.skipIf(compression.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        """ A zstd bomb is stopped at the cap, without expanding in memory first. """
+        zstandard = compression.zstandard
+        payload = os.urandom(5000) * 4
+        self.assertEqual(self._read(zstandard.ZstdCompressor().compress(payload), "zstd", len(payload)), payload)
+        bomb = zstandard.ZstdCompressor().compress(bytes(1024 ** 3))
+        tracemalloc.start()
+        try:
+            with self.assertRaises(BodyTooLargeError):
+                self._read(bomb, "zstd", 1024 * 1024)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 16 * 1024 * 1024)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(compression.accepted_encodings("gzip, deflate;q=0.5"), {"gzip", "deflate"})
+        self.assertEqual(compression.accepted_encodings("gzip;q=0, identity"), {"identity"})
+        self.assertEqual(compression.accepted_encodings("*;q=0.1, zstd;q=0"), {"*", "gzip"})
+        self.assertEqual(compression.accepted_encodings(""), set())
+
+
+
+
+class TestRouting(unittest.TestCase):
+    """ Test routing to several PACS destinations. """
+
+    def setUp(self):
+        self.router = Router.from_config({
+            "destinations": {
+                "practice-a": {"send_method": "dimse", "dimse_aet": "PACS_A"},
+                "archive": {"send_method": "wado", "wado_url": "http://archive/dicom-web"},
+            },
+            "rules": [
+                {"match": {"task.owner": "Organization/practice-a"}, "destinations": ["practice-a"]},
+                {"match": {"mwl.ScheduledStationAETitle": ["CAM1", "CAM2"]}, "destinations": ["practice-a"]},
+                {"match": {"mwl.InstitutionName": "Archive Clinic"}, "destinations": ["archive", "default"]},
+            ],
+        }, Destination(name=DEFAULT_DESTINATION))
+        self.mwl = Dataset()
+        step = Dataset()
+        step.ScheduledStationAETitle = "CAM2"
+        self.mwl.ScheduledProcedureStepSequence = [step]
+
+    def names(self, task, mwl):
+        return [d.name for d in self.router.route(task, mwl)]
+
+    def test_route(self):
+        task = Task(status="draft", intent="order", owner={"reference": "Organization/practice-a"})
+        self.assertEqual(self.names(task, None), ["practice-a"])
+        self.assertEqual(self.names(None, self.mwl), ["practice-a"])
+        self.mwl.InstitutionName = "Archive Clinic"
+        self.assertEqual(self.names(task, self.mwl), ["practice-a", "archive", "default"])
+        self.assertEqual(self.names(Task(status="draft", intent="order"), Dataset()), [DEFAULT_DESTINATION])
+
+    def test_invalid_config(self):
+        with self.assertRaises(RoutingConfigError):
+            Router.from_config({"rules": [{"match": {}, "destinations": ["nowhere"]}]}, Destination(name="default"))
+        with self.assertRaises(RoutingConfigError):
+            Router.from_config({"rules": [{"match": {"patient.name": "x"}, "destinations": ["default"]}]},
+                               Destination(name="default"))
+
+    def test_fan_out(self):
+        """ Each destination gets its own status, and a failing one does not stop the others. """
+        ok = Dataset()
+        ok.Status = 0x0000
+
+        def send(photograph, destination):
+            if destination.name == "archive":
+                raise ConnectionError("archive is down")
+            return ok
+
+        destinations = [self.router.destinations[n] for n in ("practice-a", "archive", "default")]
+        with mock.patch.object(tasks, "_send_dataset", side_effect=send):
+            statuses = tasks._send_to_destinations(Dataset(), destinations)
+        self.assertEqual(statuses, {"practice-a": TASK_COMPLETED, "archive": TASK_FAILED, "default": TASK_COMPLETED})
+        outputs = tasks._destination_outputs(statuses)
+        self.assertEqual([(o.type.text, o.valueCode) for o in outputs], list(statuses.items()))
+
+
+class TestDicomStore(unittest.TestCase):
+    """ Test the local DICOM store and its uploader. """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = DicomStore(self.tmp_dir.name)
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        self.dataset = _build_dicom_image(Bundle.model_validate(test.test_bundle), task_id, task_store).to_dataset()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write(self):
+        entry = self.store.write(self.dataset, "task-1", ["default", "archive"])
+        relative = entry.path.relative_to(self.tmp_dir.name).parts
+        self.assertEqual(relative[1:], (self.dataset.StudyInstanceUID, self.dataset.SeriesInstanceUID,
+                                        f"{self.dataset.SOPInstanceUID}_task-1.dcm"))
+        self.assertEqual(self.store.read_dataset(entry).SOPInstanceUID, self.dataset.SOPInstanceUID)
+        self.assertEqual(self.store.find("task-1")[0].destinations,
+                         {"default": DESTINATION_PENDING, "archive": DESTINATION_PENDING})
+        self.assertEqual([p.name for p in Path(self.tmp_dir.name).rglob(".*")], [])
+
+    def test_same_image_for_two_tasks(self):
+        """ The same Bundle submitted twice gives one entry per Task. """
+        first = self.store.write(self.dataset, "task-1", ["default"])
+        second = self.store.write(self.dataset, "task-2", ["default"])
+        self.assertNotEqual(first.path, second.path)
+        self.assertEqual(len(self.store.find("task-1")), 1)
+        self.assertEqual(len(self.store.find("task-2")), 1)
+
+    def test_index(self):
+        """ Sidecars are read once; lookups then use the in-memory index. """
+        self.store.write(self.dataset, "task-1", ["default"])
+        restarted = DicomStore(self.tmp_dir.name)
+        self.assertEqual([entry.task_id for entry in restarted.due()], ["task-1"])
+        with mock.patch.object(DicomStore, "load_entry", side_effect=AssertionError("read from disk")):
+            self.assertEqual(len(restarted.find("task-1")), 1)
+            self.assertEqual(len(restarted.due()), 1)
+            restarted.delete(restarted.find("task-1")[0])
+            self.assertEqual(restarted.entries(), [])
+        # An entry deleted while being uploaded is not brought back by the report of the attempt
+        entry = self.store.find("task-1")[0]
+        self.store.delete(entry)
+        self.store.save_entry(entry)
+        self.assertEqual(DicomStore(self.tmp_dir.name).entries(), [])
+
+    def test_uploader_retries(self):
+        """ A destination that fails is retried, without resending to the others. """
+        sent = []
+        reports = []
+
+        def send(dataset, names):
+            sent.append(list(names))
+            return {name: "failed" if name == "archive" and len(sent) == 1 else "completed" for name in names}
+
+        uploader = DicomUploader(self.store, send, lambda task_store, entry, final: reports.append(
+            (dict(entry.destinations), final)), retry_delay=0, threads=1)
+        uploader.start(None)
+        self.store.write(self.dataset, "task-1", ["default", "archive"])
+        uploader.drain(wait=True)
+        uploader.drain(wait=True)
+        self.assertEqual(sent, [["default", "archive"], ["archive"]])
+        self.assertEqual(reports[-1], ({"default": "completed", "archive": "completed"}, True))
+        self.assertEqual(list(self.store.entries()), [])
+        self.assertEqual(list(Path(self.tmp_dir.name).iterdir()), [])
+
+    def test_uploader_gives_up(self):
+        uploader = DicomUploader(self.store, lambda dataset, names: {n: "failed" for n in names},
+                                 lambda task_store, entry, final: None, max_attempts=2, retry_delay=0, threads=1)
+        uploader.start(None)
+        self.store.write(self.dataset, "task-1", ["default"])
+        for _ in range(3):
+            uploader.drain(wait=True)
+        entry = self.store.find("task-1")[0]
+        self.assertTrue(entry.failed)
+        self.assertEqual(entry.attempts, 2)
+        self.assertEqual(self.store.requeue("task-1"), 1)
+        self.assertEqual(len(self.store.due()), 1)
+
+
+
+class TestMwlCache(unittest.TestCase):
+    """ Test the cache of parsed MWL datasets. """
+
+    def setUp(self):
+        self.mwl_bytes = parse_bundle(copy.deepcopy(test.test_bundle)).mwl.get_bytes()
+
+    def test_hits_and_copies(self):
+        cache = MwlCache(max_entries=2)
+        first = cache.get(self.mwl_bytes)
+        first.PatientName = "Changed^ByJob"
+        second = cache.get(self.mwl_bytes)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertNotEqual(second.PatientName, "Changed^ByJob")
+        self.assertEqual(second.ScheduledProcedureStepSequence[0].ScheduledProtocolCodeSequence[0].CodeValue,
+                         first.ScheduledProcedureStepSequence[0].ScheduledProtocolCodeSequence[0].CodeValue)
+
+    def test_eviction(self):
+        cache = MwlCache(max_entries=1)
+        other = dcmread(io.BytesIO(self.mwl_bytes))
+        other.PatientName = "Other^Patient"
+        buffer = io.BytesIO()
+        other.save_as(buffer)
+        cache.get(self.mwl_bytes)
+        cache.get(buffer.getvalue())
+        cache.get(self.mwl_bytes)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 3, 1))
+
+
+
+def _send_ok(dataset, destinations, **kwargs):
+    return {destination.name: TASK_COMPLETED for destination in destinations}
+
+
+def _send_failed(dataset, destinations, **kwargs):
+    return {destination.name: TASK_FAILED for destination in destinations}
+
+
+class TestBulkImport(unittest.TestCase):
+    """ Test the offline bulk import. """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source = Path(self.tmp_dir.name) / "bundles"
+        self.source.mkdir()
+        for i in range(3):
+            bundle = copy.deepcopy(test.test_bundle)
+            bundle["entry"][0]["resource"]["description"] = f"{self._testMethodName} {i}"
+            (self.source / f"bundle{i}.json").write_text(json.dumps(bundle), encoding="utf-8")
+        (self.source / "invalid.json").write_text('{"resourceType": "Bundle"}', encoding="utf-8")
+        self.checkpoint = Path(self.tmp_dir.name) / "import.checkpoint"
+        self.task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_import(self):
+        progress = bulk_import.Progress(out=io.StringIO())
+        return bulk_import.run_import(str(self.source), self.task_store, workers=2,
+                                      checkpoint=str(self.checkpoint), progress=progress)
+
+    def test_import_and_resume(self):
+        # Worker processes are forked, so they see the patched send
+        with mock.patch.object(bulk_import, "_send_to_destinations", side_effect=_send_ok):
+            counts = self.run_import()
+        self.assertEqual(counts, {"completed": 3, "rejected": 1})
+        descriptions = {t.description: t for t in self.task_store.get_all_tasks()}
+        task = descriptions[f"{self._testMethodName} 1"]
+        self.assertEqual(task.status, "completed")
+        self.assertEqual([o.valueCode for o in task.output], ["completed"])
+
+        # Nothing left to do after an interruption
+        (self.source / "bundle3.json").write_text(json.dumps(test.test_bundle), encoding="utf-8")
+        with mock.patch.object(bulk_import, "_send_to_destinations", side_effect=_send_ok):
+            self.assertEqual(self.run_import(), {"completed": 1})
+
+    def test_retry_keeps_task(self):
+        """ A failed input retried by a later import keeps its Task. """
+        before = len(self.task_store.get_all_tasks())
+        with mock.patch.object(bulk_import, "_send_to_destinations", side_effect=_send_failed):
+            self.assertEqual(self.run_import(), {"failed": 3, "rejected": 1})
+        done, task_ids = bulk_import.load_checkpoint(self.checkpoint)
+        self.assertEqual(done, {"invalid.json"})
+        self.assertEqual(len(task_ids), 3)
+
+        with mock.patch.object(bulk_import, "_send_to_destinations", side_effect=_send_ok):
+            self.assertEqual(self.run_import(), {"completed": 3})
+        self.assertEqual(len(self.task_store.get_all_tasks()), before + 3)
+        for task_id in task_ids.values():
+            self.assertEqual(self.task_store.get_fhir_task_by_id(task_id).status, "completed")
+
+    def test_build_timeout_frees_worker(self):
+        """ A hung build fails its input only: the next build gets a new thread. """
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+        photograph = mock.Mock()
+        builds = [lambda *args: hang.wait(10), lambda *args: photograph]
+        build_executor = tasks.build_executor
+        self.addCleanup(setattr, tasks, "build_executor", build_executor)
+        tasks.build_executor = ThreadPoolExecutor(max_workers=1)
+        text = json.dumps(test.test_bundle)
+        with mock.patch.object(bulk_import, "_build_dicom_image", side_effect=lambda *args: builds.pop(0)(*args)), \
+                mock.patch.object(bulk_import.router, "route", return_value=[]), \
+                mock.patch.object(bulk_import, "_send_to_destinations", side_effect=_send_ok), \
+                mock.patch.object(bulk_import.args_cache, "build_timeout", 0.2):
+            self.assertEqual(bulk_import.process_bundle("hung", text, None)["status"], "failed")
+            self.assertEqual(bulk_import.process_bundle("next", text, None)["status"], "completed")
+
+
+
+class TestResendCache(unittest.TestCase):
+    """ Test the cache of built images to resend. """
+
+    @classmethod
+    def setUpClass(cls):
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=cls.__name__)
+        cls.dataset = _build_dicom_image(Bundle.model_validate(test.test_bundle), task_id, task_store).to_dataset()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.evicted = []
+        self.cache = ResendCache(self.tmp_dir.name, on_evict=self.evicted.append)
+
+    def test_write(self):
+        entry = self.cache.write(self.dataset, "task-1", {"default": TASK_COMPLETED, "archive": TASK_FAILED})
+        self.assertEqual(entry.path, Path(self.tmp_dir.name, "ta", "task-1.dcm"))
+        self.assertEqual(self.cache.find("task-1")[0].pending(), ["archive"])
+        self.assertEqual(self.cache.read_dataset(entry).SOPInstanceUID, self.dataset.SOPInstanceUID)
+        self.assertEqual(self.cache.find("task-2"), [])
+        self.cache.delete(entry)
+        self.assertEqual(list(Path(self.tmp_dir.name).iterdir()), [])
+
+    def test_size_cap(self):
+        """ The least recently used images are dropped once the cache is over its size cap. """
+        first = self.cache.write(self.dataset, "task-1", {"default": TASK_FAILED})
+        self.cache.write(self.dataset, "task-2", {"default": TASK_FAILED})
+        # task-1 was used last
+        self.cache.save_entry(first)
+        self.cache.max_bytes = first.size * 2 + 1
+        self.cache.write(self.dataset, "task-3", {"default": TASK_FAILED})
+        self.assertEqual(sorted(entry.task_id for entry in self.cache.entries()), ["task-1", "task-3"])
+        self.assertEqual([entry.task_id for entry in self.evicted], ["task-2"])
+
+    def test_oversize(self):
+        """ An image larger than the cache is not cached, and evicts nothing; the one written is never evicted. """
+        first = self.cache.write(self.dataset, "task-1", {"default": TASK_FAILED})
+        self.cache.max_bytes = first.size - 1
+        self.assertIsNone(self.cache.write(self.dataset, "task-2", {"default": TASK_FAILED}))
+        self.assertEqual([entry.task_id for entry in self.cache.entries()], ["task-1"])
+        self.assertFalse(self.cache.path_for_task("task-2").exists())
+
+        self.cache.max_bytes = 0
+        second = self.cache.write(self.dataset, "task-2", {"default": TASK_FAILED})
+        # task-1 was used last, but task-2 is the one being written
+        self.cache.save_entry(first)
+        self.cache.max_bytes = first.size
+        self.cache.evict(keep=second.path)
+        self.assertEqual([entry.task_id for entry in self.cache.entries()], ["task-2"])
+        self.assertEqual([entry.task_id for entry in self.evicted], ["task-1"])
+
+    def test_job_fails_when_not_cached(self):
+        """ A Task whose image does not fit in the cache fails instead of staying in progress. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        self.cache.max_bytes = 1
+        uploader = mock.Mock(retry_delay=0)
+        with mock.patch.object(tasks, "resend_cache", self.cache), \
+                mock.patch.object(tasks, "resend_uploader", uploader), \
+                mock.patch.object(tasks, "dicom_store", None), \
+                mock.patch.object(tasks, "_send_dataset", return_value=None):
+            tasks.build_and_send_dicom_image(parse_bundle(copy.deepcopy(test.test_bundle)), task_id, task_store)
+        task = task_store.get_fhir_task_by_id(task_id)
+        self.assertEqual(task.status, TASK_FAILED)
+        self.assertEqual([o.valueCode for o in task.output], [TASK_FAILED])
+        uploader.start.assert_not_called()
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_ttl(self):
+        self.cache.ttl = 60
+        self.cache.write(self.dataset, "task-1", {"default": TASK_FAILED})
+        self.cache.evict(now=time.time() + 30)
+        self.assertEqual(len(self.cache.find("task-1")), 1)
+        self.cache.evict(now=time.time() + 120)
+        self.assertEqual(self.cache.find("task-1"), [])
+        self.assertEqual(len(self.evicted), 1)
+
+    def test_job_resends_without_rebuilding(self):
+        """ A failed send keeps the image, and the retry sends it again without building it again. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        bundle = parse_bundle(copy.deepcopy(test.test_bundle))
+        uploader = DicomUploader(self.cache, tasks._send_stored, tasks._report_stored,
+                                 retry_delay=0, threads=1, name="test_resend")
+        with mock.patch.object(tasks, "resend_cache", self.cache), \
+                mock.patch.object(tasks, "resend_uploader", uploader), \
+                mock.patch.object(tasks, "dicom_store", None):
+            with mock.patch.object(tasks, "_send_dataset", return_value=None):
+                tasks.build_and_send_dicom_image(bundle, task_id, task_store)
+            task = task_store.get_fhir_task_by_id(task_id)
+            self.assertEqual(task.status, tasks.TASK_INPROGRESS)
+            self.assertEqual([o.valueCode for o in task.output], [TASK_FAILED])
+            self.assertEqual(self.cache.find(task_id)[0].attempts, 1)
+
+            ok = Dataset()
+            ok.Status = 0x0000
+            with mock.patch.object(tasks, "_send_dataset", return_value=ok), \
+                    mock.patch.object(tasks, "_build_dicom_image") as build:
+                deadline = time.monotonic() + 10
+                while task_store.get_fhir_task_by_id(task_id).status != TASK_COMPLETED and time.monotonic() < deadline:
+                    uploader.wake()
+                    time.sleep(0.05)
+            build.assert_not_called()
+        self.assertEqual(task_store.get_fhir_task_by_id(task_id).status, TASK_COMPLETED)
+        self.assertEqual(self.cache.find(task_id), [])
+
+    def test_resend_task(self):
+        """ Once the retries gave up, resend_task() queues the cached image again. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        entry = self.cache.write(self.dataset, task_id, {"default": TASK_FAILED})
+        entry.failed = True
+        self.cache.save_entry(entry)
+        uploader = mock.Mock()
+        with mock.patch.object(tasks, "resend_cache", self.cache), \
+                mock.patch.object(tasks, "resend_uploader", uploader), \
+                mock.patch.object(tasks, "dicom_store", None):
+            self.assertEqual(tasks.resend_task(task_id, task_store).status, tasks.TASK_INPROGRESS)
+            self.assertIsNone(tasks.resend_task("unknown", task_store))
+        uploader.wake.assert_called_once()
+        self.assertEqual(len(self.cache.due()), 1)
+
+    def test_cancel_cached(self):
+        """ Cancelling a Task whose job already ended drops its image, and leaves no cancel event behind. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        self.cache.write(self.dataset, task_id, {"default": TASK_FAILED})
+        with mock.patch.object(tasks, "resend_cache", self.cache), \
+                mock.patch.object(tasks, "dicom_store", None):
+            self.assertEqual(tasks.cancel_task(task_id, task_store).status, tasks.TASK_CANCELLED)
+        self.assertEqual(self.cache.find(task_id), [])
+        self.assertNotIn(task_id, job_control._cancel_events)
+
+
+class TestJobControl(unittest.TestCase):
+    """ Test per-stage deadlines and cancellation of jobs. """
+
+    def setUp(self):
+        self.task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        self.bundle = parse_bundle(copy.deepcopy(test.test_bundle))
+        self.hang = threading.Event()
+        self.addCleanup(self.hang.set)
+
+    def hung_send(self, dataset, destination):
+        self.hang.wait(10)
+        ok = Dataset()
+        ok.Status = 0x0000
+        return ok
+
+    def test_run_stage(self):
+        executor = tasks.build_executor
+        self.assertEqual(run_stage(executor, "test", lambda: 42, timeout=1), 42)
+        with self.assertRaises(StageTimeout) as context:
+            run_stage(executor, "test", self.hang.wait, 10, timeout=0.1)
+        self.assertFalse(context.exception.futures[0].done())
+        cancelled = threading.Event()
+        cancelled.set()
+        with self.assertRaises(JobCancelled):
+            wait_for([executor.submit(self.hang.wait, 10)], "test", cancelled=cancelled)
+
+    def test_send_timeout(self):
+        """ A hung send fails the Task as timed out, and frees the job thread. """
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        started = time.monotonic()
+        with mock.patch.object(tasks, "_send_dataset", side_effect=self.hung_send), \
+                mock.patch.object(tasks.args_cache, "send_timeout", 0.3):
+            tasks.build_and_send_dicom_image(self.bundle, task_id, self.task_store)
+        self.assertLess(time.monotonic() - started, 5)
+        task = self.task_store.get_fhir_task_by_id(task_id)
+        self.assertEqual(task.status, TASK_FAILED)
+        self.assertEqual(task.businessStatus.text, tasks.BUSINESS_STATUS_TIMED_OUT)
+        self.assertEqual([o.valueCode for o in task.output], [tasks.DESTINATION_TIMED_OUT])
+
+    def test_cancel(self):
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        with mock.patch.object(tasks, "_send_dataset", side_effect=self.hung_send):
+            job = threading.Thread(target=tasks.build_and_send_dicom_image,
+                                   args=(self.bundle, task_id, self.task_store))
+            job.start()
+            while self.task_store.get_fhir_task_by_id(task_id).status != tasks.TASK_INPROGRESS:
+                time.sleep(0.01)
+            tasks.cancel_task(task_id, self.task_store)
+            job.join(5)
+        self.assertFalse(job.is_alive())
+        task = self.task_store.get_fhir_task_by_id(task_id)
+        self.assertEqual(task.status, tasks.TASK_CANCELLED)
+        self.assertEqual(task.businessStatus.text, tasks.BUSINESS_STATUS_CANCELLED)
+
+    def test_cancel_queued(self):
+        """ A job cancelled before it starts never runs. """
+        task_id = self.task_store.reserve_id(description=self._testMethodName)
+        tasks.cancel_task(task_id, self.task_store)
+        in_flight = tasks.memory_budget.in_flight
+        # Reserved by the job queue when it dispatched the job
+        self.assertTrue(tasks.memory_budget.try_acquire(1000))
+        with mock.patch.object(tasks, "_build_dicom_image") as build:
+            tasks.build_and_send_dicom_image(self.bundle, task_id, self.task_store, reserved_bytes=1000)
+        build.assert_not_called()
+        self.assertEqual(tasks.memory_budget.in_flight, in_flight)
+        self.assertEqual(self.task_store.get_fhir_task_by_id(task_id).status, tasks.TASK_CANCELLED)
+
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    """ Test the AIMD limit on concurrent sends. """
+
+    def test_additive_increase(self):
+        limiter = AdaptiveLimiter("test-increase", floor=1, ceiling=3, initial=1)
+        with limiter.slot():
+            pass
+        self.assertEqual(int(limiter.limit), 2)
+        # Sends that do not use the whole limit do not raise it
+        with limiter.slot():
+            pass
+        self.assertEqual(int(limiter.limit), 2)
+        for _ in range(5):
+            tokens = [limiter.acquire() for _ in range(int(limiter.limit))]
+            for token in tokens:
+                limiter.release(token, success=True)
+        self.assertEqual(int(limiter.limit), 3)
+        self.assertEqual(metrics.get_gauge("send_concurrency_limit", destination="test-increase"), 3)
+
+    def test_multiplicative_decrease_once_per_round(self):
+        limiter = AdaptiveLimiter("test-decrease", floor=2, ceiling=16, initial=16)
+        tokens = [limiter.acquire() for _ in range(8)]
+        for token in tokens:
+            limiter.release(token, success=False)
+        # All eight sends were started before the first decrease
+        self.assertEqual(int(limiter.limit), 8)
+        for _ in range(5):
+            with self.assertRaises(ConnectionError), limiter.slot():
+                raise ConnectionError()
+        self.assertEqual(int(limiter.limit), 2)
+
+    def test_slow_send_decreases(self):
+        limiter = AdaptiveLimiter("test-slow", floor=1, ceiling=8, initial=8, latency_target=0.01)
+        with limiter.slot():
+            time.sleep(0.02)
+        self.assertEqual(int(limiter.limit), 4)
+
+    def test_limit_blocks(self):
+        limiter = AdaptiveLimiter("test-block", floor=1, ceiling=1, initial=1)
+        token = limiter.acquire()
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(token, success=True)
+        self.assertTrue(acquired.wait(1))
+        waiter.join()
+
+    def test_waiting_sends_hold_no_thread(self):
+        """ Sends waiting for the limit of one destination do not hold up sends to another. """
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        slow = AdaptiveLimiter("test-slow-destination", floor=1, ceiling=1, initial=1)
+        fast = AdaptiveLimiter("test-fast-destination", floor=1, ceiling=4, initial=4)
+        unblock = threading.Event()
+        slow_futures = [slow.submit(executor, unblock.wait, 5) for _ in range(3)]
+        self.assertEqual(fast.submit(executor, lambda: "sent").result(timeout=1), "sent")
+        self.assertEqual(slow.in_flight, 1)
+        unblock.set()
+        self.assertEqual([future.result(timeout=1) for future in slow_futures], [True] * 3)
+        self.assertEqual(slow.in_flight, 0)
+
+    def test_cancelled_while_waiting(self):
+        """ A send cancelled while waiting for a slot is never made. """
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        limiter = AdaptiveLimiter("test-cancel-waiting", floor=1, ceiling=1, initial=1)
+        unblock = threading.Event()
+        first = limiter.submit(executor, unblock.wait, 5)
+        sent = []
+        second = limiter.submit(executor, sent.append, "image")
+        self.assertTrue(second.cancel())
+        unblock.set()
+        first.result(timeout=1)
+        third = limiter.submit(executor, sent.append, "other image")
+        third.result(timeout=1)
+        self.assertEqual(sent, ["other image"])
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_no_decrease_at_floor(self):
+        limiter = AdaptiveLimiter("test-floor", floor=1, ceiling=4, initial=1)
+        package_logger = logging.getLogger("fhir2dicom4ortho")
+        with self.assertLogs(package_logger, "INFO") as logs:
+            limiter.release(limiter.acquire(), success=False)
+            package_logger.info("done")
+        self.assertEqual(metrics.get_counter("send_concurrency_decreases", destination="test-floor"), 0)
+        self.assertEqual(logs.output, ["INFO:fhir2dicom4ortho:done"])
+
+
+class TestAddTasks(unittest.TestCase):
+    """ Test storing many Tasks at once. """
+
+    def test_add_tasks(self):
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        fhir_tasks = [parse_bundle(group).task for group in split_batch(test.batch_bundle(3))]
+        for fhir_task in fhir_tasks:
+            fhir_task.status = "received"
+        stored = task_store.add_tasks(fhir_tasks)
+        self.assertEqual(len({fhir_task.id for fhir_task in stored}), 3)
+        for fhir_task in stored:
+            self.assertEqual(task_store.get_fhir_task_by_id(fhir_task.id).status, "received")
+
+    def test_add_tasks_is_atomic(self):
+        """ If one Task cannot be stored, none is. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        fhir_tasks = [parse_bundle(group).task for group in split_batch(test.batch_bundle(2))]
+        before = len(task_store.get_all_tasks())
+        with mock.patch("fhir2dicom4ortho.task_store.uuid.uuid4", return_value="same-id"):
+            with self.assertRaises(Exception):
+                task_store.add_tasks(fhir_tasks)
+        self.assertEqual(len(task_store.get_all_tasks()), before)
+
+
+class TestAsyncTaskStore(unittest.TestCase):
+    """ Test async access to the TaskStore from the event loop. """
+
+    def test_calls_run_off_the_loop(self):
+        sync_task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_store = AsyncTaskStore(sync_task_store)
+        loop_thread = threading.get_ident()
+
+        async def scenario():
+            task_id = await task_store.run(sync_task_store.reserve_id, self._testMethodName)
+            await task_store.run(sync_task_store.modify_task_status, task_id, TASK_COMPLETED)
+            task = await task_store.get_fhir_task_by_id(task_id)
+            worker_thread = await task_store.run(threading.get_ident)
+            return task, worker_thread
+
+        task, worker_thread = asyncio.run(scenario())
+        self.assertEqual(task.status, TASK_COMPLETED)
+        self.assertEqual(task.description, self._testMethodName)
+        self.assertNotEqual(worker_thread, loop_thread)
+
+
+class TestLogPipeline(unittest.TestCase):
+    """ Test the queued, structured logging. """
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        root_logger = logging.getLogger()
+        self.addCleanup(root_logger.setLevel, root_logger.level)
+        handlers = list(root_logger.handlers)
+        self.listener = start_logging(logging.DEBUG, log_format="json", handler=logging.StreamHandler(self.stream))
+        self.queue_handler = next(h for h in root_logger.handlers if h not in handlers)
+        self.addCleanup(root_logger.removeHandler, self.queue_handler)
+        self.logger = logging.getLogger("test_log_pipeline")
+
+    def lines(self):
+        self.listener.stop()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json_with_task_id(self):
+        self.logger.info("no task")
+        with task_context("task-1"):
+            self.logger.info("sending %s to %s", "image", "pacs")
+            # Threads of an executor see the Task id through a copied context
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(self.logger.warning, "from a thread"))
+            thread.start()
+            thread.join()
+        lines = self.lines()
+        self.assertNotIn("task_id", lines[0])
+        self.assertEqual(lines[1]["message"], "sending image to pacs")
+        self.assertEqual(lines[1]["level"], "INFO")
+        self.assertEqual(lines[1]["task_id"], "task-1")
+        self.assertEqual(lines[2]["task_id"], "task-1")
+
+    def test_formatting_is_left_to_the_listener(self):
+        formatted_in = []
+
+        class Arg:
+            def __str__(self):
+                formatted_in.append(threading.current_thread())
+                return "arg"
+
+        # Without the capture handlers of the test runner, which format at once
+        with mock.patch.object(logging.getLogger(), "handlers", [self.queue_handler]):
+            self.logger.debug("lazy %s", Arg())
+        self.assertEqual(self.lines()[0]["message"], "lazy arg")
+        self.assertEqual(len(formatted_in), 1)
+        self.assertIsNot(formatted_in[0], threading.current_thread())
+
+    def test_debug_sampling(self):
+        sampler = DebugSampler(0.25)
+        record = lambda level: logging.LogRecord("test", level, __file__, 1, "message", None, None)
+        kept = [sampler.filter(record(logging.DEBUG)) for _ in range(100)]
+        self.assertTrue(kept[0])
+        self.assertEqual(sum(kept), 26)
+        self.assertTrue(all(sampler.filter(record(logging.INFO)) for _ in range(10)))
+        self.assertEqual(sum(DebugSampler(1).filter(record(logging.DEBUG)) for _ in range(10)), 10)
+
+    def test_full_queue_drops(self):
+        queue_handler = LazyQueueHandler(queue.Queue(maxsize=2))
+        dropped = metrics.get_counter("log_records_dropped")
+        for _ in range(5):
+            queue_handler.handle(logging.LogRecord("test", logging.INFO, __file__, 1, "message", None, None))
+        self.assertEqual(queue_handler.queue.qsize(), 2)
+        self.assertEqual(queue_handler.dropped, 3)
+        self.assertEqual(metrics.get_counter("log_records_dropped"), dropped + 3)
+
+    def test_forked_worker(self):
+        """ Records logged in a worker process of the bulk import are written. """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        log_path = Path(tmp_dir.name, "worker.log")
+        file_handler = logging.FileHandler(log_path)
+        self.addCleanup(file_handler.close)
+        root_logger = logging.getLogger()
+        handlers = list(root_logger.handlers)
+        listener = start_logging(logging.DEBUG, handler=file_handler)
+        queue_handler = next(h for h in root_logger.handlers if h not in handlers)
+        self.addCleanup(root_logger.removeHandler, queue_handler)
+
+        with ProcessPoolExecutor(max_workers=1, initializer=bulk_import.init_worker) as executor:
+            executor.submit(_log_from_worker, "from a worker").result()
+        listener.stop()
+        self.assertIn("[task-worker] from a worker", log_path.read_text())
+
+
+def _log_from_worker(message):
+    with task_context("task-worker"):
+        logging.getLogger("test_log_pipeline").info(message)
+
+
+class _SpanCollector:
+    """ Exporter keeping the exported spans. """
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class TestTracing(unittest.TestCase):
+    """ Test spans, their export, and the trace of a job. """
+
+    def setUp(self):
+        self.collector = _SpanCollector()
+
+    def test_spans(self):
+        tracer = Tracer([self.collector])
+        with task_context("task-1"), tracer.span("parent", kind="test") as parent:
+            with tracer.span("child"):
+                pass
+            tracer.record("waited", 1, 2)
+            with self.assertRaises(ValueError), tracer.span("failing"):
+                raise ValueError("boom")
+        with tracer.span("other"):
+            pass
+        tracer.flush()
+        spans = {span.name: span for span in self.collector.spans}
+        self.assertEqual(spans["parent"].attributes, {"kind": "test", "task.id": "task-1"})
+        self.assertIsNone(spans["parent"].parent_id)
+        for name in ("child", "waited", "failing"):
+            self.assertEqual(spans[name].trace_id, parent.trace_id)
+            self.assertEqual(spans[name].parent_id, parent.span_id)
+        self.assertEqual(spans["failing"].error, "ValueError: boom")
+        self.assertNotEqual(spans["other"].trace_id, parent.trace_id)
+        self.assertNotIn("task.id", spans["other"].attributes)
+        self.assertGreaterEqual(spans["parent"].end_ns, spans["child"].end_ns)
+
+    def test_disabled(self):
+        tracer = Tracer()
+        with tracer.span("nothing") as span:
+            self.assertIsNone(span)
+            self.assertIsNone(tracer.trace_id())
+
+    def test_exporters(self):
+        tracer = Tracer()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "trace.jsonl"
+            requests = []
+            client = httpx.Client(transport=httpx.MockTransport(
+                lambda request: requests.append(json.loads(request.content)) or httpx.Response(200)))
+            tracer.exporters = [FileExporter(str(path)), OtlpHttpExporter("http://collector/v1/traces", client)]
+            with tracer.span("parent"), tracer.span("child", attempt=1):
+                pass
+            tracer.flush()
+            lines = [json.loads(line) for line in path.read_text().splitlines()]
+        self.assertEqual([line["name"] for line in lines], ["child", "parent"])
+        self.assertEqual(lines[0]["parent_id"], lines[1]["span_id"])
+        spans = requests[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        self.assertEqual(spans[0]["parentSpanId"], spans[1]["spanId"])
+        self.assertEqual(spans[0]["attributes"], [{"key": "attempt", "value": {"intValue": "1"}}])
+        self.assertEqual(spans[1]["status"], {"code": tracing.OTLP_STATUS_OK})
+
+    def test_job_trace(self):
+        """ Scheduling, queue wait, build, send and TaskStore writes are all in the trace of the request. """
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_id = task_store.reserve_id(description=self._testMethodName)
+        scheduler = TestPriorityJobQueue.ManualScheduler()
+        queue = PriorityJobQueue(scheduler)
+        ok = Dataset()
+        ok.Status = 0x0000
+        with mock.patch.object(tracing.tracer, "exporters", [self.collector]), \
+                mock.patch.object(tasks.OrthodonticController, "send", return_value=ok):
+            # As in the Bundle handler
+            with task_context(task_id), tracing.tracer.span("request") as request:
+                queue.submit(tasks.build_and_send_dicom_image, args=[parse_bundle(copy.deepcopy(test.test_bundle)), task_id, task_store])
+            for dispatch in scheduler.dispatches:
+                dispatch()
+            tracing.tracer.flush()
+        self.assertEqual(task_store.get_fhir_task_by_id(task_id).status, TASK_COMPLETED)
+        names = {span.name for span in self.collector.spans}
+        for name in ("queue.wait", "job", "build", "photograph.prepare", "photograph.to_dataset", "send",
+                     "task_store.modify_task_status"):
+            self.assertIn(name, names)
+        job_spans = [span for span in self.collector.spans if span.name != "request"]
+        self.assertTrue(all(span.trace_id == request.trace_id for span in job_spans))
+        self.assertTrue(all(span.attributes["task.id"] == task_id for span in job_spans))
+
+
+class TestSearchset(unittest.TestCase):
+    """ Test the searchset Bundle spliced from stored Task JSON. """
+
+    def test_same_as_pydantic(self):
+        from fhir.resources.bundle import BundleEntry
+        from fhir2dicom4ortho.fhir_api import searchset_json
+        tasks = [Task(id=f"task-{i}", status="draft", intent="order", description=f"Task {i}") for i in range(3)]
+        task_jsons = [task.model_dump_json() for task in tasks]
+        for chunks, expected in (([], []), ([task_jsons[:2], [], task_jsons[2:]], tasks)):
+            spliced = json.loads(b"".join(searchset_json(chunks)))
+            bundle = Bundle(type="searchset", total=len(expected), entry=[BundleEntry(resource=t) for t in expected])
+            self.assertEqual(spliced, json.loads(bundle.model_dump_json()))
+        self.assertEqual(Bundle.model_validate(spliced).total, 3)
+
+    def test_iter_all_tasks_json(self):
+        task_store = TaskStore(db_url='sqlite:///test_tasks.sqlite')
+        task_ids = {task_store.reserve_id(description=self._testMethodName) for _ in range(3)}
+        chunks = list(task_store.iter_all_tasks_json(chunk_size=2))
+        self.assertTrue(all(len(chunk) <= 2 for chunk in chunks))
+        ids = [json.loads(task_json)["id"] for chunk in chunks for task_json in chunk]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertLessEqual(task_ids, set(ids))
+        task_id = task_ids.pop()
+        self.assertEqual(task_store.get_task_json(task_id), task_store.get_fhir_task_by_id(task_id).model_dump_json())
+        self.assertIsNone(task_store.get_task_json("does-not-exist"))
+
 
 if __name__ == "__main__":
     unittest.main()